@@ -0,0 +1,209 @@
+# Runs the street name, state name and zip code audits over files too
+# big for the sets the audit files collect their results in.
+# Instead of every unexpected value, each auditor keeps counts of the
+# most frequent ones in a fixed number of slots (the Space-Saving
+# heavy hitter algorithm), along with a few example values each, so
+# memory use doesn't grow with the file. Any value that makes up more
+# than 1/capacity of the anomalies it is counted with is guaranteed to
+# be in the report, with a count that is too high by at most its error.
+# The counters take the place of the sets in the audit functions of
+# street_audit.py, state_audit.py and zip_code_audit.py, which are run
+# together in one pass by combined_audit.py.
+
+import heapq
+import re
+
+import combined_audit
+import state_audit
+import street_audit
+import zip_code_audit
+
+OSMFILE = "small_sample.osm"
+
+# Number of distinct values counted by each auditor
+CAPACITY = 1000
+
+# Example values kept for each counted value
+EXAMPLES = 3
+
+
+class HeavyHitters(object):
+    """Approximate counts of the most frequent values in a stream,
+    in at most capacity slots.
+    Used in place of a set (add) or a defaultdict(set)
+    (counter[value].add(example)) by the audit functions"""
+
+    def __init__(self, capacity=CAPACITY, examples=EXAMPLES):
+        self.capacity = capacity
+        self.n_examples = examples
+        self.counts = {}
+        self.errors = {}
+        self.examples = {}
+        # (count, value) of every counted value, plus stale entries
+        # for values whose count has gone up since; the heap is rebuilt
+        # from the counts once it holds too many of those
+        self.heap = []
+        self.total = 0
+
+    def evict(self):
+        """Remove the value with the lowest count, and return its count"""
+
+        heap = self.heap
+        counts = self.counts
+        while True:
+            count, value = heapq.heappop(heap)
+            if counts.get(value) == count:
+                del counts[value]
+                del self.errors[value]
+                del self.examples[value]
+                return count
+
+    def count(self, value, example=None):
+        self.total += 1
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        else:
+            if len(counts) < self.capacity:
+                floor = 0
+            else:
+                # The new value takes the slot of the least frequent one,
+                # which it may have been seen as many times as
+                floor = self.evict()
+            counts[value] = floor + 1
+            self.errors[value] = floor
+            self.examples[value] = []
+        heapq.heappush(self.heap, (counts[value], value))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, v) for v, count in counts.iteritems()]
+            heapq.heapify(self.heap)
+        if example is not None:
+            examples = self.examples[value]
+            if len(examples) < self.n_examples and example not in examples:
+                examples.append(example)
+
+    def add(self, value):
+        self.count(value)
+
+    def __getitem__(self, value):
+        return Examples(self, value)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def top(self, n=20):
+        """The n most frequent values, as dicts of the value, its
+        count, how much the count may be too high, and examples"""
+
+        values = sorted(self.counts, key=lambda value: (-self.counts[value], value))[:n]
+        return [{'value': value, 'count': self.counts[value], 'error': self.errors[value],
+                 'examples': list(self.examples[value])} for value in values]
+
+
+class Examples(object):
+    """Counts a value each time an example of it is added"""
+
+    def __init__(self, counter, value):
+        self.counter = counter
+        self.value = value
+
+    def add(self, example):
+        self.counter.count(self.value, example)
+
+
+def postcode_pattern(code):
+    """Shape of a postcode: 9 for each digit and A for each letter,
+    so "97214-1234" and "97210-0001" are counted together"""
+
+    return re.sub(r'[A-Za-z]', 'A', re.sub(r'\d', '9', code))
+
+
+def audit_postcode_pattern(patterns, code):
+    """Count the pattern of each zip code that isn't 5 digits"""
+
+    if not zip_code_audit.zip_code_re.match(code):
+        patterns[postcode_pattern(code)].add(code)
+
+
+def make_auditors(capacity=CAPACITY, examples=EXAMPLES):
+    """Auditors for combined_audit.audit that count their results
+    in HeavyHitters instead of sets"""
+
+    def new_results():
+        return HeavyHitters(capacity, examples)
+
+    return [combined_audit.Auditor("street_types", street_audit.AUDIT_KEYS,
+                                   new_results, street_audit.audit_street_type),
+            combined_audit.Auditor("states", state_audit.AUDIT_KEYS,
+                                   new_results, state_audit.audit_state),
+            combined_audit.Auditor("zip_codes", zip_code_audit.AUDIT_KEYS,
+                                   new_results, zip_code_audit.audit_zip),
+            combined_audit.Auditor("zip_code_patterns", zip_code_audit.AUDIT_KEYS,
+                                   new_results, audit_postcode_pattern)]
+
+
+def audit(osmfile, capacity=CAPACITY, examples=EXAMPLES):
+    """Run the audits in one pass over the file. Returns the
+    HeavyHitters of each auditor, keyed by name"""
+
+    results, _ = combined_audit.audit(osmfile, make_auditors(capacity, examples))
+    return results
+
+
+def report(results, n=20):
+    """The top n values of each audit, as text"""
+
+    lines = []
+    for name in sorted(results):
+        counter = results[name]
+        lines.append("%s: %d unexpected values, %d counted" % (name, counter.total, len(counter)))
+        for row in counter.top(n):
+            error = " (+/- %d)" % row['error'] if row['error'] else ""
+            examples = ", ".join(repr(example) for example in row['examples'])
+            lines.append("  %8d%s  %r%s" % (row['count'], error, row['value'],
+                                            "  e.g. " + examples if examples else ""))
+    return "\n".join(lines)
+
+
+def test():
+    """Check the counts against exact ones on a generated file,
+    with far fewer slots than distinct values"""
+
+    import collections
+    import os
+    import random
+    import shutil
+    import tempfile
+
+    import benchmark
+
+    counter = HeavyHitters(capacity=50)
+    stream = ['common'] * 3000 + ['often'] * 1000 + ['sometimes'] * 300 + \
+             ['rare%d' % i for i in xrange(5000)]
+    random.Random(0).shuffle(stream)
+    for value in stream:
+        counter.add(value)
+    exact = collections.Counter(stream)
+    top = counter.top(3)
+    assert [row['value'] for row in top] == ['common', 'often', 'sometimes'], top
+    for row in top:
+        assert row['count'] - row['error'] <= exact[row['value']] <= row['count']
+    assert len(counter) <= 50
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'audit.osm')
+        benchmark.generate_osm(osm_path, 50000, dirty_share=0.3)
+        results = audit(osm_path, capacity=20)
+        exact_states = combined_audit.audit(osm_path)[0]
+        # The dirty state spellings are spread evenly, so every
+        # one of them fits in 20 slots
+        assert set(row['value'] for row in results['states'].top(20)) == exact_states['states']
+        assert all(len(results[name]) <= 20 for name in results)
+        print report(results, 5)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
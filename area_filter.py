@@ -0,0 +1,293 @@
+# Restricts process_map in database_prep.py to an area of interest,
+# for cutting a sub-region out of a larger extract.
+# Nodes are checked against a bounding box or polygon as they are
+# streamed, before shape_element does any work on them, and the ids
+# of the nodes that are kept go into a compact paged id set. Ways are then
+# kept if any of their nodes was kept, and relations if any of their
+# node or way members was (so ways that cross the edge of the area
+# keep all of their way nodes, even those outside of it).
+# This relies on the usual order of OSM files: nodes, then ways,
+# then relations.
+
+import array
+import bisect
+
+# Node ids covered by one page of the id set
+PAGE_BITS = 2 ** 16
+PAGE_BYTES = PAGE_BITS // 8
+
+# A page stores its ids as a sorted array of 16 bit offsets until it
+# has this many, when a bitmap of the whole page becomes smaller
+ARRAY_LIMIT = PAGE_BYTES // 2
+
+
+class NodeIdSet(object):
+    """Set of element ids split into pages of PAGE_BITS ids, each only
+    allocated once one of its ids is added (as in roaring bitmaps).
+    Sparse pages hold a sorted array of 2 byte offsets and dense ones
+    a bitmap, so an id takes at most 2 bytes instead of the ~70 of a
+    Python set of ints"""
+
+    def __init__(self):
+        self.pages = {}
+        self.count = 0
+
+    def add(self, element_id):
+        page_number, offset = divmod(element_id, PAGE_BITS)
+        page = self.pages.get(page_number)
+        if page is None:
+            page = self.pages[page_number] = array.array('H')
+        if isinstance(page, bytearray):
+            mask = 1 << (offset & 7)
+            if not page[offset >> 3] & mask:
+                page[offset >> 3] |= mask
+                self.count += 1
+            return
+        # Ids mostly arrive in order, so this is usually an append
+        if not page or page[-1] < offset:
+            page.append(offset)
+        else:
+            i = bisect.bisect_left(page, offset)
+            if i < len(page) and page[i] == offset:
+                return
+            page.insert(i, offset)
+        self.count += 1
+        if len(page) > ARRAY_LIMIT:
+            bitmap = bytearray(PAGE_BYTES)
+            for offset in page:
+                bitmap[offset >> 3] |= 1 << (offset & 7)
+            self.pages[page_number] = bitmap
+
+    def __contains__(self, element_id):
+        page_number, offset = divmod(element_id, PAGE_BITS)
+        page = self.pages.get(page_number)
+        if page is None:
+            return False
+        if isinstance(page, bytearray):
+            return bool(page[offset >> 3] & (1 << (offset & 7)))
+        i = bisect.bisect_left(page, offset)
+        return i < len(page) and page[i] == offset
+
+    def __len__(self):
+        return self.count
+
+    def memory_bytes(self):
+        return sum(len(page) * page.itemsize if isinstance(page, array.array) else len(page)
+                   for page in self.pages.values())
+
+
+class BoundingBox(object):
+    """Area between two longitudes and two latitudes"""
+
+    def __init__(self, min_lon, min_lat, max_lon, max_lat):
+        self.min_lon = min_lon
+        self.min_lat = min_lat
+        self.max_lon = max_lon
+        self.max_lat = max_lat
+
+    def contains(self, lat, lon):
+        return self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon
+
+
+def ring_contains(ring, lat, lon):
+    """Whether a point is inside a ring of (lon, lat) points,
+    by counting the edges a ray from it crosses"""
+
+    inside = False
+    x0, y0 = ring[-1]
+    for x1, y1 in ring:
+        if (y1 > lat) != (y0 > lat) and lon < (x0 - x1) * (lat - y1) / (y0 - y1) + x1:
+            inside = not inside
+        x0, y0 = x1, y1
+    return inside
+
+
+class Polygon(object):
+    """Area made of outer rings, less any holes, each a list
+    of (lon, lat) points"""
+
+    def __init__(self, rings, holes=()):
+        self.rings = [list(ring) for ring in rings]
+        self.holes = [list(hole) for hole in holes]
+        # Most points are ruled out by the bounding box alone
+        points = [point for ring in self.rings for point in ring]
+        self.bbox = BoundingBox(min(x for x, _ in points), min(y for _, y in points),
+                                max(x for x, _ in points), max(y for _, y in points))
+
+    def contains(self, lat, lon):
+        if not self.bbox.contains(lat, lon):
+            return False
+        if not any(ring_contains(ring, lat, lon) for ring in self.rings):
+            return False
+        return not any(ring_contains(hole, lat, lon) for hole in self.holes)
+
+
+def load_poly(path):
+    """Read a polygon from an Osmosis .poly file, the format
+    that extracts are usually cut with"""
+
+    rings = []
+    holes = []
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    # The first line is the name of the polygon
+    i = 1
+    while i < len(lines) and lines[i] != 'END':
+        is_hole = lines[i].startswith('!')
+        ring = []
+        i += 1
+        while lines[i] != 'END':
+            if lines[i]:
+                lon, lat = lines[i].split()[:2]
+                ring.append((float(lon), float(lat)))
+            i += 1
+        (holes if is_hole else rings).append(ring)
+        i += 1
+    if not rings:
+        raise ValueError("%s: no polygon found" % path)
+    return Polygon(rings, holes)
+
+
+def make_area(area):
+    """Return a BoundingBox or Polygon for what process_map was given:
+    one of those, a (min_lon, min_lat, max_lon, max_lat) tuple or
+    the path of a .poly file"""
+
+    if isinstance(area, (BoundingBox, Polygon)):
+        return area
+    if isinstance(area, basestring):
+        return load_poly(area)
+    if len(area) == 4:
+        return BoundingBox(*[float(value) for value in area])
+    raise ValueError("Unknown area: %r" % (area,))
+
+
+class AreaFilter(object):
+    """Keep the elements of an OSM file that are in an area"""
+
+    def __init__(self, area):
+        self.area = make_area(area)
+        self.node_ids = NodeIdSet()
+        self.way_ids = NodeIdSet()
+        self.kept = dict.fromkeys(('node', 'way', 'relation'), 0)
+        self.dropped = dict.fromkeys(('node', 'way', 'relation'), 0)
+
+    def keep(self, element):
+        tag = element.tag
+        if tag == 'node':
+            attrib = element.attrib
+            if not self.area.contains(float(attrib['lat']), float(attrib['lon'])):
+                return False
+            self.node_ids.add(int(attrib['id']))
+            return True
+        elif tag == 'way':
+            node_ids = self.node_ids
+            for nd in element.iter('nd'):
+                if int(nd.attrib['ref']) in node_ids:
+                    self.way_ids.add(int(element.attrib['id']))
+                    return True
+            return False
+        elif tag == 'relation':
+            for member in element.iter('member'):
+                member_type = member.attrib['type']
+                if member_type == 'node':
+                    ids = self.node_ids
+                elif member_type == 'way':
+                    ids = self.way_ids
+                else:
+                    continue
+                if int(member.attrib['ref']) in ids:
+                    return True
+            return False
+        return True
+
+    def filter(self, elements):
+        """Yield the elements that are in the area"""
+
+        for element in elements:
+            if self.keep(element):
+                self.kept[element.tag] += 1
+                yield element
+            else:
+                self.dropped[element.tag] += 1
+
+
+def test():
+    """Check the id set and the areas, and filter a sample file
+    to its south-west corner"""
+
+    import os
+    import random
+    import shutil
+    import sqlite3
+    import tempfile
+
+    import database_prep
+    import osm_stream
+    import sqlite_output
+
+    ids = NodeIdSet()
+    # Sparse ids, and a dense run that fills whole bitmap pages
+    added = set(random.sample(xrange(1, 10 ** 10), 20000)) | set(xrange(10 ** 6, 10 ** 6 + 200000))
+    for element_id in added:
+        ids.add(element_id)
+    assert len(ids) == len(added)
+    assert all(element_id in ids for element_id in added)
+    assert not any(element_id in ids for element_id in random.sample(xrange(1, 10 ** 10), 20000)
+                   if element_id not in added)
+    assert ids.memory_bytes() < len(added) * 2
+
+    square = Polygon([[(0, 0), (10, 0), (10, 10), (0, 10)]], [[(4, 4), (6, 4), (6, 6), (4, 6)]])
+    assert square.contains(1, 1) and not square.contains(5, 5) and not square.contains(11, 1)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        with open(osm_path, 'w') as f:
+            f.write('<osm version="0.6">\n')
+            for i in xrange(1, 101):
+                # A 10 x 10 grid of nodes, 0.01 degrees apart
+                f.write('<node id="%d" lat="%.2f" lon="%.2f" version="1" timestamp="2016-01-01T00:00:00Z" '
+                        'changeset="1" uid="1" user="test"><tag k="name" v="n%d"/></node>\n'
+                        % (i, 45 + (i - 1) // 10 * 0.01, -122 + (i - 1) % 10 * 0.01, i))
+            for i in xrange(1, 11):
+                # One way along each row of the grid
+                f.write('<way id="%d" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" '
+                        'uid="1" user="test">%s</way>\n'
+                        % (i, ''.join('<nd ref="%d"/>' % (i * 10 - 9 + j) for j in xrange(10))))
+            f.write('<relation id="1" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" '
+                    'uid="1" user="test"><member type="way" ref="10" role=""/></relation>\n')
+            f.write('<relation id="2" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" '
+                    'uid="1" user="test"><member type="way" ref="1" role=""/></relation>\n')
+            f.write('</osm>\n')
+
+        area = AreaFilter((-122.001, 44.999, -121.975, 45.025))
+        for _ in area.filter(osm_stream.iter_elements(osm_path, ('node', 'way', 'relation'))):
+            pass
+        assert area.kept == {'node': 9, 'way': 3, 'relation': 1}, area.kept
+
+        db_path = os.path.join(tmp_dir, 'map.db')
+        database_prep.process_map(osm_path, False, output='sqlite', db_path=db_path,
+                                  area=(-122.001, 44.999, -121.975, 45.025),
+                                  spatial_index=True)
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0] == 9
+        assert conn.execute("SELECT COUNT(*) FROM ways").fetchone()[0] == 3
+        found = sqlite_output.nodes_in_bbox(conn, -122.001, 44.999, -121.985, 45.005)
+        assert sorted(found) == [1, 2], found
+        # A box with edges on the nodes, which the float32 boxes
+        # of the R-tree are rounded around
+        conn.execute("UPDATE nodes SET lat = 45.5231234, lon = -122.6765432 WHERE id = 1")
+        conn.execute("INSERT OR REPLACE INTO nodes_rtree VALUES (1, 45.5231234, 45.5231234, "
+                     "-122.6765432, -122.6765432)")
+        found = sqlite_output.nodes_in_bbox(conn, -122.6765432, 45.5231234,
+                                            -122.6765432, 45.5231234)
+        assert found == [1], found
+        conn.close()
+        print "kept %(node)d nodes, %(way)d ways, %(relation)d relations" % area.kept
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,184 @@
+# On-disk cache of the results of the street name, state name and
+# zip code audits, so that running an audit again on a file that
+# hasn't changed doesn't parse the whole file again.
+# Results are keyed by a fingerprint of the OSM file (its size,
+# modification time and a hash of a few blocks spread over it, which
+# is much cheaper than hashing a whole extract) and of the rules the
+# audit depends on (the expected street types and state names, and
+# the zip code pattern), as returned by the audit_rules function of
+# each audit file. The mapping tables only affect the cleaning that
+# the test functions preview from the results, so changing them
+# doesn't invalidate the cache: only the preview is run again.
+# Used by the test functions of the audit files and by
+# combined_audit.audit(..., cache=AuditCache()).
+
+import cPickle
+import hashlib
+import json
+import os
+import tempfile
+
+CACHE_DIR = ".audit_cache"
+
+# Bumped when the format of the results or the audit code changes
+# in a way the rules don't show
+CACHE_VERSION = 1
+
+# Blocks hashed for the fingerprint, and their size
+SAMPLE_BLOCKS = 16
+SAMPLE_SIZE = 64 * 1024
+
+
+def file_fingerprint(path, blocks=SAMPLE_BLOCKS, block_size=SAMPLE_SIZE):
+    """Size, modification time and a hash of blocks_size bytes at
+    blocks offsets spread evenly over the file (including its start
+    and end). Files smaller than that are hashed whole"""
+
+    stat = os.stat(path)
+    size = stat.st_size
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        if size <= blocks * block_size:
+            digest.update(f.read())
+        else:
+            step = (size - block_size) // (blocks - 1)
+            for i in xrange(blocks):
+                f.seek(i * step)
+                digest.update(f.read(block_size))
+    return {'size': size, 'mtime': stat.st_mtime, 'sample_sha1': digest.hexdigest()}
+
+
+class AuditCache(object):
+    """Audit results saved in cache_dir, one file per result"""
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fingerprint, name, rules):
+        """Hash of everything an audit result depends on"""
+
+        return hashlib.sha1(json.dumps([CACHE_VERSION, fingerprint, name, rules],
+                                       sort_keys=True)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def get(self, fingerprint, name, rules):
+        """The saved results, or None if there are none"""
+
+        try:
+            with open(self.path(self.key(fingerprint, name, rules)), 'rb') as f:
+                results = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return results
+
+    def put(self, fingerprint, name, rules, results):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # Written to a temporary file first, so that a stopped run
+        # never leaves a partly written result behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(results, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path(self.key(fingerprint, name, rules)))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def audit(self, osmfile, name, audit, rules):
+        """Return the results of audit(osmfile), from the cache
+        if the file and rules haven't changed since they were saved"""
+
+        # Taken before the audit, so that results of a file changed
+        # while it was audited are not found again
+        fingerprint = file_fingerprint(osmfile)
+        results = self.get(fingerprint, name, rules)
+        if results is None:
+            results = audit(osmfile)
+            self.put(fingerprint, name, rules, results)
+        return results
+
+    def clear(self):
+        """Remove every saved result"""
+
+        if os.path.isdir(self.cache_dir):
+            for filename in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, filename))
+
+
+def cached_audit(osmfile, name, audit, rules, cache_dir=CACHE_DIR):
+    """AuditCache(cache_dir).audit(...), for the audit files"""
+
+    return AuditCache(cache_dir).audit(osmfile, name, audit, rules)
+
+
+def test():
+    """Check that results are found again only while neither the
+    file nor the rules have changed"""
+
+    import shutil
+    import time
+
+    import benchmark
+    import combined_audit
+    import state_audit
+    import street_audit
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        benchmark.generate_osm(osm_path, 100000, dirty_share=0.3)
+        cache = AuditCache(os.path.join(tmp_dir, 'cache'))
+
+        start = time.time()
+        first = cache.audit(osm_path, 'street_types', street_audit.audit,
+                            street_audit.audit_rules())
+        parsed = time.time() - start
+        start = time.time()
+        second = cache.audit(osm_path, 'street_types', street_audit.audit,
+                             street_audit.audit_rules())
+        cached = time.time() - start
+        assert second == first and (cache.hits, cache.misses) == (1, 1)
+        print "audit %.3f s, cached %.3f s" % (parsed, cached)
+
+        # A rule the results depend on
+        rules = street_audit.audit_rules()
+        rules['expected'] = rules['expected'] + ['Pkwy']
+        cache.audit(osm_path, 'street_types', street_audit.audit, rules)
+        assert cache.misses == 2
+
+        # The same size and modification time, and a different
+        # digit in one of the hashed blocks
+        stat = os.stat(osm_path)
+        with open(osm_path, 'r+b') as f:
+            f.seek((stat.st_size - SAMPLE_SIZE) // (SAMPLE_BLOCKS - 1) * 8)
+            offset = f.tell() + f.read(SAMPLE_SIZE).index('lat="') + 5
+            f.seek(offset)
+            digit = f.read(1)
+            f.seek(offset)
+            f.write('5' if digit != '5' else '6')
+        os.utime(osm_path, (stat.st_atime, stat.st_mtime))
+        cache.audit(osm_path, 'street_types', street_audit.audit,
+                    street_audit.audit_rules())
+        assert cache.misses == 3
+
+        # The combined audit only runs the auditors missing from the cache
+        cache = AuditCache(os.path.join(tmp_dir, 'combined'))
+        cache.audit(osm_path, 'states', state_audit.audit, state_audit.audit_rules())
+        results, timings = combined_audit.audit(osm_path, cache=cache)
+        assert results['states'] == state_audit.audit(osm_path)
+        assert timings['states'] == 0.0 and timings['street_types'] > 0.0
+        assert combined_audit.audit(osm_path, cache=cache)[0] == results
+        assert cache.hits == 1 + 3
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
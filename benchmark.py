@@ -0,0 +1,386 @@
+# Benchmarks of the cleaning and ingest code in database_prep.py, on
+# synthetic OSM files, so that changes which slow it down show up.
+# generate_osm writes a file with a configurable number of nodes,
+# ways and relations, share of tagged nodes and tags per node, and a
+# share of addr:street, addr:postcode and addr:state values written
+# the messy ways found in the Portland data (abbreviated street
+# types, zip+4 codes, "OR" for Oregon and so on).
+# run_benchmarks times get_element, shape_element, handle_tags, the
+# update_* functions and process_map, and the results can be saved as
+# JSON and compared against a saved baseline:
+#     python benchmark.py --save baseline.json
+#     python benchmark.py --baseline baseline.json
+# With --queries, the file is loaded into SQLite with the summary
+# tables instead, and the report's queries are timed against the
+# loaded tables and the summaries (see summary_tables.py).
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.cElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import database_prep
+
+STREET_NAMES = ['Alder', 'Belmont', 'Burnside', 'Division', 'Foster', 'Glisan',
+                'Hawthorne', 'Killingsworth', 'Lombard', 'Powell', 'Sandy', 'Stark',
+                'Woodstock', 'Broadway', '39th', '42nd', '82nd', 'Martin Luther King Jr',
+                u'Caf\xe9', u'Se\xf1or']
+DIRECTIONS = ['', 'North ', 'Northeast ', 'Southeast ', 'Southwest ', 'NE ', 'SE ']
+CITIES = ['Portland', 'Gresham', 'Beaverton', 'Vancouver']
+AMENITIES = ['cafe', 'restaurant', 'school', 'bench', 'parking', 'bicycle_parking']
+HIGHWAYS = ['residential', 'service', 'footway', 'primary', 'secondary', 'cycleway']
+
+# Keys of the other tags nodes get, with a function for their value;
+# 'fixme?' has a problem character, so it is dropped when shaping
+OTHER_TAGS = [('name', lambda r: r.choice(STREET_NAMES) + ' ' + r.choice(AMENITIES).title()),
+              ('amenity', lambda r: r.choice(AMENITIES)),
+              ('addr:housenumber', lambda r: str(r.randint(1, 20000))),
+              ('addr:city', lambda r: r.choice(CITIES)),
+              ('building', lambda r: 'yes'),
+              ('source', lambda r: 'survey'),
+              ('fixme?', lambda r: 'check')]
+
+TIMESTAMP = '2016-01-01T00:00:00Z'
+
+
+def street_name(r, dirty):
+    """A street name, either in its cleaned form or written
+    one of the ways update_name cleans up"""
+
+    normalizer = database_prep.normalizer
+    name = r.choice(DIRECTIONS) + r.choice(STREET_NAMES)
+    if not dirty:
+        return name + ' ' + r.choice(sorted(normalizer.expected))
+    choice = r.random()
+    if choice < 0.8:
+        return name + ' ' + r.choice(sorted(normalizer.mapping))
+    elif choice < 0.9:
+        return r.choice(sorted(normalizer.specific_mappings))
+    # The normalizer only removes a special case after " #"
+    return name + ' #' + r.choice(sorted(normalizer.special_cases))
+
+
+def postcode(r, dirty):
+    code = '972%02d' % r.randint(0, 99)
+    if not dirty:
+        return code
+    if r.random() < 0.7:
+        return '%s-%04d' % (code, r.randint(0, 9999))
+    return 'Portland, OR ' + code
+
+
+def state(r, dirty):
+    if not dirty:
+        return r.choice(['Oregon', 'Washington'])
+    return r.choice(sorted(database_prep.state_name_mapping))
+
+
+def node_tags(r, tags_per_node, dirty_share):
+    """Tags of one tagged node: an address (cleaned or dirty)
+    and a few others"""
+
+    tags = [('addr:street', street_name(r, r.random() < dirty_share)),
+            ('addr:postcode', postcode(r, r.random() < dirty_share)),
+            ('addr:state', state(r, r.random() < dirty_share))]
+    extra = max(0, int(r.gauss(tags_per_node - len(tags), 1)))
+    for key, value in r.sample(OTHER_TAGS, min(extra, len(OTHER_TAGS))):
+        tags.append((key, value(r)))
+    return tags
+
+
+def write_tags(f, tags):
+    for key, value in tags:
+        f.write('  <tag k=%s v=%s/>\n' % (quoteattr(key), quoteattr(value).encode('utf-8')))
+
+
+def generate_osm(path, n_nodes=100000, n_ways=None, n_relations=None, tagged_share=0.3,
+                 tags_per_node=5, dirty_share=0.2, seed=0):
+    """Write a synthetic OSM file. tagged_share of the nodes have
+    about tags_per_node tags, including an address with a dirty
+    street, postcode or state dirty_share of the time.
+    By default there is a way for every 10 nodes and a relation
+    for every 50 ways"""
+
+    r = random.Random(seed)
+    if n_ways is None:
+        n_ways = n_nodes // 10
+    if n_relations is None:
+        n_relations = n_ways // 50
+    node_ids = []
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark.py">\n')
+        node_id = 0
+        for _ in xrange(n_nodes):
+            # Ids with gaps, as in a real extract
+            node_id += r.randint(1, 5)
+            node_ids.append(node_id)
+            user = r.randint(1, 500)
+            attrs = ('<node id="%d" lat="%.7f" lon="%.7f" version="%d" timestamp="%s" '
+                     'changeset="%d" uid="%d" user="user%d"'
+                     % (node_id, r.uniform(45.4, 45.6), r.uniform(-122.8, -122.5),
+                        r.randint(1, 9), TIMESTAMP, r.randint(1, 10 ** 7), user, user))
+            if r.random() < tagged_share:
+                f.write(' %s>\n' % attrs)
+                write_tags(f, node_tags(r, tags_per_node, dirty_share))
+                f.write(' </node>\n')
+            else:
+                f.write(' %s/>\n' % attrs)
+        for way_id in xrange(1, n_ways + 1):
+            user = r.randint(1, 500)
+            f.write(' <way id="%d" version="%d" timestamp="%s" changeset="%d" uid="%d" user="user%d">\n'
+                    % (way_id, r.randint(1, 9), TIMESTAMP, r.randint(1, 10 ** 7), user, user))
+            start = r.randint(0, max(len(node_ids) - 20, 0))
+            for ref in node_ids[start:start + r.randint(2, 20)]:
+                f.write('  <nd ref="%d"/>\n' % ref)
+            tags = [('highway', r.choice(HIGHWAYS)),
+                    ('name', street_name(r, r.random() < dirty_share))]
+            if r.random() < 0.2:
+                tags.append(('addr:street', street_name(r, r.random() < dirty_share)))
+            write_tags(f, tags)
+            f.write(' </way>\n')
+        for relation_id in xrange(1, n_relations + 1):
+            f.write(' <relation id="%d" version="1" timestamp="%s" changeset="1" uid="1" user="user1">\n'
+                    % (relation_id, TIMESTAMP))
+            for _ in xrange(r.randint(1, 10)):
+                f.write('  <member type="way" ref="%d" role="%s"/>\n'
+                        % (r.randint(1, max(n_ways, 1)), r.choice(['outer', 'inner', ''])))
+            write_tags(f, [('type', 'multipolygon')])
+            f.write(' </relation>\n')
+        f.write('</osm>\n')
+
+
+def load_elements(path, limit):
+    """The first limit elements of a file, kept in memory (unlike
+    those from get_element) so they can be shaped repeatedly"""
+
+    elements = []
+    for _, elem in ET.iterparse(path):
+        if elem.tag in ('node', 'way', 'relation'):
+            elements.append(elem)
+            if len(elements) >= limit:
+                break
+    return elements
+
+
+def best_time(func, repeat):
+    """Shortest of repeat runs of func, in seconds"""
+
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def run_benchmarks(osm_path, repeat=3, sample_size=50000):
+    """Time each step of the ingest on a file. Returns the seconds and
+    items per second of each benchmark"""
+
+    elements = load_elements(osm_path, sample_size)
+    tags = [(tag, element) for element in elements for tag in element.iter('tag')]
+    values = {'addr:street': [], 'addr:postcode': [], 'addr:state': []}
+    for tag, _ in tags:
+        if tag.attrib['k'] in values:
+            values[tag.attrib['k']].append(tag.attrib['v'])
+    n_elements = sum(1 for _ in database_prep.get_element(osm_path))
+
+    def shape(as_tuples):
+        shape_element = database_prep.shape_element
+        for element in elements:
+            shape_element(element, as_tuples=as_tuples)
+
+    def handle_tags():
+        handle = database_prep.handle_tags
+        problem_chars = database_prep.PROBLEMCHARS
+        for tag, element in tags:
+            handle(tag, element, problem_chars)
+
+    def update(func, items):
+        def run():
+            for item in items:
+                func(item)
+        return run
+
+    out_dir = tempfile.mkdtemp()
+    paths = dict((key, os.path.join(out_dir, os.path.basename(path)))
+                 for key, path in database_prep.OUTPUT_PATHS.items())
+
+    benchmarks = [
+        ('get_element', n_elements, lambda: sum(1 for _ in database_prep.get_element(osm_path))),
+        ('shape_element', len(elements), lambda: shape(False)),
+        ('shape_element_tuples', len(elements), lambda: shape(True)),
+        ('handle_tags', len(tags), handle_tags),
+        ('update_name', len(values['addr:street']),
+         update(database_prep.update_name, values['addr:street'])),
+        ('update_zip', len(values['addr:postcode']),
+         update(database_prep.update_zip, values['addr:postcode'])),
+        ('update_state_name', len(values['addr:state']),
+         update(database_prep.update_state_name, values['addr:state'])),
+        ('process_map', n_elements,
+         lambda: database_prep.process_map(osm_path, False, paths=paths)),
+        ('process_map_validate', n_elements,
+         lambda: database_prep.process_map(osm_path, True, paths=paths)),
+    ]
+    results = {}
+    try:
+        for name, items, func in benchmarks:
+            # Start each one with empty cleaning caches
+            database_prep.set_cleaning_cache_size(database_prep.CLEANING_CACHE_SIZE)
+            seconds = best_time(func, repeat)
+            results[name] = {'seconds': seconds, 'items': items,
+                             'per_second': items / seconds if seconds else 0.0}
+    finally:
+        shutil.rmtree(out_dir)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare results with a baseline run. Returns report lines, and
+    the names of the benchmarks more than tolerance slower"""
+
+    lines = []
+    regressions = []
+    for name in sorted(results):
+        rate = results[name]['per_second']
+        if name not in baseline:
+            lines.append("%-22s %12.0f/s  (no baseline)" % (name, rate))
+            continue
+        base = baseline[name]['per_second']
+        ratio = rate / base if base else 0.0
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif ratio > 1 + tolerance:
+            flag = '  faster'
+        lines.append("%-22s %12.0f/s  baseline %12.0f/s  %5.2fx%s" % (name, rate, base, ratio, flag))
+    return lines, regressions
+
+
+def benchmark_run(n_nodes=100000, repeat=3, dirty_share=0.2, seed=0, **options):
+    """Generate a file and benchmark it. Returns the document that
+    save writes: the settings and environment, and the results"""
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'benchmark.osm')
+        generate_osm(osm_path, n_nodes, dirty_share=dirty_share, seed=seed, **options)
+        settings = dict(options, n_nodes=n_nodes, dirty_share=dirty_share, seed=seed,
+                        repeat=repeat, file_bytes=os.path.getsize(osm_path))
+        results = run_benchmarks(osm_path, repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return {'settings': settings,
+            'python': sys.version.split()[0],
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def query_benchmark(n_nodes=100000, repeat=3, dirty_share=0.2, seed=0):
+    """Generate a file, load it into SQLite with the summary tables
+    and time the report queries (see summary_tables.py)"""
+
+    import summary_tables
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'benchmark.osm')
+        generate_osm(osm_path, n_nodes, dirty_share=dirty_share, seed=seed)
+        db_path = os.path.join(tmp_dir, 'benchmark.db')
+        database_prep.process_map(osm_path, False, output='sqlite', db_path=db_path,
+                                  summaries=True)
+        return summary_tables.benchmark_queries(db_path, repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def save(run, path):
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test():
+    """Generate a small file, check what is in it, and benchmark it"""
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'small.osm')
+        generate_osm(osm_path, 5000, tagged_share=1.0, dirty_share=0.5)
+        elements = load_elements(osm_path, 10 ** 6)
+        assert sum(1 for e in elements if e.tag == 'node') == 5000
+        assert sum(1 for e in elements if e.tag == 'way') == 500
+        assert sum(1 for e in elements if e.tag == 'relation') == 10
+        streets = [tag.attrib['v'] for e in elements if e.tag == 'node'
+                   for tag in e.iter('tag') if tag.attrib['k'] == 'addr:street']
+        cleaned = sum(1 for name in streets if database_prep.update_name(name) != name)
+        # About half are dirty, and most of those get cleaned
+        assert 0.3 < cleaned / float(len(streets)) < 0.6, cleaned
+
+        run = benchmark_run(2000, repeat=1)
+        lines, regressions = compare(run['results'], run['results'])
+        assert not regressions
+        print "\n".join(lines)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cleaning and ingest code")
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--dirty-share', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare with the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--queries', action='store_true',
+                        help="time the report queries on the SQLite output instead")
+    args = parser.parse_args(argv)
+
+    if args.queries:
+        import summary_tables
+        results = query_benchmark(args.nodes, args.repeat, args.dirty_share, args.seed)
+        print "\n".join(summary_tables.report_lines(results))
+        return 0
+
+    run = benchmark_run(args.nodes, args.repeat, args.dirty_share, args.seed)
+    if args.save:
+        save(run, args.save)
+    if args.baseline:
+        baseline = load(args.baseline)
+        lines, regressions = compare(run['results'], baseline['results'], args.tolerance)
+        print "\n".join(lines)
+        return 1 if regressions else 0
+    for name in sorted(run['results']):
+        result = run['results'][name]
+        print "%-22s %8.3f s  %12.0f/s" % (name, result['seconds'], result['per_second'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
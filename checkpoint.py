@@ -0,0 +1,184 @@
+# Checkpoints for long runs of process_map in database_prep.py.
+# Every checkpoint_every elements, the number of elements processed,
+# the last element and the size of each csv file are saved. When a
+# run is restarted with the same checkpoint file, the csv files are
+# truncated back to those sizes (dropping any partly written rows)
+# and parsing starts right after the last checkpointed element,
+# which is found with a byte scan of the OSM file instead of parsing
+# everything before it again.
+
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+CHECKPOINT_EVERY = 100000
+
+# How far to read at a time when looking for the last element
+SCAN_SIZE = 2 ** 20
+
+
+def find_element_offset(file_in, tag, element_id):
+    """Return the offset of the start tag of an element in the
+    OSM file, or None if it can't be found"""
+
+    pattern = re.compile(r'<%s\s+id=["\']%s["\']' % (re.escape(tag), re.escape(element_id)))
+    offset = 0
+    carry = ''
+    with open(file_in, 'rb') as osm_file:
+        while True:
+            block = osm_file.read(SCAN_SIZE)
+            if not block:
+                return None
+            data = carry + block
+            m = pattern.search(data)
+            if m:
+                return offset - len(carry) + m.start()
+            carry = data[-64:]
+            offset += len(block)
+
+
+class Checkpoint(object):
+    """Saved progress of a process_map run over one OSM file"""
+
+    def __init__(self, path, file_in, every=CHECKPOINT_EVERY):
+        self.path = path
+        self.file_in = file_in
+        self.every = every
+        self.state = self.load()
+        self.elements = self.state['elements'] if self.state else 0
+
+    def input_fingerprint(self):
+        st = os.stat(self.file_in)
+        return {'path': os.path.abspath(self.file_in), 'size': st.st_size,
+                'mtime': st.st_mtime}
+
+    def load(self):
+        """Return the saved state, if there is one for the same input file"""
+
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('input') != self.input_fingerprint():
+            return None
+        return state
+
+    @property
+    def resume_positions(self):
+        """Sizes the output files are truncated to, or None
+        for a new run"""
+
+        return self.state['positions'] if self.state else None
+
+    def resume_source(self):
+        """Return what get_element should parse, and how many elements
+        of it still have to be skipped"""
+
+        if not self.state:
+            return self.file_in, 0
+
+        import compressed_io
+        import parallel_prep
+
+        if compressed_io.compression_of(self.file_in):
+            # A compressed file can't be read from an offset
+            return self.file_in, self.state['elements']
+        offset = find_element_offset(self.file_in, self.state['last_tag'], self.state['last_id'])
+        if offset is None:
+            # Parse from the start and skip the elements already written
+            return self.file_in, self.state['elements']
+        with open(self.file_in, 'rb') as osm_file:
+            end = parallel_prep.find_osm_end(osm_file)
+            start = parallel_prep.find_element_start(osm_file, offset + 1)
+        if start is None or start > end:
+            start = end
+        return parallel_prep.ChunkReader(self.file_in, start, end), 0
+
+    def element_done(self, element, output):
+        """Count a written element, saving a checkpoint every
+        self.every elements"""
+
+        self.elements += 1
+        if self.elements % self.every == 0:
+            self.save(element.tag, element.attrib['id'], output.positions())
+
+    def save(self, tag, element_id, positions):
+        state = {'input': self.input_fingerprint(),
+                 'elements': self.elements,
+                 'last_tag': tag,
+                 'last_id': element_id,
+                 'positions': positions}
+        # Write to a temporary file first, so a crash while saving
+        # leaves the previous checkpoint in place
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+        self.state = state
+
+    def remove(self):
+        """Delete the checkpoint once the run is complete"""
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def test(n_nodes=300000):
+    """Kill a checkpointed run part way through, resume it and check
+    that the output is the same as an uninterrupted run"""
+
+    import database_prep
+    import osm_stream
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        osm_stream.write_sample_file(osm_path, n_nodes)
+        checkpoint_path = os.path.join(tmp_dir, 'checkpoint.json')
+
+        def paths(name):
+            out_dir = os.path.join(tmp_dir, name)
+            if not os.path.isdir(out_dir):
+                os.mkdir(out_dir)
+            return dict((key, os.path.join(out_dir, os.path.basename(path)))
+                        for key, path in database_prep.OUTPUT_PATHS.items())
+
+        database_prep.process_map(osm_path, False, paths=paths('full'))
+
+        code = ("import sys; sys.path.insert(0, %r); import database_prep; "
+                "database_prep.process_map(%r, False, checkpoint_path=%r, "
+                "checkpoint_every=1000, paths=%r)"
+                % (os.path.dirname(os.path.abspath(__file__)), osm_path,
+                   checkpoint_path, paths('resumed')))
+        process = subprocess.Popen([sys.executable, '-c', code])
+        while not os.path.exists(checkpoint_path):
+            time.sleep(0.05)
+        time.sleep(1)
+        os.kill(process.pid, signal.SIGKILL)
+        process.wait()
+        with open(checkpoint_path) as f:
+            print "killed after checkpoint at element %d" % json.load(f)['elements']
+
+        database_prep.process_map(osm_path, False, checkpoint_path=checkpoint_path,
+                                  checkpoint_every=1000, paths=paths('resumed'))
+        assert not os.path.exists(checkpoint_path)
+        for key, _ in database_prep.OUTPUT_FIELDS:
+            name = os.path.basename(database_prep.OUTPUT_PATHS[key])
+            with open(os.path.join(tmp_dir, 'full', name), 'rb') as f:
+                full = f.read()
+            with open(os.path.join(tmp_dir, 'resumed', name), 'rb') as f:
+                resumed = f.read()
+            assert full == resumed, name
+        print "resumed output is identical"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
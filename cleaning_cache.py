@@ -0,0 +1,112 @@
+# Size-bounded LRU caching of the cleaning functions.
+# A few thousand distinct street names, zip codes and state names
+# come up millions of times in the full OSM file, so the cleaned
+# value of each is kept instead of being recomputed for every tag.
+# The hit, miss and eviction counts show how big the cache needs to be.
+
+# Index of each field in the links of the cache's linked list
+PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+
+DEFAULT_CAPACITY = 10000
+
+
+class CachedFunction(object):
+    """Wrap a function of one hashable argument with an LRU cache
+    holding up to capacity results"""
+
+    def __init__(self, func, capacity=DEFAULT_CAPACITY):
+        self.func = func
+        self.__name__ = getattr(func, '__name__', 'cached')
+        self.__doc__ = getattr(func, '__doc__', None)
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        """Empty the cache and set how many results it holds"""
+
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.cache = {}
+        # Circular doubly linked list, oldest entry first after the root
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, arg):
+        cache = self.cache
+        link = cache.get(arg)
+        if link is not None:
+            # Move the entry to the most recently used end
+            link_prev, link_next, _, result = link
+            link_prev[NEXT] = link_next
+            link_next[PREV] = link_prev
+            root = self.root
+            last = root[PREV]
+            last[NEXT] = root[PREV] = link
+            link[PREV] = last
+            link[NEXT] = root
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self.func(arg)
+        root = self.root
+        if len(cache) >= self.capacity:
+            # Reuse the root for the new entry and make the oldest
+            # entry the new root
+            root[KEY] = arg
+            root[RESULT] = result
+            cache[arg] = root
+            self.root = root = root[NEXT]
+            del cache[root[KEY]]
+            root[KEY] = root[RESULT] = None
+            self.evictions += 1
+        else:
+            last = root[PREV]
+            link = [last, root, arg, result]
+            last[NEXT] = root[PREV] = cache[arg] = link
+        return result
+
+    def stats(self):
+        """Counts of hits, misses and evictions, the current size
+        and the hit rate"""
+
+        calls = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.cache),
+                'capacity': self.capacity,
+                'hit_rate': float(self.hits) / calls if calls else 0.0}
+
+
+def test():
+    """Check the cache against the uncached function"""
+
+    import random
+    calls = []
+
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    cached = CachedFunction(square, capacity=3)
+    for x in [1, 2, 3, 1, 4, 2, 1]:
+        assert cached(x) == x * x
+    # 1, 2, 3 missed; 1 hit; 4 evicted 2; 2 missed and evicted 3; 1 hit
+    assert calls == [1, 2, 3, 4, 2]
+    stats = cached.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (2, 5, 2, 3)
+
+    cached = CachedFunction(square, capacity=50)
+    for _ in range(10000):
+        x = random.randint(0, 100)
+        assert cached(x) == x * x
+        assert len(cached.cache) <= 50
+    print cached.stats()
+
+
+if __name__ == '__main__':
+    test()
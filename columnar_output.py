@@ -0,0 +1,153 @@
+# Writes shaped elements to columnar Parquet or Arrow IPC files
+# instead of csv files, for the analytics jobs that re-read them.
+# Rows are buffered per table as typed columns (int64 ids, float64
+# lat/lon, dictionary-encoded strings) and written out every
+# batch_size rows, so memory use is bounded by the batch size (and
+# the Parquet row groups are at most batch_size rows).
+# Used by process_map in database_prep.py with output='parquet'
+# or output='arrow'. Requires pyarrow.
+
+import os
+
+import database_prep
+
+# Number of rows buffered per table before they are written
+BATCH_SIZE = 65536
+
+# Columns with few distinct values, which are dictionary-encoded
+# in the Parquet files. The Arrow IPC writer of pyarrow 0.16 (the last
+# release for Python 2.7) cannot write dictionaries that change from
+# one batch to the next, so the Arrow files store them as plain strings
+DICTIONARY_COLUMNS = {'user', 'key', 'type', 'member_type', 'role'}
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet and arrow outputs require pyarrow "
+                          "(pip install pyarrow)")
+    return pyarrow
+
+
+class ColumnarOutput(object):
+    """Write shaped elements to one Parquet or Arrow file per table"""
+
+    # Rows are buffered from tuples in field order (see shape_element_tuples)
+    row_format = 'tuple'
+
+    def __init__(self, out_dir='.', format='parquet', batch_size=BATCH_SIZE,
+                 row_group_size=None, compression='snappy', geometry=False, compact=False):
+        if format not in FORMATS:
+            raise ValueError("Unknown columnar format: %r" % (format,))
+        self.pa = import_pyarrow()
+        self.out_dir = out_dir
+        self.format = format
+        # Each batch is written on its own, so a Parquet row group
+        # can't hold more rows than a batch; a smaller row_group_size
+        # splits each batch into several row groups
+        if row_group_size is not None and row_group_size > batch_size:
+            raise ValueError("row_group_size (%d) can't be larger than batch_size (%d)"
+                             % (row_group_size, batch_size))
+        self.batch_size = batch_size
+        self.row_group_size = row_group_size or batch_size
+        self.compression = compression
+        self.output_fields = database_prep.output_fields(geometry, compact)
+        self.schema = database_prep.output_schema(compact)
+        self.fields = dict(self.output_fields)
+        self.schemas = {}
+        self.converters = {}
+        self.columns = {}
+        self.writers = {}
+        self.sinks = {}
+        self.rows = {}
+
+    def path(self, name):
+        base = os.path.splitext(os.path.basename(database_prep.OUTPUT_PATHS[name]))[0]
+        return os.path.join(self.out_dir, base + FORMATS[self.format])
+
+    def arrow_schema(self, name):
+        """Arrow schema of a table, with the column types from schema.py"""
+
+        pa = self.pa
+        types = {'integer': pa.int64(), 'float': pa.float64(), 'string': pa.string()}
+        rules = database_prep.field_schema(name, self.schema)
+        return pa.schema([pa.field(field, types[rules[field]['type']])
+                          for field in self.fields[name]])
+
+    def __enter__(self):
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        for name, fields in self.output_fields:
+            rules = database_prep.field_schema(name, self.schema)
+            self.schemas[name] = self.arrow_schema(name)
+            # The values are converted to their column type as they
+            # are buffered, with the coerce functions of schema.py
+            self.converters[name] = [rules[field].get('coerce') for field in fields]
+            self.columns[name] = [[] for _ in fields]
+            self.rows[name] = 0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for name in self.columns:
+                    self.flush(name)
+                    if name not in self.writers:
+                        # Write empty tables too, so every file exists
+                        self.open_writer(name)
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+            for sink in self.sinks.values():
+                sink.close()
+
+    def open_writer(self, name):
+        pa = self.pa
+        path = self.path(name)
+        schema = self.schemas[name]
+        if self.format == 'parquet':
+            dictionary = [field for field in self.fields[name] if field in DICTIONARY_COLUMNS]
+            writer = pa.parquet.ParquetWriter(path, schema, compression=self.compression,
+                                              use_dictionary=dictionary or False)
+        else:
+            self.sinks[name] = pa.OSFile(path, 'wb')
+            writer = pa.RecordBatchFileWriter(self.sinks[name], schema)
+        self.writers[name] = writer
+        return writer
+
+    def flush(self, name):
+        """Write the buffered rows of one table"""
+
+        columns = self.columns[name]
+        if not columns[0]:
+            return
+        pa = self.pa
+        schema = self.schemas[name]
+        arrays = [pa.array(column, type=field.type) for column, field in zip(columns, schema)]
+        writer = self.writers.get(name) or self.open_writer(name)
+        if self.format == 'parquet':
+            table = pa.Table.from_arrays(arrays, schema=schema)
+            writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            batch = pa.RecordBatch.from_arrays(arrays, schema.names)
+            writer.write_batch(batch)
+        self.rows[name] += len(columns[0])
+        self.columns[name] = [[] for _ in columns]
+
+    def add_rows(self, name, rows):
+        columns = self.columns[name]
+        converters = self.converters[name]
+        for row in rows:
+            for column, value, convert in zip(columns, row, converters):
+                column.append(convert(value) if convert is not None else value)
+        if len(columns[0]) >= self.batch_size:
+            self.flush(name)
+
+    def write(self, el):
+        """Buffer the rows of one shaped element"""
+
+        database_prep.write_element(self, el)
@@ -0,0 +1,132 @@
+# Runs the street name, state name and zip code audits together.
+# Each of the audit files parses the whole OSM file just to look
+# at a single tag key, which means one full pass over the file
+# per audit. Here every auditor registers the tag keys it cares
+# about, and all of them are called from one pass over the file.
+# With an audit_cache.AuditCache, only the auditors whose results
+# aren't cached for the file and their rules are run.
+
+import time
+from collections import defaultdict
+import pprint
+
+from osm_stream import iter_elements
+import state_audit
+import street_audit
+import zip_code_audit
+
+OSMFILE = "small_sample.osm"
+
+
+class Auditor(object):
+    """An audit that can be run by the combined audit"""
+
+    def __init__(self, name, keys, new_results, audit_value, rules=None):
+        # name: the key the results are returned under
+        # keys: the tag keys ("addr:street", ...) the auditor looks at
+        # new_results: called once to create the results container
+        # audit_value: called with the results and each tag value
+        # rules: returns the rules the results depend on, for the
+        # cache (see audit_cache.py); results are never cached without
+        self.name = name
+        self.keys = tuple(keys)
+        self.new_results = new_results
+        self.audit_value = audit_value
+        self.rules = rules
+
+
+AUDITORS = []
+
+def register_auditor(name, keys, new_results, audit_value, rules=None):
+    """Add an auditor to the ones run by audit()"""
+
+    auditor = Auditor(name, keys, new_results, audit_value, rules)
+    AUDITORS.append(auditor)
+    return auditor
+
+register_auditor("street_types", street_audit.AUDIT_KEYS,
+                 lambda: defaultdict(set), street_audit.audit_street_type,
+                 street_audit.audit_rules)
+register_auditor("states", state_audit.AUDIT_KEYS,
+                 set, state_audit.audit_state, state_audit.audit_rules)
+register_auditor("zip_codes", zip_code_audit.AUDIT_KEYS,
+                 set, zip_code_audit.audit_zip, zip_code_audit.audit_rules)
+
+
+def audit(osmfile, auditors=None, cache=None):
+    """Parse the OSM file once and run every auditor on the tags
+    it registered for.
+    Returns the results and the seconds spent in each auditor,
+    both keyed by auditor name.
+    With an audit_cache.AuditCache, cached results are used where
+    there are any (taking 0 seconds), and the others are saved"""
+
+    if auditors is None:
+        auditors = AUDITORS
+
+    if cache is not None:
+        import audit_cache
+        fingerprint = audit_cache.file_fingerprint(osmfile)
+        results = {}
+        missing = []
+        for auditor in auditors:
+            cached = None
+            if auditor.rules is not None:
+                cached = cache.get(fingerprint, auditor.name, auditor.rules())
+            if cached is None:
+                missing.append(auditor)
+            else:
+                results[auditor.name] = cached
+        timings = dict.fromkeys(results, 0.0)
+        if missing:
+            new_results, new_timings = audit(osmfile, missing)
+            for auditor in missing:
+                if auditor.rules is not None:
+                    cache.put(fingerprint, auditor.name, auditor.rules(),
+                              new_results[auditor.name])
+            results.update(new_results)
+            timings.update(new_timings)
+        return results, timings
+
+    # Look up the auditors by tag key, so that each tag costs
+    # a single dictionary lookup
+    auditors_by_key = defaultdict(list)
+    for auditor in auditors:
+        for key in auditor.keys:
+            auditors_by_key[key].append(auditor)
+
+    results = {}
+    timings = {}
+    for auditor in auditors:
+        results[auditor.name] = auditor.new_results()
+        timings[auditor.name] = 0.0
+
+    for elem in iter_elements(osmfile):
+        for tag in elem.iter("tag"):
+            for auditor in auditors_by_key.get(tag.attrib['k'], ()):
+                start = time.time()
+                auditor.audit_value(results[auditor.name], tag.attrib['v'])
+                timings[auditor.name] += time.time() - start
+    return results, timings
+
+def test():
+    """Run all of the audits in one pass (or take their results
+    from the cache) and show the results"""
+
+    import audit_cache
+
+    start = time.time()
+    results, timings = audit(OSMFILE, cache=audit_cache.AuditCache())
+    total = time.time() - start
+
+    pprint.pprint(dict(results["street_types"]))
+    pprint.pprint(results["states"])
+    pprint.pprint(results["zip_codes"])
+
+    for name, seconds in sorted(timings.items()):
+        print "%s: %.3f s" % (name, seconds)
+    print "total (including parsing): %.3f s" % total
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,200 @@
+# Compact mode of process_map in database_prep.py
+# (process_map(..., compact=True)).
+# The same few thousand user names, tag keys and tag types repeat
+# millions of times in a full file, and every id, uid, changeset and
+# timestamp is kept as a string until it is written. In compact mode:
+#  * ids, uids, changesets and versions are converted to ints, and
+#    timestamps to seconds since the epoch, as soon as they are read
+#  * user names are written once per uid, to a separate users table,
+#    instead of in every node, way and relation row
+#  * tag keys and types are the shared strings from the key cache of
+#    clean_tag (see KEY_CLASSES), so each distinct one is stored once
+#    however many rows use it, and the member types and roles of
+#    relations are interned the same way
+# This cuts the memory held by the rows waiting to be written and the
+# size of the output. All of the outputs (csv, SQLite, Parquet and
+# Arrow) support it.
+
+import calendar
+import copy
+
+import database_prep
+import schema
+
+NODE_FIELDS = ['id', 'lat', 'lon', 'uid', 'version', 'changeset', 'timestamp']
+WAY_FIELDS = ['id', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_FIELDS = ['id', 'uid', 'version', 'changeset', 'timestamp']
+USER_FIELDS = ['uid', 'user']
+
+# The tag, way node and member rows keep their fields
+OUTPUT_FIELDS = [(name, {'node': NODE_FIELDS,
+                         'way': WAY_FIELDS,
+                         'relation': RELATION_FIELDS}.get(name, fields))
+                 for name, fields in database_prep.OUTPUT_FIELDS] + [('user', USER_FIELDS)]
+
+
+def compact_schema():
+    """schema.py, with the compact element fields and the users table"""
+
+    compact = copy.deepcopy(schema.schema)
+    for name in ('node', 'way', 'relation'):
+        fields = compact[name]['schema']
+        del fields['user']
+        fields['version'] = {'required': True, 'type': 'integer', 'coerce': int}
+        fields['timestamp'] = {'required': True, 'type': 'integer', 'coerce': int}
+    compact['user'] = {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'uid': {'required': True, 'type': 'integer', 'coerce': int},
+                'user': {'required': True, 'type': 'string'}
+            }
+        }
+    }
+    return compact
+
+SCHEMA = compact_schema()
+
+
+class TimestampParser(object):
+    """Converts OSM timestamps (2016-01-01T00:00:00Z) to seconds
+    since the epoch. The seconds at the start of each day are cached,
+    since the timestamps of a file fall on a few thousand days"""
+
+    def __init__(self):
+        self.days = {}
+
+    def __call__(self, timestamp):
+        day = timestamp[:10]
+        start = self.days.get(day)
+        if start is None:
+            start = self.days[day] = calendar.timegm(
+                (int(day[:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+        return (start + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60
+                + int(timestamp[17:19]))
+
+
+class CompactShaper(object):
+    """Shapes elements into compact tuple rows, adding a users
+    row the first time each uid is seen"""
+
+    fields = dict(OUTPUT_FIELDS)
+    schema = SCHEMA
+
+    def __init__(self, problem_chars=database_prep.PROBLEMCHARS):
+        self.problem_chars = problem_chars
+        self.users = {}
+        self.strings = {}
+        self.timestamp = TimestampParser()
+
+    def user_rows(self, attrib, uid):
+        user = attrib['user']
+        if self.users.get(uid) == user:
+            return []
+        # A uid is written again if its name changes within the file;
+        # later rows replace earlier ones when loaded by uid
+        self.users[uid] = user
+        return [(uid, user)]
+
+    def shape(self, element):
+        attrib = element.attrib
+        clean_tag = database_prep.clean_tag
+        problem_chars = self.problem_chars
+        element_id = int(attrib['id'])
+        uid = int(attrib['uid'])
+        tags = []
+        for item in element.iter('tag'):
+            tag = clean_tag(item.attrib['k'], item.attrib['v'], problem_chars)
+            if tag:
+                # (id, key, value, type)
+                tags.append((element_id,) + tag)
+        common = (uid, int(attrib['version']), int(attrib['changeset']),
+                  self.timestamp(attrib['timestamp']))
+
+        if element.tag == 'node':
+            return {'node': (element_id, float(attrib['lat']), float(attrib['lon'])) + common,
+                    'node_tags': tags, 'user': self.user_rows(attrib, uid)}
+        elif element.tag == 'way':
+            way_nodes = [(element_id, int(node.attrib['ref']), i)
+                         for i, node in enumerate(element.iter('nd'))]
+            return {'way': (element_id,) + common, 'way_nodes': way_nodes,
+                    'way_tags': tags, 'user': self.user_rows(attrib, uid)}
+        elif element.tag == 'relation':
+            shared = self.strings.setdefault
+            members = []
+            for i, member in enumerate(element.iter('member')):
+                member_type = member.attrib['type']
+                role = member.attrib['role']
+                members.append((element_id, shared(member_type, member_type),
+                                int(member.attrib['ref']), shared(role, role), i))
+            return {'relation': (element_id,) + common, 'relation_members': members,
+                    'relation_tags': tags, 'user': self.user_rows(attrib, uid)}
+
+
+def test():
+    """Compare the compact csv files with the regular ones, and check
+    that the SQLite database joined with the users gives the same rows"""
+
+    import csv
+    import os
+    import shutil
+    import sqlite3
+    import tempfile
+    import time
+
+    import benchmark
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        benchmark.generate_osm(osm_path, 50000)
+
+        def paths(name):
+            out_dir = os.path.join(tmp_dir, name)
+            os.mkdir(out_dir)
+            return dict((key, os.path.join(out_dir, os.path.basename(path)))
+                        for key, path in database_prep.OUTPUT_PATHS.items())
+
+        regular = paths('regular')
+        compact = paths('compact')
+        database_prep.process_map(osm_path, True, paths=regular)
+        database_prep.process_map(osm_path, True, paths=compact, compact=True)
+
+        def read(path):
+            with open(path, 'rb') as f:
+                return list(csv.DictReader(f))
+
+        users = dict((row['uid'], row['user']) for row in read(compact['user']))
+        parse = TimestampParser()
+        for name in ('node', 'way', 'relation'):
+            for full, short in zip(read(regular[name]), read(compact[name])):
+                assert users[short['uid']] == full['user']
+                assert int(short['timestamp']) == parse(full['timestamp'])
+                assert time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(
+                    int(short['timestamp']))) == full['timestamp']
+                for field in ('id', 'uid', 'version', 'changeset'):
+                    assert short[field] == full[field]
+        for name in ('node_tags', 'way_nodes', 'way_tags', 'relation_members', 'relation_tags'):
+            with open(regular[name], 'rb') as f:
+                expected = f.read()
+            with open(compact[name], 'rb') as f:
+                assert f.read() == expected, name
+        sizes = [sum(os.path.getsize(path) for path in out.values() if os.path.exists(path))
+                 for out in (regular, compact)]
+        print "csv files: %d kB regular, %d kB compact" % (sizes[0] / 1024, sizes[1] / 1024)
+
+        db_path = os.path.join(tmp_dir, 'compact.db')
+        database_prep.process_map(osm_path, False, output='sqlite', db_path=db_path, compact=True)
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute("SELECT nodes.id, users.user FROM nodes JOIN users "
+                            "ON users.uid = nodes.uid ORDER BY nodes.id").fetchall()
+        assert [(int(row['id']), row['user']) for row in read(regular['node'])] == \
+            [(node_id, str(user)) for node_id, user in rows]
+        conn.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
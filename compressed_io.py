@@ -0,0 +1,331 @@
+# Reading and writing compressed files (.bz2, .gz and .zst) as a
+# stream, so an OSM extract never has to be decompressed to disk
+# before it is parsed, and the csv files can be written compressed.
+# The compression is picked from the file extension.
+# bz2 and gzip input is decompressed in a background thread (zlib and
+# bz2 release the GIL while they work), which stays a few blocks ahead
+# of the parser; zstd input and output go through a zstd process.
+# Used by get_element and CsvOutput in database_prep.py, by
+# osm_stream.py for the audit files and by incremental_update.py.
+
+import bz2
+import Queue
+import subprocess
+import threading
+import zlib
+
+# Bytes of compressed data read at a time
+READ_SIZE = 2 ** 20
+
+# Number of decompressed blocks the reader thread can get ahead by
+BLOCKS_AHEAD = 8
+
+COMPRESSIONS = {'.bz2': 'bz2', '.gz': 'gz', '.zst': 'zst'}
+
+EXTENSIONS = dict((name, ext) for ext, name in COMPRESSIONS.items())
+
+
+def compression_of(path):
+    """Return 'bz2', 'gz' or 'zst' from the extension of a path,
+    or None for an uncompressed file"""
+
+    for ext, name in COMPRESSIONS.items():
+        if path.endswith(ext):
+            return name
+    return None
+
+
+def decompressor(compression):
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    # 16 + MAX_WBITS reads the gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def iter_decompressed(raw_file, compression):
+    """Yield the decompressed data of a bz2 or gzip file in blocks.
+    Files made of several streams (as written by pbzip2 and pigz,
+    or by concatenating files) are read to the end"""
+
+    d = decompressor(compression)
+    while True:
+        data = raw_file.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                block = d.decompress(data)
+            except EOFError:
+                # A bz2 stream ended exactly at the end of the last
+                # read, so there was no unused_data to start the next
+                # one from (gzip keeps anything after the end in
+                # unused_data instead)
+                d = decompressor(compression)
+                continue
+            if block:
+                yield block
+            data = d.unused_data
+            if data:
+                # The end of one stream, with the next one after it
+                d = decompressor(compression)
+    if compression == 'gz':
+        block = d.flush()
+        if block:
+            yield block
+
+
+class ThreadedReader(object):
+    """File-like object over blocks of data produced by a background
+    thread, so that producing them overlaps with reading them"""
+
+    def __init__(self, blocks, ahead=BLOCKS_AHEAD, close=None):
+        self.queue = Queue.Queue(ahead)
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+        self.stopped = False
+        self.close_source = close
+        self.thread = threading.Thread(target=self.produce, args=(blocks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self, blocks):
+        try:
+            for block in blocks:
+                if self.stopped:
+                    return
+                self.queue.put((block, None))
+            self.queue.put(('', None))
+        except Exception as e:
+            self.queue.put(('', e))
+
+    def next_block(self):
+        block, error = self.queue.get()
+        if error is not None:
+            self.done = True
+            raise error
+        if not block:
+            self.done = True
+        return block
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.buffer[self.pos:]]
+            while not self.done:
+                parts.append(self.next_block())
+            self.buffer = ''
+            self.pos = 0
+            return ''.join(parts)
+        # Blocks can be many times the size asked for, so they are
+        # read from an offset rather than sliced down each time
+        while self.pos >= len(self.buffer) and not self.done:
+            self.buffer = self.next_block()
+            self.pos = 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.stopped = True
+        # Unblock the thread if it is waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        if self.close_source is not None:
+            self.close_source()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProcessReader(object):
+    """File-like object over the output of a decompressing process"""
+
+    def __init__(self, args):
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                        bufsize=READ_SIZE)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.wait() not in (0, -13):
+            # -13 is SIGPIPE, when the file is closed before the end
+            raise IOError("zstd exited with %d" % self.process.returncode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProcessWriter(object):
+    """File-like object that writes through a compressing process"""
+
+    def __init__(self, args, path):
+        self.out = open(path, 'wb')
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                        stdout=self.out, bufsize=READ_SIZE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def flush(self):
+        self.process.stdin.flush()
+
+    def close(self):
+        self.process.stdin.close()
+        code = self.process.wait()
+        self.out.close()
+        if code != 0:
+            raise IOError("zstd exited with %d" % code)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GzipWriter(object):
+    """Write a gzip file with zlib, without gzip.GzipFile's
+    per-write overhead"""
+
+    def __init__(self, path, level=6):
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        self.file.write(self.compressor.compress(data))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        try:
+            self.file.write(self.compressor.flush())
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_input(path):
+    """Open a file for reading, decompressing it on the fly if
+    its extension is .bz2, .gz or .zst"""
+
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, 'rb')
+    if compression == 'zst':
+        return ProcessReader(['zstd', '-q', '-d', '-c', path])
+    raw_file = open(path, 'rb')
+    return ThreadedReader(iter_decompressed(raw_file, compression), close=raw_file.close)
+
+
+def open_output_file(path):
+    """Open a file for writing, compressing what is written if
+    its extension is .bz2, .gz or .zst"""
+
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, 'wb')
+    if compression == 'bz2':
+        return bz2.BZ2File(path, 'wb')
+    if compression == 'gz':
+        return GzipWriter(path)
+    return ProcessWriter(['zstd', '-q', '-c'], path)
+
+
+def test():
+    """Write a sample OSM file in each compression, check that it
+    reads back the same, and that process_map gives the same csv
+    files from the compressed files"""
+
+    import gzip
+    import os
+    import shutil
+    import StringIO
+    import tempfile
+
+    import database_prep
+    import osm_stream
+
+    def gzip_compress(data):
+        buf = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(data)
+        return buf.getvalue()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        osm_stream.write_sample_file(osm_path, 20000)
+        with open(osm_path, 'rb') as f:
+            original = f.read()
+
+        def paths(name):
+            out_dir = os.path.join(tmp_dir, name)
+            os.mkdir(out_dir)
+            return dict((key, os.path.join(out_dir, os.path.basename(path)))
+                        for key, path in database_prep.OUTPUT_PATHS.items())
+
+        expected = paths('expected')
+        database_prep.process_map(osm_path, False, paths=expected)
+        for compression in ('bz2', 'gz', 'zst'):
+            path = osm_path + EXTENSIONS[compression]
+            with open_output_file(path) as f:
+                # Several small writes, as the csv writers make
+                for start in xrange(0, len(original), 65536):
+                    f.write(original[start:start + 65536])
+            with open_input(path) as f:
+                assert f.read() == original, compression
+            with open_input(path) as f:
+                assert ''.join(iter(lambda: f.read(4096), '')) == original, compression
+
+            out_paths = paths(compression)
+            database_prep.process_map(path, False, paths=out_paths,
+                                      compression=compression)
+            for key, _ in database_prep.OUTPUT_FIELDS:
+                expected_path = expected[key]
+                with open_input(out_paths[key] + EXTENSIONS[compression]) as f:
+                    with open(expected_path, 'rb') as g:
+                        assert f.read() == g.read(), (compression, key)
+            print "%s: %d bytes, same output" % (compression, os.path.getsize(path))
+
+        # Concatenated streams read as one file
+        with open(osm_path + '.gz', 'rb') as f:
+            gz_data = f.read()
+        with open(osm_path + '.2.gz', 'wb') as f:
+            f.write(gz_data * 2)
+        with open_input(osm_path + '.2.gz') as f:
+            assert f.read() == original * 2
+
+        # A stream ending exactly where a read ends
+        global READ_SIZE
+        read_size = READ_SIZE
+        try:
+            for compression, compress in (('bz2', bz2.compress), ('gz', gzip_compress)):
+                first, second = compress(original[:50000]), compress(original[50000:])
+                READ_SIZE = len(first)
+                blocks = iter_decompressed(StringIO.StringIO(first + second), compression)
+                assert ''.join(blocks) == original, compression
+        finally:
+            READ_SIZE = read_size
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
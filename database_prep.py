@@ -14,16 +14,24 @@
 
 import csv
 import codecs
+import cStringIO
+import itertools
+import os
 import pprint
 import re
+import time
 import xml.etree.cElementTree as ET
 
-import cerberus
-
+import checkpoint
+import cleaning_cache
+import compressed_io
+import fast_validation
 import schema
+import street_normalizer
 
-# When validating the schema, use small_sample.osm instead since
-# it will take too long with the full OSM file
+# Validation with cerberus took too long with the full OSM file,
+# so elements are validated with the compiled checks in
+# fast_validation.py (use validate_every to only check a sample)
 OSM_PATH = "map.osm"
 
 NODES_PATH = "nodes.csv"
@@ -31,6 +39,11 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+WAY_GEOMETRY_PATH = "ways_geometry.csv"
+USERS_PATH = "users.csv"
 
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
@@ -43,43 +56,22 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_type', 'member_id', 'role', 'position']
+WAY_GEOMETRY_FIELDS = ['id', 'linestring']
 
 # Recognize the correct types of street names and zip codes
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 zip_code_re = re.compile(r'^\d{5}$')
 
-# The following mapping dictionaries and list were used to convert
-# street names to their correct forms:
-mapping = { "St": "Street",
-            "St.": "Street",
-            "st.": "Street",
-            "Ave.": "Avenue",
-            "Ave": "Avenue",
-            "AVE": "Avenue",
-            "Rd.": "Road",
-            "Rd": "Road",
-            "Dr": "Drive",
-            "Dr.": "Drive",
-            "Blvd": "Boulevard",
-            "Blvd.": "Boulevard",
-            "Cir": "Circle",
-            "Hwy": "Highway",
-            "Pkwy": "Parkway",
-            "Pky": "Parkway",
-            }
-
-specific_mappings = { "8202 SE Flavel St, Portland, OR 97266": "8202 SE Flavel Street",
-                      "US 26 (OR)": "US Highway 26",
-                      "North Missouri Ave-Michigan Ave Alley": "North Missouri Avenue - Michigan Avenue Alley",
-                      " Southeast Hwy 212": "Southeast Highway 212",
-                      "Southeast Hwy 212": "Southeast Highway 212",
-                      "Southeast Stark Street;SE Stark St": "Southeast Stark Street",
-                      "North Marine Srive": "North Marine Drive",
-                      "unknown": "N/A",
-                      "gresham": "Gresham"
-                      }
-
-special_cases = {"D", "101", "C113", "E"}
+# The mapping dictionaries and list used to convert street names
+# to their correct forms are kept in street_rules.json, and compiled
+# into a single lookup table by street_normalizer.py
+normalizer = street_normalizer.default_normalizer()
+mapping = normalizer.mapping
+specific_mappings = normalizer.specific_mappings
+special_cases = normalizer.special_cases
 
 #This dictionary was used to standardize state names
 state_name_mapping = {"OR": "Oregon",
@@ -96,16 +88,7 @@ def update_name(name):
     """Clean street names according to different data cleaning
      procedures"""
 
-    m = street_type_re.search(name)
-    street_type = m.group()
-    if name in specific_mappings:
-        name = name.replace(name, specific_mappings[name])
-    elif street_type in mapping:
-        name = name.replace(street_type, mapping[street_type]).strip(".").strip(" ")
-    elif street_type in special_cases:
-        name_to_replace = " #" + street_type
-        name = name.replace(name_to_replace, "")
-    return name
+    return normalizer.normalize(name)
 
 # Here the only issues that came up were hyphenated zip codes and
 # "Portland, OR " being included before the zip code
@@ -126,62 +109,136 @@ def update_state_name(state_name):
         state_name = state_name.replace(state_name, state_name_mapping[state_name])
     return state_name
 
-# Node tags and way tags were handled in the same way
-# Therefore, this function is used in the function below it
-# to eliminate repitition
-def handle_tags(item, element, problem_chars):
-    """Set the key, type, and value of tags when inserted
-     into the database"""
+# The same street names, zip codes and state names come up over
+# and over in the full file, so the cleaned values are cached
+# (see cleaning_cache.py). The cached functions return exactly
+# the same values as the update functions above
+CLEANING_CACHE_SIZE = 10000
+
+clean_street_name = cleaning_cache.CachedFunction(update_name, CLEANING_CACHE_SIZE)
+clean_zip = cleaning_cache.CachedFunction(update_zip, CLEANING_CACHE_SIZE)
+clean_state_name = cleaning_cache.CachedFunction(update_state_name, CLEANING_CACHE_SIZE)
+
+CACHED_CLEANERS = [clean_street_name, clean_zip, clean_state_name]
+
+def set_cleaning_cache_size(capacity):
+    """Empty the caches of the cleaning functions and set
+    how many values each one holds"""
+
+    for cleaner in CACHED_CLEANERS:
+        cleaner.resize(capacity)
+
+def cleaning_cache_stats():
+    """Hit, miss and eviction counts of each cleaning cache"""
+
+    return dict((cleaner.__name__, cleaner.stats()) for cleaner in CACHED_CLEANERS)
+
+# Cleaning function applied to the values of each tag key.
+# Other keys keep their values as they are
+CLEANERS = {'addr:street': clean_street_name,
+            'addr:postcode': clean_zip,
+            'addr:state': clean_state_name}
+
+# A whole file has only a few thousand distinct tag keys, so what
+# clean_tag does with each key is worked out once and kept here, for
+# each problem_chars pattern: None if the key is dropped, otherwise
+# its key, its type and its cleaner
+KEY_CLASSES = {}
+
+# Keys stop being added to KEY_CLASSES past this many
+KEY_CACHE_SIZE = 100000
+
+def register_cleaner(k, cleaner):
+    """Clean the values of tags with key k (e.g. 'addr:city') with
+    cleaner, or stop cleaning them if cleaner is None"""
 
-    s = problem_chars.search(item.attrib['k'])
+    if cleaner is None:
+        CLEANERS.pop(k, None)
+    else:
+        CLEANERS[k] = cleaner
+    KEY_CLASSES.clear()
+
+def classify_key(k, problem_chars=PROBLEMCHARS):
+    """Return (key, type, cleaner) for a tag key, or None if the key
+    has problematic characters"""
+
+    s = problem_chars.search(k)
     # If there are no problematic characters in an attribute's key,
     # the function proceeds
     if not s:
-        d = {}
-        # The 'id' assigned in the osm file is assigned in the same
-        # way for the database
-        d['id'] = element.attrib['id']
-        possible_type = str(item.attrib['k'])
         # If there is at least one colon in the name, the string
         # before the colon is assigned to the 'type'
         # and the remaining characters are assigned to the 'key'
         # (regardless of whether there is another colon)
-        if possible_type.count(":") >= 1:
-            separated = possible_type.split(":", 1)
-            d['key'] = separated[1]
-            d['type'] = separated[0]
-            # Values for street, zip code, and state name 
-            # are all cleaned here,
-            # each according to their update functions
-            if item.attrib["k"] == 'addr:street':
-                d["value"] = update_name(item.attrib["v"])
-            elif item.attrib["k"] == 'addr:postcode':
-                d["value"] = update_zip(item.attrib["v"])
-            elif item.attrib["k"] == 'addr:state':
-                d["value"] = update_state_name(item.attrib["v"])
-            # If the key does not pertain to the street name, 
+        if k.count(":") >= 1:
+            tag_type, key = k.split(":", 1)
+            # Values for street, zip code, and state name
+            # are all cleaned, each according to their update functions.
+            # If the key does not pertain to the street name,
             # zip code, or state name, the regular value is used
-            else:
-                d['value'] = item.attrib['v']
+            return key, tag_type, CLEANERS.get(k)
         # If there are no colons in the key, then the normal
         # key and value are used, and the type is just "regular"
         else:
-            d['key'] = item.attrib['k']
-            d['type'] = "regular"
-            d['value'] = item.attrib['v']
-        return d
+            return k, "regular", CLEANERS.get(k)
     #For keys with problematic characters, no node was tag is added
     else:
         return None
 
+# Node tags and way tags were handled in the same way
+# Therefore, this function is used in the functions below it
+# to eliminate repitition
+def clean_tag(k, v, problem_chars=PROBLEMCHARS):
+    """Return the key, value, and type of a tag as they are
+     inserted into the database, or None if the key has
+     problematic characters"""
+
+    try:
+        key_class = KEY_CLASSES[problem_chars][k]
+    except KeyError:
+        key_class = classify_key(k, problem_chars)
+        classes = KEY_CLASSES.setdefault(problem_chars, {})
+        if len(classes) < KEY_CACHE_SIZE:
+            classes[k] = key_class
+    if key_class is None:
+        return None
+    key, tag_type, cleaner = key_class
+    if cleaner is not None:
+        v = cleaner(v)
+    return key, v, tag_type
+
+def handle_tags(item, element, problem_chars):
+    """Set the key, type, and value of tags when inserted
+     into the database"""
+
+    tag = clean_tag(item.attrib['k'], item.attrib['v'], problem_chars)
+    if tag:
+        d = {}
+        # The 'id' assigned in the osm file is assigned in the same
+        # way for the database
+        d['id'] = element.attrib['id']
+        d['key'], d['value'], d['type'] = tag
+        return d
+    else:
+        return None
+
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular',
+                  relation_attr_fields=RELATION_FIELDS, as_tuples=False):
+    """Clean and shape node, way or relation XML element to Python dict.
+    With as_tuples=True, each row is a tuple in the order of its fields
+    (see shape_element_tuples)"""
+
+    if as_tuples:
+        return shape_element_tuples(element, node_attr_fields, way_attr_fields,
+                                    problem_chars, relation_attr_fields)
 
     node_attribs = {}
     way_attribs = {}
+    relation_attribs = {}
     way_nodes = []
+    relation_members = []
     tags = []  
 
     if element.tag == 'node':
@@ -189,14 +246,18 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
             node_attribs[field] = element.attrib[field]
         for item in element.iter('tag'):
             d = handle_tags(item, element, problem_chars)
-            tags.append(d)
+            # Tags with problematic keys are skipped
+            if d:
+                tags.append(d)
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
         for field in way_attr_fields:
             way_attribs[field] = element.attrib[field]
         for item in element.iter('tag'):
             d = handle_tags(item, element, problem_chars)
-            tags.append(d)
+            # Tags with problematic keys are skipped
+            if d:
+                tags.append(d)
         for i, node in enumerate(element.iter("nd")):
             d = {}
             d['id'] = element.attrib['id']
@@ -204,6 +265,77 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
             d['position'] = i
             way_nodes.append(d)
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    # Relations (multipolygons, routes, boundaries...) are shaped like
+    # ways, with their members kept in order along with their type and role
+    elif element.tag == 'relation':
+        for field in relation_attr_fields:
+            relation_attribs[field] = element.attrib[field]
+        for item in element.iter('tag'):
+            d = handle_tags(item, element, problem_chars)
+            if d:
+                tags.append(d)
+        for i, member in enumerate(element.iter("member")):
+            d = {}
+            d['id'] = element.attrib['id']
+            d['member_type'] = member.attrib['type']
+            d['member_id'] = member.attrib['ref']
+            d['role'] = member.attrib['role']
+            d['position'] = i
+            relation_members.append(d)
+        return {'relation': relation_attribs, 'relation_members': relation_members,
+                'relation_tags': tags}
+
+
+def shape_element_tuples(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+                         problem_chars=PROBLEMCHARS, relation_attr_fields=RELATION_FIELDS):
+    """Clean and shape an XML element like shape_element, but with
+    each row as a tuple in the order of NODE_FIELDS, NODE_TAGS_FIELDS,
+    WAY_NODES_FIELDS, etc. instead of a dict"""
+
+    attrib = element.attrib
+    element_id = attrib['id']
+    tags = []
+    refs = []
+    # One pass over the children of the element: the element.iter of
+    # cElementTree is a Python generator, and costs more than the
+    # shaping itself when it is called once per kind of child
+    for child in element:
+        if child.tag == 'tag':
+            child_attrib = child.attrib
+            tag = clean_tag(child_attrib['k'], child_attrib['v'], problem_chars)
+            if tag:
+                # (id, key, value, type)
+                tags.append((element_id,) + tag)
+        else:
+            refs.append(child.attrib)
+
+    if element.tag == 'node':
+        return {'node': tuple([attrib[field] for field in node_attr_fields]),
+                'node_tags': tags}
+    elif element.tag == 'way':
+        way_nodes = [(element_id, node['ref'], i) for i, node in enumerate(refs)]
+        return {'way': tuple([attrib[field] for field in way_attr_fields]),
+                'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == 'relation':
+        members = [(element_id, member['type'], member['ref'], member['role'], i)
+                   for i, member in enumerate(refs)]
+        return {'relation': tuple([attrib[field] for field in relation_attr_fields]),
+                'relation_members': members, 'relation_tags': tags}
+
+
+def element_as_dicts(el, compact=False):
+    """Turn the tuple rows of an element shaped by shape_element_tuples
+    (or compact.CompactShaper, with compact=True) into the dicts
+    returned by shape_element"""
+
+    fields = dict(output_fields(geometry=True, compact=compact))
+    shaped = {}
+    for name, rows in el.items():
+        if isinstance(rows, tuple):
+            shaped[name] = dict(zip(fields[name], rows))
+        else:
+            shaped[name] = [dict(zip(fields[name], row)) for row in rows]
+    return shaped
 
 
 # ================================================== #
@@ -212,6 +344,22 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag"""
 
+    # PBF files are decoded by pbf_reader.py into elements
+    # that shape_element handles the same way
+    if isinstance(osm_file, basestring) and osm_file.endswith('.pbf'):
+        import pbf_reader
+        for elem in pbf_reader.iter_elements(osm_file, tags):
+            yield elem
+        return
+
+    # Compressed files (.bz2, .gz, .zst) are decompressed as they
+    # are parsed, see compressed_io.py
+    if isinstance(osm_file, basestring) and compressed_io.compression_of(osm_file):
+        with compressed_io.open_input(osm_file) as f:
+            for elem in get_element(f, tags):
+                yield elem
+        return
+
     context = ET.iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
     for event, elem in context:
@@ -243,45 +391,376 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+# Number of rows TupleCsvWriter buffers before writing them
+WRITE_BATCH_SIZE = 1000
+
+class TupleCsvWriter(object):
+    """Write rows given as tuples in field order to a csv file,
+    in buffered batches. The output is the same as UnicodeDictWriter's"""
+
+    def __init__(self, f, fieldnames, batch_size=WRITE_BATCH_SIZE):
+        self.file = f
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+        self.batch = []
+
+    def writeheader(self):
+        self.writerow(tuple(self.fieldnames))
+
+    def writerow(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.batch.extend(rows)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the file"""
+
+        if not self.batch:
+            return
+        buf = cStringIO.StringIO()
+        try:
+            csv.writer(buf).writerows(self.batch)
+        except UnicodeEncodeError:
+            # Only batches with non-ASCII text pay for encoding each value
+            buf = cStringIO.StringIO()
+            csv.writer(buf).writerows(
+                [[v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+                 for row in self.batch])
+        self.file.write(buf.getvalue())
+        self.batch = []
+
+
+def write_element(output, el):
+    """Hand the rows of one shaped element to the add_rows method of
+    an output (CsvOutput, sqlite_output.SqliteOutput or
+    columnar_output.ColumnarOutput), table by table"""
+
+    if 'user' in el:
+        output.add_rows('user', el['user'])
+    if 'node' in el:
+        output.add_rows('node', (el['node'],))
+        output.add_rows('node_tags', el['node_tags'])
+    elif 'way' in el:
+        output.add_rows('way', (el['way'],))
+        output.add_rows('way_nodes', el['way_nodes'])
+        output.add_rows('way_tags', el['way_tags'])
+        if 'way_geometry' in el:
+            output.add_rows('way_geometry', el['way_geometry'])
+    elif 'relation' in el:
+        output.add_rows('relation', (el['relation'],))
+        output.add_rows('relation_members', el['relation_members'])
+        output.add_rows('relation_tags', el['relation_tags'])
+
+
+class CsvOutput(object):
+    """Write shaped elements to the csv files"""
+
+    # Rows are written from tuples in field order (see shape_element_tuples)
+    row_format = 'tuple'
+
+    def __init__(self, paths=None, header=True, resume_positions=None, compression=None,
+                 geometry=False, compact=False):
+        # paths maps each key of a shaped element ('node', 'node_tags', ...)
+        # to the csv file its rows are written to.
+        # resume_positions maps the same keys to the sizes the existing
+        # files are truncated to before appending to them (see checkpoint.py)
+        # With compression='bz2', 'gz' or 'zst' the files are written
+        # compressed, with the extension added to each path
+        self.paths = paths or OUTPUT_PATHS
+        if compression is not None:
+            if compression not in compressed_io.EXTENSIONS:
+                raise ValueError("Unknown compression: %r" % (compression,))
+            ext = compressed_io.EXTENSIONS[compression]
+            self.paths = dict((name, path + ext) for name, path in self.paths.items())
+        if resume_positions is not None and any(
+                compressed_io.compression_of(path) for path in self.paths.values()):
+            raise ValueError("Compressed csv files can't be resumed from a checkpoint")
+        self.header = header
+        self.resume_positions = resume_positions
+        self.output_fields = output_fields(geometry, compact)
+        self.files = {}
+        self.writers = {}
+
+    def __enter__(self):
+        for name, fields in self.output_fields:
+            if self.resume_positions is not None:
+                # Drop anything written after the checkpoint,
+                # including partly written rows
+                f = open(self.paths[name], 'r+b')
+                f.truncate(self.resume_positions[name])
+                f.seek(0, os.SEEK_END)
+            else:
+                f = compressed_io.open_output_file(self.paths[name])
+            self.files[name] = f
+            writer = TupleCsvWriter(f, fields)
+            if self.header and self.resume_positions is None:
+                writer.writeheader()
+            self.writers[name] = writer
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            for writer in self.writers.values():
+                writer.flush()
+        finally:
+            for f in self.files.values():
+                f.close()
+
+    def positions(self):
+        """Flush everything written so far and return the size
+        of each csv file"""
+
+        positions = {}
+        for name, f in self.files.items():
+            self.writers[name].flush()
+            f.flush()
+            positions[name] = f.tell()
+        return positions
+
+    # Each table has its own file, so the rows of different tables
+    # can be written from different threads (see pipeline.py)
+    tables_independent = True
+
+    def add_rows(self, name, rows):
+        self.writers[name].writerows(rows)
+
+    def write(self, el):
+        """Write the rows of one shaped element"""
+
+        write_element(self, el)
+
+
+# Each key of a shaped element and the fields of its rows,
+# in the order the csv files are written
+OUTPUT_FIELDS = [('node', NODE_FIELDS),
+                 ('node_tags', NODE_TAGS_FIELDS),
+                 ('way', WAY_FIELDS),
+                 ('way_nodes', WAY_NODES_FIELDS),
+                 ('way_tags', WAY_TAGS_FIELDS),
+                 ('relation', RELATION_FIELDS),
+                 ('relation_tags', RELATION_TAGS_FIELDS),
+                 ('relation_members', RELATION_MEMBERS_FIELDS)]
+
+OUTPUT_PATHS = {'node': NODES_PATH,
+                'node_tags': NODE_TAGS_PATH,
+                'way': WAYS_PATH,
+                'way_nodes': WAY_NODES_PATH,
+                'way_tags': WAY_TAGS_PATH,
+                'relation': RELATIONS_PATH,
+                'relation_tags': RELATION_TAGS_PATH,
+                'relation_members': RELATION_MEMBERS_PATH,
+                'way_geometry': WAY_GEOMETRY_PATH,
+                'user': USERS_PATH}
+
+
+def output_fields(geometry=False, compact=False):
+    """OUTPUT_FIELDS, with the way geometry table when it is written
+    (see way_geometry.py), or the compact fields and users table
+    of compact mode (see compact.py)"""
+
+    fields = OUTPUT_FIELDS
+    if compact:
+        import compact as compact_module
+        fields = compact_module.OUTPUT_FIELDS
+    if geometry:
+        return fields + [('way_geometry', WAY_GEOMETRY_FIELDS)]
+    return fields
+
+
+def output_schema(compact=False):
+    """The schema the shaped elements are validated with, and
+    the outputs take their column types from"""
+
+    if compact:
+        import compact as compact_module
+        return compact_module.SCHEMA
+    return SCHEMA
+
+
+def field_schema(name, element_schema=SCHEMA):
+    """Return the schema.py field rules for the rows of one key
+    of a shaped element"""
+
+    rules = element_schema[name]
+    if rules['type'] == 'list':
+        rules = rules['schema']
+    return rules['schema']
+
+
+def shape_for_output(element, as_tuples, geometry=None, shaper=None):
+    """Shape an element with tuple or dict rows, adding the
+    geometry of ways if a way_geometry.WayGeometry is given.
+    A compact.CompactShaper, if given, shapes it into compact
+    tuple rows instead"""
+
+    if shaper is not None:
+        el = shaper.shape(element)
+    else:
+        el = shape_element(element, as_tuples=as_tuples)
+    if el and geometry is not None:
+        if element.tag == 'node':
+            geometry.add_node(element)
+        elif element.tag == 'way':
+            rows = geometry.way_rows(element)
+            if not as_tuples:
+                rows = [dict(zip(WAY_GEOMETRY_FIELDS, row)) for row in rows]
+            el['way_geometry'] = rows
+    return el
+
+
+def write_elements(elements, output, validate, validate_every=1, validator=None,
+                   checkpoint=None, geometry=None, stats=None, shaper=None):
+    """Shape each XML element, optionally validate it,
+    and write it to the output.
+    With validate_every=N only every Nth element is validated.
+    Progress is saved to the checkpoint, if one is given, and the
+    geometry of each way is added with a way_geometry.WayGeometry.
+    The time spent on each step is recorded in stats, if given
+    (see pipeline_stats.py). A compact.CompactShaper given as shaper
+    shapes the elements into compact rows"""
+
+    compact = shaper is not None
+    element_schema = output_schema(compact)
+    # The compiled validator gives the same errors as cerberus.Validator
+    # and is fast enough to leave validation on for the full file
+    if validator is None:
+        validator = fast_validation.CompiledValidator(element_schema)
+
+    # Outputs that take tuple rows get them straight from
+    # shape_element_tuples, without building a dict per row
+    as_tuples = getattr(output, 'row_format', 'dict') == 'tuple'
+
+    if stats is not None:
+        elements = stats.timed(elements)
+        timer = time.time
+        profiler = None
+
+    for i, element in enumerate(elements):
+        if stats is not None:
+            profiler = stats.profiler if stats.profiling() else None
+            if profiler is not None:
+                profiler.enable()
+            started = timer()
+
+        el = shape_for_output(element, as_tuples, geometry, shaper)
+        if stats is not None:
+            shaped = validated = timer()
+        if el:
+            if validate is True and i % validate_every == 0:
+                validate_element(element_as_dicts(el, compact) if as_tuples else el,
+                                 validator, element_schema)
+                if stats is not None:
+                    validated = timer()
+            output.write(el)
+        if checkpoint is not None:
+            checkpoint.element_done(element, output)
+
+        if stats is not None:
+            if profiler is not None:
+                profiler.disable()
+            stats.element_done(element, shaped - started, validated - shaped,
+                               timer() - validated)
+
+
+def open_output(output='csv', **options):
+    """Return the output that shaped elements are written to:
+    'csv' for the csv files, 'sqlite' to load them straight
+    into a SQLite database (see sqlite_output.py), or 'parquet'
+    or 'arrow' for columnar files (see columnar_output.py)"""
+
+    if output == 'csv':
+        return CsvOutput(**options)
+    elif output == 'sqlite':
+        import sqlite_output
+        return sqlite_output.SqliteOutput(**options)
+    elif output in ('parquet', 'arrow'):
+        import columnar_output
+        return columnar_output.ColumnarOutput(format=output, **options)
+    raise ValueError("Unknown output: %r" % (output,))
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-            codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-            codecs.open(WAYS_PATH, 'w') as ways_file, \
-            codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-            codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+def process_map(file_in, validate, output='csv', validate_every=1,
+                checkpoint_path=None, checkpoint_every=checkpoint.CHECKPOINT_EVERY,
+                area=None, geometry=False, location_store='sorted', stats=None,
+                pipeline=None, compact=False, **output_options):
+    """Iteratively process each XML element and write to csv(s),
+    or to the output chosen with output and output_options.
+    With a checkpoint_path, progress is saved every checkpoint_every
+    elements, and a run that was stopped resumes from its last checkpoint.
+    With an area (a bounding box or polygon, see area_filter.py) only
+    the elements inside it are written.
+    With geometry=True the WKB linestring of each way is written too,
+    with the node coordinates kept in location_store ('sorted' or
+    'dense', see way_geometry.py).
+    A pipeline_stats.PipelineStats given as stats records the
+    throughput and time spent on each step of the run.
+    With pipeline=True (or a pipeline.Pipeline, to see its statistics
+    afterwards) parsing, shaping and writing run in separate threads.
+    With compact=True ids, versions and timestamps are written as
+    integers and user names to a separate users table (see compact.py)"""
+
+    if pipeline and (checkpoint_path is not None or stats is not None):
+        raise ValueError("The pipelined run can't be used with checkpoints or stats")
+
+    progress = None
+    source, skip = file_in, 0
+    if checkpoint_path is not None:
+        if output != 'csv':
+            raise ValueError("Checkpoints are only supported for the csv output")
+        if area is not None or geometry or compact:
+            # The ids and coordinates of the nodes and the users seen
+            # so far are not saved in the checkpoint
+            raise ValueError("Checkpoints can't be used with an area, geometry or compact mode")
+        progress = checkpoint.Checkpoint(checkpoint_path, file_in, checkpoint_every)
+        output_options['resume_positions'] = progress.resume_positions
+        source, skip = progress.resume_source()
+
+    elements = get_element(source, tags=('node', 'way', 'relation'))
+    if skip:
+        elements = itertools.islice(elements, skip, None)
+    if area is not None:
+        import area_filter
+        elements = area_filter.AreaFilter(area).filter(elements)
+    locations = None
+    if geometry:
+        import way_geometry
+        locations = way_geometry.WayGeometry(location_store)
+        output_options['geometry'] = True
+    shaper = None
+    if compact:
+        import compact as compact_module
+        shaper = compact_module.CompactShaper()
+        output_options['compact'] = True
+    if stats is not None:
+        stats.start()
+    try:
+        with open_output(output, **output_options) as out:
+            if pipeline:
+                if pipeline is True:
+                    import pipeline as pipeline_module
+                    pipeline = pipeline_module.Pipeline()
+                pipeline.run(elements, out, validate, validate_every, geometry=locations,
+                             shaper=shaper)
+            else:
+                write_elements(elements, out, validate, validate_every, checkpoint=progress,
+                               geometry=locations, stats=stats, shaper=shaper)
+    finally:
+        if locations is not None:
+            locations.close()
+        if stats is not None:
+            stats.finish()
+
+    if progress is not None:
+        progress.remove()
+    return out
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+# Compiled version of the cerberus validation of shaped elements.
+# cerberus interprets the nested schema in schema.py again for every
+# element, which is far too slow for the full OSM file. Here the
+# schema is turned once into per-field checks (type test and coercion
+# function), which are then run on the flat rows of each element.
+# The errors are the same as the ones cerberus gives for the schema,
+# so validate_element in database_prep.py works with either validator.
+# Only the rules used in schema.py are supported:
+# type, required, coerce and schema.
+
+import time
+
+import schema
+
+SCHEMA = schema.schema
+
+# Python types accepted for each schema type, as in cerberus
+TYPES = {'integer': (int, long),
+         'float': (float, int, long),
+         'string': (basestring,),
+         'dict': (dict,),
+         'list': (list, tuple)}
+
+SUPPORTED_RULES = {'type', 'required', 'coerce', 'schema'}
+
+REQUIRED_FIELD = 'required field'
+UNKNOWN_FIELD = 'unknown field'
+NULL_VALUE = 'null value not allowed'
+BAD_TYPE = 'must be of %s type'
+COERCION_FAILED = "field '%s' cannot be coerced: %s"
+
+
+def compile_field(field, rules):
+    """Return a function that checks one value against the rules
+    of a field, returning None if it is valid and else the list
+    of errors cerberus would give for it"""
+
+    unsupported = set(rules) - SUPPORTED_RULES
+    if unsupported:
+        raise ValueError("Unsupported rules for field %r: %s" % (field, sorted(unsupported)))
+
+    type_name = rules['type']
+    types = TYPES[type_name]
+    bad_type = BAD_TYPE % type_name
+    coerce = rules.get('coerce')
+    check_mapping = None
+    check_item = None
+    if 'schema' in rules:
+        if type_name == 'dict':
+            check_mapping = compile_mapping(rules['schema'])
+        else:
+            check_item = compile_field(None, rules['schema'])
+
+    def check(value, field=field):
+        coerce_error = None
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as exc:
+                coerce_error = COERCION_FAILED % (field, exc)
+        if value is None:
+            errors = [NULL_VALUE]
+        elif not isinstance(value, types):
+            errors = [bad_type]
+        else:
+            errors = []
+            if check_mapping is not None:
+                mapping_errors = check_mapping(value)
+                if mapping_errors:
+                    errors.append(mapping_errors)
+            elif check_item is not None:
+                item_errors = {}
+                for i, item in enumerate(value):
+                    e = check_item(item, i)
+                    if e:
+                        item_errors[i] = e
+                if item_errors:
+                    errors.append(item_errors)
+        if coerce_error is not None:
+            errors.append(coerce_error)
+        return errors or None
+
+    return check
+
+
+def compile_mapping(fields_schema):
+    """Return a function that checks a dict against a schema of
+    fields, returning a dict of errors by field (empty if valid)"""
+
+    checks = [(field, rules.get('required', False), compile_field(field, rules))
+              for field, rules in fields_schema.items()]
+    known = frozenset(fields_schema)
+
+    def check(document):
+        errors = {}
+        present = 0
+        for field, required, check_field in checks:
+            if field in document:
+                present += 1
+                e = check_field(document[field])
+                if e:
+                    errors[field] = e
+            elif required:
+                errors[field] = [REQUIRED_FIELD]
+        if len(document) > present:
+            for field in document:
+                if field not in known:
+                    errors[field] = [UNKNOWN_FIELD]
+        return errors
+
+    return check
+
+
+class CompiledValidator(object):
+    """Drop-in replacement for cerberus.Validator for the schema in
+    schema.py. The schema is compiled the first time it is seen"""
+
+    def __init__(self, schema=SCHEMA):
+        self.schema = schema
+        self.check = compile_mapping(schema)
+        self.errors = {}
+
+    def validate(self, document, schema=None):
+        """Return True if the document is valid, else set
+        self.errors and return False"""
+
+        if schema is not None and schema is not self.schema:
+            self.schema = schema
+            self.check = compile_mapping(schema)
+        self.errors = self.check(document)
+        return not self.errors
+
+
+def benchmark(elements, repeat=3):
+    """Time cerberus and the compiled validator on a list of shaped
+    elements, and check that they give the same errors"""
+
+    import cerberus
+
+    validators = [('cerberus', cerberus.Validator()), ('compiled', CompiledValidator())]
+    results = {}
+    for name, validator in validators:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for el in elements:
+                validator.validate(el, SCHEMA)
+            seconds = time.time() - start
+            best = seconds if best is None else min(best, seconds)
+        results[name] = best
+
+    for el in elements:
+        for _, validator in validators:
+            validator.validate(el, SCHEMA)
+        assert validators[0][1].errors == validators[1][1].errors, el
+
+    return results
+
+
+def test():
+    """Compare the compiled validator with cerberus on valid
+    and invalid elements"""
+
+    node = {'id': '1', 'lat': '45.5', 'lon': '-122.6', 'user': 'a', 'uid': '1',
+            'version': '1', 'changeset': '1', 'timestamp': '2016-01-01T00:00:00Z'}
+    tag = {'id': '1', 'key': 'street', 'value': 'Main Street', 'type': 'addr'}
+    way = {'id': '2', 'user': 'a', 'uid': '1', 'version': '1', 'changeset': '1',
+           'timestamp': '2016-01-01T00:00:00Z'}
+    way_node = {'id': '2', 'node_id': '1', 'position': 0}
+
+    def changed(row, **values):
+        row = dict(row)
+        for field, value in values.items():
+            if value is KeyError:
+                del row[field]
+            else:
+                row[field] = value
+        return row
+
+    elements = [
+        {'node': node, 'node_tags': [tag, tag]},
+        {'way': way, 'way_nodes': [way_node], 'way_tags': [tag]},
+        {'node': changed(node, id='x', lon=KeyError, user=5, extra=1), 'node_tags': []},
+        {'node': changed(node, lat=None, user=None), 'node_tags': [None, 'x', changed(tag, type=KeyError)]},
+        {'way': changed(way, uid=[1]), 'way_nodes': [changed(way_node, position='a')], 'way_tags': 'x'},
+        {'node': 'abc', 'unknown': 1},
+        {'node': None},
+    ]
+
+    results = benchmark(elements * 200)
+    print "cerberus: %.3f s, compiled: %.3f s (%.0fx)" % (
+        results['cerberus'], results['compiled'],
+        results['cerberus'] / results['compiled'])
+
+
+if __name__ == '__main__':
+    test()
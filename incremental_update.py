@@ -0,0 +1,411 @@
+# Applies OSM change files (.osc) to the SQLite database built by
+# process_map(..., output='sqlite'), instead of rebuilding it from a
+# fresh extract.
+# The created and modified nodes, ways and relations are shaped and
+# cleaned the same way as in database_prep.py and replace their rows
+# (and the rows of their tags, way nodes and members); deleted
+# elements have all of their rows removed. If the database has way
+# geometries, those of the changed ways and of the ways whose nodes
+# changed are built again from the nodes table, and if it has the
+# summary tables of summary_tables.py the counts of the rows each
+# change removes and adds are applied to them.
+# The sequence number of each applied change file is recorded in the
+# database along with its changes, so updates can be applied
+# continuously and a change file is never applied twice. It is read
+# from the .state.txt replication serves next to each file, or from
+# the replication path (000/123/456.osc.gz); files named otherwise
+# need it given (apply_changes(..., sequences=...), or --sequences).
+# Change files can be read compressed, as replication serves them (.osc.gz).
+# Only the SQLite output can be updated in place; the csv files
+# still need a full run of process_map.
+
+import binascii
+import os
+import re
+import sqlite3
+import xml.etree.cElementTree as ET
+
+import compressed_io
+import database_prep
+import sqlite_output
+import summary_tables
+import way_geometry
+
+DB_PATH = sqlite_output.DB_PATH
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# Key of the main row of each element type, and the keys
+# of its child rows, as returned by shape_element
+ELEMENT_ROWS = {'node': ('node', ('node_tags',)),
+                'way': ('way', ('way_nodes', 'way_tags')),
+                'relation': ('relation', ('relation_members', 'relation_tags'))}
+
+CREATE_STATE_TABLE = ("CREATE TABLE IF NOT EXISTS replication_state "
+                      "(sequence INTEGER PRIMARY KEY, file TEXT, "
+                      "applied_at TEXT DEFAULT CURRENT_TIMESTAMP)")
+
+
+def sequence_from_state(osc_path):
+    """Return the sequence number in the state file that replication
+    serves next to a change file (456.state.txt for 456.osc.gz), or
+    None if there is none"""
+
+    state_path = os.path.join(os.path.dirname(osc_path),
+                              os.path.basename(osc_path).split('.osc')[0] + '.state.txt')
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        for line in f:
+            if line.startswith('sequenceNumber='):
+                return int(line.split('=', 1)[1])
+    raise ValueError("No sequenceNumber in %s" % state_path)
+
+
+def sequence_from_path(path):
+    """Return the sequence number of a change file, from its state
+    file or from its path, e.g. 123456 for .../000/123/456.osc or
+    123456.osc. Raise ValueError for other names (such as
+    changes-2024-01-02.osc), whose sequence has to be given"""
+
+    sequence = sequence_from_state(path)
+    if sequence is not None:
+        return sequence
+    directory, filename = os.path.split(path)
+    name = filename.split('.osc')[0]
+    if not name.isdigit():
+        raise ValueError("Can't tell the sequence number of %r from its name; "
+                         "give it explicitly" % (path,))
+    # Replication diffs are stored as AAA/BBB/CCC.osc.gz
+    parents = directory.replace('\\', '/').split('/')[-2:]
+    if len(name) == 3 and len(parents) == 2 and all(
+            len(part) == 3 and part.isdigit() for part in parents):
+        name = ''.join(parents) + name
+    return int(name)
+
+
+def iter_changes(osc_file):
+    """Yield (action, element) for each node, way and relation in
+    a change file, clearing each element once it has been used"""
+
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    action = None
+    block = root
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ACTIONS:
+                action = elem.tag
+                block = elem
+        elif elem.tag in ELEMENT_ROWS:
+            yield action, elem
+            block.clear()
+        elif elem.tag in ACTIONS:
+            action = None
+            block = root
+            root.clear()
+
+
+class ChangeApplier(object):
+    """Upsert and delete the rows of changed elements in the
+    SQLite database"""
+
+    def __init__(self, conn):
+        if has_table(conn, 'users'):
+            raise ValueError("The database was loaded in compact mode (see compact.py), "
+                             "which can't be updated with change files; load it "
+                             "without compact=True to update it")
+        self.conn = conn
+        fields = dict(database_prep.output_fields(geometry=True))
+        self.inserts = {}
+        self.deletes = {}
+        for name, table in sqlite_output.TABLE_NAMES.items():
+            if name not in fields:
+                # The users table of compact mode
+                continue
+            self.inserts[name] = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join('"%s"' % field for field in fields[name]),
+                ', '.join('?' * len(fields[name])))
+            self.deletes[name] = 'DELETE FROM %s WHERE id = ?' % table
+        self.counts = dict.fromkeys(ACTIONS, 0)
+        # Keep the R-tree over the nodes and the way geometries
+        # up to date, if the database has them
+        self.spatial_index = sqlite_output.has_spatial_index(conn)
+        self.geometry = has_table(conn, 'ways_geometry')
+        self.summary = None
+        if has_table(conn, 'summary_users'):
+            self.summary = summary_tables.SummaryDeltas(
+                conn, database_prep.output_fields(geometry=True))
+        self.changed_ways = set()
+
+    def delete(self, tag, element_id):
+        main, children = ELEMENT_ROWS[tag]
+        if self.summary is not None:
+            self.summary.remove(tag, element_id)
+        for name in (main,) + children:
+            self.conn.execute(self.deletes[name], (element_id,))
+        if tag == 'node' and self.spatial_index:
+            self.conn.execute("DELETE FROM nodes_rtree WHERE id = ?", (element_id,))
+        if self.geometry:
+            if tag == 'way':
+                self.conn.execute("DELETE FROM ways_geometry WHERE id = ?", (element_id,))
+            elif tag == 'node':
+                # The ways using a node that moved or was deleted
+                # get a new geometry once the whole file is applied
+                self.changed_ways.update(row[0] for row in self.conn.execute(
+                    "SELECT id FROM ways_nodes WHERE node_id = ?", (element_id,)))
+
+    def apply(self, action, element):
+        """Apply one created, modified or deleted element"""
+
+        element_id = int(element.attrib['id'])
+        # The old tags, way nodes and members are always removed,
+        # since a modified element may have fewer than before
+        self.delete(element.tag, element_id)
+        if action != 'delete':
+            el = database_prep.shape_element_tuples(element)
+            main, children = ELEMENT_ROWS[element.tag]
+            self.conn.execute(self.inserts[main], el[main])
+            if element.tag == 'node' and self.spatial_index:
+                lat = float(element.attrib['lat'])
+                lon = float(element.attrib['lon'])
+                self.conn.execute("INSERT INTO nodes_rtree VALUES (?, ?, ?, ?, ?)",
+                                  (element_id, lat, lat, lon, lon))
+            for name in children:
+                if el[name]:
+                    self.conn.executemany(self.inserts[name], el[name])
+            if element.tag == 'way' and self.geometry:
+                self.changed_ways.add(element_id)
+            if self.summary is not None:
+                self.summary.add_rows(main, [el[main]])
+                self.summary.add_rows(main + '_tags', el[main + '_tags'])
+        self.counts[action] += 1
+
+    def finish(self):
+        """Build the geometry of the ways that changed, from the
+        coordinates of their nodes in the database, and update the
+        summary tables"""
+
+        for way_id in self.changed_ways:
+            self.conn.execute("DELETE FROM ways_geometry WHERE id = ?", (way_id,))
+            points = [(way_geometry.to_fixed(lat), way_geometry.to_fixed(lon))
+                      for lat, lon in self.conn.execute(
+                          "SELECT nodes.lat, nodes.lon FROM ways_nodes "
+                          "JOIN nodes ON nodes.id = ways_nodes.node_id "
+                          "WHERE ways_nodes.id = ? ORDER BY ways_nodes.position", (way_id,))]
+            if len(points) >= 2:
+                self.conn.execute(self.inserts['way_geometry'], (way_id, binascii.hexlify(
+                    way_geometry.linestring_wkb(points))))
+        self.changed_ways = set()
+        if self.summary is not None:
+            self.summary.apply()
+
+
+def open_db(db_path=DB_PATH):
+    """Connect to the database, creating any missing tables"""
+
+    conn = sqlite3.connect(db_path)
+    for name, fields in database_prep.OUTPUT_FIELDS:
+        conn.execute(sqlite_output.create_table_sql(name, fields))
+    for index in sqlite_output.INDEXES:
+        conn.execute(index)
+    conn.execute(CREATE_STATE_TABLE)
+    conn.commit()
+    return conn
+
+
+def has_table(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table,)).fetchone() is not None
+
+
+def last_sequence(conn):
+    """Sequence number of the last applied change file, or None"""
+
+    return conn.execute("SELECT MAX(sequence) FROM replication_state").fetchone()[0]
+
+
+def apply_change_file(conn, osc_path, sequence=None):
+    """Apply one change file in a single transaction.
+    Returns the counts of created, modified and deleted elements,
+    or None if the file had already been applied"""
+
+    if sequence is None:
+        sequence = sequence_from_path(osc_path)
+    last = last_sequence(conn)
+    if last is not None and sequence <= last:
+        return None
+
+    applier = ChangeApplier(conn)
+    try:
+        with compressed_io.open_input(osc_path) as osc_file:
+            for action, element in iter_changes(osc_file):
+                if action is None:
+                    raise ValueError("%s: <%s> outside of a create, modify or delete block"
+                                     % (osc_path, element.tag))
+                applier.apply(action, element)
+        applier.finish()
+        conn.execute("INSERT INTO replication_state (sequence, file) VALUES (?, ?)",
+                     (sequence, os.path.basename(osc_path)))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return applier.counts
+
+
+def apply_changes(osc_paths, db_path=DB_PATH, sequences=None):
+    """Apply the change files that have not been applied yet, in
+    sequence order. sequences gives the sequence number of each file,
+    for files whose names don't have it (see sequence_from_path)"""
+
+    if sequences is None:
+        sequences = [sequence_from_path(path) for path in osc_paths]
+    elif len(sequences) != len(osc_paths):
+        raise ValueError("%d sequence numbers for %d change files"
+                         % (len(sequences), len(osc_paths)))
+    if len(set(sequences)) != len(sequences):
+        # Only the first file of a sequence number would be applied
+        raise ValueError("Change files with the same sequence number: %s" % ', '.join(
+            path for sequence, path in zip(sequences, osc_paths)
+            if sequences.count(sequence) > 1))
+
+    conn = open_db(db_path)
+    try:
+        for sequence, path in sorted(zip(sequences, osc_paths)):
+            counts = apply_change_file(conn, path, sequence)
+            if counts is not None:
+                print "%s: %d created, %d modified, %d deleted" % (
+                    path, counts['create'], counts['modify'], counts['delete'])
+    finally:
+        conn.close()
+
+
+
+TEST_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="45.50" lon="-122.60" version="1" changeset="1" uid="1" user="a"
+  timestamp="2016-01-01T00:00:00Z"><tag k="amenity" v="cafe"/></node>
+ <node id="2" lat="45.51" lon="-122.61" version="1" changeset="1" uid="1" user="a"
+  timestamp="2016-01-01T00:00:00Z"/>
+ <node id="3" lat="45.52" lon="-122.62" version="1" changeset="1" uid="1" user="a"
+  timestamp="2016-01-01T00:00:00Z"><tag k="name" v="Gone"/></node>
+ <way id="10" version="1" changeset="1" uid="1" user="a" timestamp="2016-01-01T00:00:00Z">
+  <nd ref="1"/><nd ref="2"/><nd ref="3"/><tag k="highway" v="residential"/></way>
+ <relation id="20" version="1" changeset="1" uid="1" user="a"
+  timestamp="2016-01-01T00:00:00Z"><member type="way" ref="10" role="outer"/>
+  <member type="node" ref="3" role="label"/><tag k="type" v="multipolygon"/></relation>
+</osm>
+"""
+
+TEST_OSC = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <create>
+  <node id="4" lat="45.53" lon="-122.63" version="1" changeset="2" uid="2" user="b"
+   timestamp="2016-02-01T00:00:00Z"><tag k="shop" v="bakery"/></node>
+ </create>
+ <modify>
+  <node id="1" lat="45.54" lon="-122.64" version="2" changeset="2" uid="2" user="b"
+   timestamp="2016-02-01T00:00:00Z"><tag k="amenity" v="restaurant"/>
+   <tag k="cuisine" v="thai"/></node>
+  <way id="10" version="2" changeset="2" uid="2" user="b" timestamp="2016-02-01T00:00:00Z">
+   <nd ref="1"/><nd ref="4"/><tag k="highway" v="residential"/></way>
+  <relation id="20" version="2" changeset="2" uid="2" user="b"
+   timestamp="2016-02-01T00:00:00Z"><member type="way" ref="10" role="outer"/>
+   <tag k="type" v="multipolygon"/></relation>
+ </modify>
+ <delete>
+  <node id="3" version="2" changeset="2" uid="2" user="b" timestamp="2016-02-01T00:00:00Z"/>
+ </delete>
+</osmChange>
+"""
+
+
+def test():
+    """Check which change file names give a sequence number, and apply
+    a change file to a small database"""
+
+    import shutil
+    import tempfile
+
+    assert sequence_from_path('minute/006/123/456.osc.gz') == 6123456
+    assert sequence_from_path('123456.osc') == 123456
+    assert sequence_from_path('data/2024/456.osc') == 456
+    for path in ('changes-2024-01-02.osc', 'changes-2024-02-01.osc', 'update_7.osc.gz'):
+        try:
+            sequence_from_path(path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(path)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osc_path = os.path.join(tmp_dir, 'changes-2024-01-02.osc.gz')
+        with open(os.path.join(tmp_dir, 'changes-2024-01-02.state.txt'), 'w') as f:
+            f.write("#Tue Jan 02 00:00:00 UTC 2024\nsequenceNumber=4242\n"
+                    "timestamp=2024-01-02T00\\:00\\:00Z\n")
+        assert sequence_from_path(osc_path) == 4242
+        try:
+            apply_changes(['a.osc', 'b.osc'], os.path.join(tmp_dir, 'map.db'), sequences=[1, 1])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("duplicate sequence numbers")
+
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        osc_path = os.path.join(tmp_dir, '1.osc')
+        with open(osm_path, 'w') as f:
+            f.write(TEST_OSM)
+        with open(osc_path, 'w') as f:
+            f.write(TEST_OSC)
+        db_path = os.path.join(tmp_dir, 'update.db')
+        database_prep.process_map(osm_path, True, output='sqlite', db_path=db_path)
+        conn = open_db(db_path)
+
+        def dump():
+            return dict((table, conn.execute("SELECT * FROM %s ORDER BY 1, 2, 3" % table)
+                         .fetchall()) for table in ('nodes', 'nodes_tags', 'ways',
+                                                    'ways_nodes', 'ways_tags', 'relations',
+                                                    'relations_members', 'relations_tags'))
+
+        assert apply_change_file(conn, osc_path) == {'create': 1, 'modify': 3, 'delete': 1}
+        rows = dump()
+        assert [row[:3] for row in rows['nodes']] == [(1, 45.54, -122.64), (2, 45.51, -122.61),
+                                                      (4, 45.53, -122.63)]
+        assert [row[:3] for row in rows['nodes_tags']] == [
+            (1, u'amenity', u'restaurant'), (1, u'cuisine', u'thai'), (4, u'shop', u'bakery')]
+        assert rows['ways_nodes'] == [(10, 1, 0), (10, 4, 1)]
+        assert rows['relations_members'] == [(20, u'way', 10, u'outer', 0)]
+        assert [(row[0], row[3]) for row in rows['relations']] == [(20, u'2')]
+        # The same file again is skipped, and applying its changes a
+        # second time (as a later sequence) leaves the rows as they are
+        assert apply_change_file(conn, osc_path) is None
+        assert apply_change_file(conn, osc_path, sequence=2) is not None
+        assert dump() == rows
+        conn.close()
+
+        compact_path = os.path.join(tmp_dir, 'compact.db')
+        database_prep.process_map(osm_path, False, output='sqlite', db_path=compact_path,
+                                  compact=True)
+        conn = open_db(compact_path)
+        try:
+            apply_change_file(conn, osc_path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("compact database")
+        conn.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Apply OSM change files to the database")
+    parser.add_argument('osc_paths', nargs='+', metavar='osc_path')
+    parser.add_argument('--db', default=DB_PATH, help="database to update")
+    parser.add_argument('--sequences', type=lambda value: [int(n) for n in value.split(',')],
+                        help="comma-separated sequence numbers of the change files, in "
+                             "the order given, if their names and state files don't have them")
+    args = parser.parse_args()
+    apply_changes(args.osc_paths, args.db, args.sequences)
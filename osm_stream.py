@@ -0,0 +1,108 @@
+# Streaming iteration over the elements of an OSM file, used by the
+# audit files.
+# Elements are yielded on their "end" event, so all of their child
+# tags have been parsed, and are cleared (along with the root) once
+# they have been consumed. Every other child of the root is cleared
+# at its end too, including the relations the audits skip, which
+# would otherwise pile up under the root. This keeps memory use flat
+# no matter how big the OSM file is, the same way get_element does in
+# database_prep.py
+# .bz2, .gz and .zst files are read without decompressing them to disk
+
+import os
+import resource
+import tempfile
+import xml.etree.cElementTree as ET
+
+import compressed_io
+
+
+def iter_elements(osmfile, tags=("node", "way")):
+    """Yield each complete element with one of the given tags,
+    clearing it once the caller is done with it"""
+
+    if osmfile.endswith('.pbf'):
+        import pbf_reader
+        for elem in pbf_reader.iter_elements(osmfile, tags):
+            yield elem
+        return
+
+    # Compressed files are decompressed as they are parsed
+    osm_file = compressed_io.open_input(osmfile)
+    try:
+        context = ET.iterparse(osm_file, events=("start", "end"))
+        _, root = next(context)
+        depth = 0
+        for event, elem in context:
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if elem.tag in tags:
+                yield elem
+                elem.clear()
+                root.clear()
+            elif depth == 0:
+                elem.clear()
+                root.clear()
+    finally:
+        osm_file.close()
+
+
+def peak_memory_kb():
+    """Peak resident set size of this process in kilobytes"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_sample_file(path, n_nodes, n_relations=0):
+    """Write an OSM file with n_nodes tagged nodes, a way
+    for every 10 nodes and n_relations relations"""
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for i in xrange(1, n_nodes + 1):
+            f.write(' <node id="%d" lat="45.5" lon="-122.6" version="1" '
+                    'timestamp="2016-01-01T00:00:00Z" changeset="1" uid="1" user="test">\n'
+                    '  <tag k="addr:street" v="Southeast %d St"/>\n'
+                    '  <tag k="addr:postcode" v="97214-%04d"/>\n'
+                    ' </node>\n' % (i, i, i % 10000))
+        for i in xrange(1, n_nodes / 10 + 1):
+            f.write(' <way id="%d" version="1" timestamp="2016-01-01T00:00:00Z" '
+                    'changeset="1" uid="1" user="test">\n' % i)
+            for ref in xrange(i * 10 - 9, i * 10 + 1):
+                f.write('  <nd ref="%d"/>\n' % ref)
+            f.write('  <tag k="addr:state" v="OR"/>\n </way>\n')
+        for i in xrange(1, n_relations + 1):
+            f.write(' <relation id="%d" version="1" timestamp="2016-01-01T00:00:00Z" '
+                    'changeset="1" uid="1" user="test">\n' % i)
+            for ref in xrange(i, i + 10):
+                f.write('  <member type="way" ref="%d" role="outer"/>\n' % ref)
+            f.write('  <tag k="type" v="multipolygon"/>\n </relation>\n')
+        f.write('</osm>\n')
+
+
+def test(n_nodes=500000, max_growth_kb=20 * 1024):
+    """Stream a large synthetic file and check that the peak memory
+    grows by less than max_growth_kb while doing so, including over
+    the relations at its end, which aren't yielded"""
+
+    fd, path = tempfile.mkstemp(suffix=".osm")
+    os.close(fd)
+    try:
+        write_sample_file(path, n_nodes, n_relations=n_nodes / 5)
+        before = peak_memory_kb()
+        count = 0
+        for elem in iter_elements(path):
+            count += len(elem.findall("tag"))
+        growth = peak_memory_kb() - before
+        print "%d MB file, %d tags, peak memory grew by %d kB" % (
+            os.path.getsize(path) / 2 ** 20, count, growth)
+        assert count == n_nodes * 2 + n_nodes / 10
+        assert growth < max_growth_kb
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
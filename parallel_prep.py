@@ -0,0 +1,275 @@
+# Multiprocess version of process_map in database_prep.py.
+# The OSM file is split into byte ranges that start at a <node>,
+# <way> or <relation> element, and each range is shaped and written
+# to its own set of csv part files by a pool of worker processes.
+# The parts are then concatenated in range order, so the
+# csv files are the same as the ones written by process_map
+# (including the position order of the way nodes).
+# Pre-split shards (complete OSM files) can be processed the same way,
+# and may be compressed (see compressed_io.py).
+
+import codecs
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+import compressed_io
+import database_prep
+
+# Size of each byte range handed to a worker.
+# Workers stream their range, so this does not bound memory use,
+# only how finely the work is spread over the pool
+CHUNK_SIZE = 64 * 2 ** 20
+
+# Top-level elements are only ever opened by one of these tags
+# (child elements are <tag>, <nd> and <member>)
+ELEMENT_START_RE = re.compile(r'<(?:node|way|relation)[\s/>]')
+OSM_END = '</osm>'
+
+# How far to read at a time when looking for an element boundary
+SCAN_SIZE = 2 ** 16
+
+
+def find_element_start(osm_file, offset):
+    """Return the offset of the first element starting at or after
+    offset, or None if there is none"""
+
+    osm_file.seek(offset)
+    # Keep a few bytes of the previous block in case a tag
+    # is split between two reads
+    carry = ''
+    while True:
+        block = osm_file.read(SCAN_SIZE)
+        if not block:
+            return None
+        data = carry + block
+        m = ELEMENT_START_RE.search(data)
+        if m:
+            return offset - len(carry) + m.start()
+        carry = data[-10:]
+        offset += len(block)
+
+
+def find_osm_end(osm_file):
+    """Return the offset of the closing </osm> tag, or the size
+    of the file if there is none"""
+
+    osm_file.seek(0, os.SEEK_END)
+    size = osm_file.tell()
+    osm_file.seek(max(size - SCAN_SIZE, 0))
+    tail = osm_file.read()
+    if OSM_END in tail:
+        return max(size - SCAN_SIZE, 0) + tail.rfind(OSM_END)
+    return size
+
+
+def find_chunks(file_in, chunk_size=CHUNK_SIZE):
+    """Split the OSM file into (start, end) byte ranges,
+    each starting at an element boundary"""
+
+    if compressed_io.compression_of(file_in):
+        raise ValueError("%s: compressed files can't be split into byte ranges, "
+                         "use process_map or process_shards" % file_in)
+    with open(file_in, 'rb') as osm_file:
+        first = find_element_start(osm_file, 0)
+        if first is None:
+            return []
+
+        # The last range ends before the closing </osm> tag
+        end = find_osm_end(osm_file)
+
+        starts = [first]
+        while starts[-1] + chunk_size < end:
+            start = find_element_start(osm_file, starts[-1] + chunk_size)
+            if start is None or start >= end:
+                break
+            starts.append(start)
+
+    return zip(starts, starts[1:] + [end])
+
+
+class ChunkReader(object):
+    """File-like object that reads a byte range of the OSM file
+    wrapped in an <osm> element, so it can be given to iterparse"""
+
+    def __init__(self, file_in, start, end):
+        self.osm_file = open(file_in, 'rb')
+        self.osm_file.seek(start)
+        self.remaining = end - start
+        self.pending = ['<osm>']
+        self.closed_tag = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining + 16
+        if self.pending:
+            return self.pending.pop()
+        if self.remaining > 0:
+            data = self.osm_file.read(min(size, self.remaining))
+            self.remaining -= len(data)
+            if data:
+                return data
+            self.remaining = 0
+        if not self.closed_tag:
+            self.closed_tag = True
+            return OSM_END
+        return ''
+
+    def close(self):
+        self.osm_file.close()
+
+
+def part_paths(part_dir, index):
+    """Paths of the csv part files written for one chunk or shard"""
+
+    return dict((name, os.path.join(part_dir, '%s.%06d.csv' % (name, index)))
+                for name, _ in database_prep.OUTPUT_FIELDS)
+
+
+def process_chunk(args):
+    """Shape the elements of one byte range (or of a whole shard,
+    when start is None) into csv part files"""
+
+    file_in, start, end, part_dir, index, validate, validate_every = args
+    if start is None:
+        source = file_in
+    else:
+        source = ChunkReader(file_in, start, end)
+    try:
+        with database_prep.CsvOutput(part_paths(part_dir, index), header=False) as output:
+            database_prep.write_elements(
+                database_prep.get_element(source, tags=('node', 'way', 'relation')),
+                output, validate, validate_every)
+    finally:
+        if start is not None:
+            source.close()
+    return index
+
+
+def merge_parts(part_dir, n_parts, paths=None):
+    """Concatenate the csv part files, in order, into the
+    output csv files"""
+
+    paths = paths or database_prep.OUTPUT_PATHS
+    for name, fields in database_prep.OUTPUT_FIELDS:
+        with codecs.open(paths[name], 'w') as out:
+            database_prep.UnicodeDictWriter(out, fields).writeheader()
+            for index in range(n_parts):
+                part = part_paths(part_dir, index)[name]
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out, 2 ** 20)
+                os.remove(part)
+
+
+def run_jobs(jobs, processes):
+    """Run the chunk jobs in a worker pool"""
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap_unordered keeps all of the workers busy; the parts are
+        # merged by index afterwards, so the output order is fixed
+        for _ in pool.imap_unordered(process_chunk, jobs):
+            pass
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def process_map_parallel(file_in, validate, processes=None, chunk_size=CHUNK_SIZE,
+                         validate_every=1, paths=None):
+    """Process the OSM file in byte ranges across a pool of worker
+    processes and write the same csv(s) as process_map (to paths,
+    by default database_prep.OUTPUT_PATHS)"""
+
+    part_dir = tempfile.mkdtemp(prefix='osm_parts_', dir='.')
+    try:
+        jobs = [(file_in, start, end, part_dir, index, validate, validate_every)
+                for index, (start, end) in enumerate(find_chunks(file_in, chunk_size))]
+        run_jobs(jobs, processes)
+        merge_parts(part_dir, len(jobs), paths)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def process_shards(shards, validate, processes=None, validate_every=1, paths=None):
+    """Process pre-split OSM files (in the given order) across a pool
+    of worker processes and write the csv(s) as one output"""
+
+    part_dir = tempfile.mkdtemp(prefix='osm_parts_', dir='.')
+    try:
+        jobs = [(shard, None, None, part_dir, index, validate, validate_every)
+                for index, shard in enumerate(shards)]
+        run_jobs(jobs, processes)
+        merge_parts(part_dir, len(jobs), paths)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def test():
+    """Check that the csv files written from byte ranges, and from
+    shards, are the same as the ones written by process_map"""
+
+    import gzip
+
+    import benchmark
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        benchmark.generate_osm(osm_path, 20000, n_relations=2000)
+
+        def paths(name):
+            out_dir = os.path.join(tmp_dir, name)
+            os.mkdir(out_dir)
+            return dict((key, os.path.join(out_dir, os.path.basename(path)))
+                        for key, path in database_prep.OUTPUT_PATHS.items())
+
+        def check(out):
+            for name, _ in database_prep.OUTPUT_FIELDS:
+                with open(expected[name], 'rb') as f:
+                    with open(out[name], 'rb') as g:
+                        assert f.read() == g.read(), name
+
+        expected = paths('process_map')
+        database_prep.process_map(osm_path, True, paths=expected)
+
+        # Small ranges, so that ranges start at nodes, ways and relations
+        chunk_size = os.path.getsize(osm_path) // 37
+        chunks = find_chunks(osm_path, chunk_size)
+        with open(osm_path, 'rb') as osm_file:
+            first_tags = set()
+            for start, _ in chunks:
+                osm_file.seek(start)
+                first_tags.add(osm_file.read(4))
+        assert first_tags == {'<nod', '<way', '<rel'}, first_tags
+        out = paths('parallel')
+        process_map_parallel(osm_path, True, processes=3, chunk_size=chunk_size, paths=out)
+        check(out)
+
+        # The same ranges as complete files, some of them compressed
+        shards = []
+        with open(osm_path, 'rb') as osm_file:
+            for index, (start, end) in enumerate(chunks):
+                osm_file.seek(start)
+                shard = os.path.join(tmp_dir, 'shard%02d.osm' % index)
+                opener = open
+                if index % 2:
+                    shard += '.gz'
+                    opener = gzip.open
+                with opener(shard, 'wb') as f:
+                    f.write('<osm>' + osm_file.read(end - start) + OSM_END)
+                shards.append(shard)
+        out = paths('shards')
+        process_shards(shards, True, processes=3, paths=out)
+        check(out)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    process_map_parallel(database_prep.OSM_PATH, validate=False)
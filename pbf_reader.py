@@ -0,0 +1,605 @@
+# Reader for OSM PBF files (.osm.pbf), which are about a tenth of the
+# size of the XML and much cheaper to parse.
+# The file is a series of zlib-compressed protobuf blobs. Each blob
+# is decoded (string table, dense nodes with delta-coded ids and
+# coordinates, ways and relations) into the same node, way and
+# relation structure that get_element yields for the XML, so
+# shape_element and the audits work on either.
+# Blobs are decoded in a pool of worker processes, in order.
+# The protobuf messages are decoded directly, so no protobuf
+# library is needed.
+
+import collections
+import multiprocessing
+import struct
+import time
+import zlib
+
+# Element types of relation members, by their number in the file
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+# Features of the PBF format this reader understands
+SUPPORTED_FEATURES = {'OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'}
+
+# Number of blobs being decoded ahead of the one being read, per worker
+BLOBS_AHEAD = 4
+
+# Attributes of the elements of files written without some or all of
+# their metadata (anonymized extracts, osmium --no-details), so they
+# can be shaped like the others
+MISSING_INFO = {'version': '0', 'timestamp': '1970-01-01T00:00:00Z', 'changeset': '0',
+                'uid': '0', 'user': ''}
+
+
+# ================================================== #
+#               Protobuf decoding                    #
+# ================================================== #
+def read_varint(buf, pos):
+    """Return the varint at pos in a bytearray, and the position after it"""
+
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(buf):
+    """Yield (field number, value) for each field of a message.
+    Length-delimited values are returned as bytearrays"""
+
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+def read_packed(buf):
+    """Return the varints of a packed repeated field"""
+
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        b = buf[pos]
+        # Most deltas fit in a single byte
+        if b < 0x80:
+            append(b)
+            pos += 1
+        else:
+            value, pos = read_varint(buf, pos)
+            append(value)
+    return values
+
+
+def signed(value):
+    """Two's complement value of an int32/int64 varint"""
+
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def zigzag(value):
+    """Value of a sint32/sint64 varint"""
+
+    return (value >> 1) ^ -(value & 1)
+
+
+def undelta(values):
+    """Running sums of delta-coded values"""
+
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+
+def dense_info(info, field, count):
+    """Delta-coded values of one array of a DenseInfo, or None
+    for each node if the block doesn't have it"""
+
+    if field not in info:
+        return [None] * count
+    return undelta([zigzag(v) for v in info[field]])
+
+
+def decode_string(raw):
+    """Turn a string table entry into a str, or a unicode string if
+    it is not ASCII, the way ElementTree returns attribute values"""
+
+    s = bytes(raw)
+    try:
+        s.decode('ascii')
+    except UnicodeDecodeError:
+        return s.decode('utf-8')
+    return s
+
+
+# ================================================== #
+#               OSM blocks                           #
+# ================================================== #
+class Block(object):
+    """Settings of one PrimitiveBlock, used to decode its elements"""
+
+    def __init__(self, strings, granularity, lat_offset, lon_offset, date_granularity):
+        self.strings = strings
+        self.granularity = granularity
+        self.lat_offset = lat_offset
+        self.lon_offset = lon_offset
+        self.date_granularity = date_granularity
+
+    def coordinate(self, offset, value):
+        """Format a coordinate the way it is written in the XML,
+        with 7 decimal places"""
+
+        units = (offset + self.granularity * value) // 100
+        sign = '-' if units < 0 else ''
+        units = abs(units)
+        return '%s%d.%07d' % (sign, units // 10 ** 7, units % 10 ** 7)
+
+    def timestamp(self, value):
+        seconds = value * self.date_granularity // 1000
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+    def info(self, attrib, version=None, timestamp=None, changeset=None, uid=None,
+             user_sid=None):
+        """Set the metadata attributes of an element, with the
+        values of MISSING_INFO for those the file leaves out (None)"""
+
+        attrib.update(MISSING_INFO)
+        if version is not None:
+            attrib['version'] = str(version)
+        if timestamp is not None:
+            attrib['timestamp'] = self.timestamp(timestamp)
+        if changeset is not None:
+            attrib['changeset'] = str(changeset)
+        if uid is not None:
+            attrib['uid'] = str(uid)
+        if user_sid is not None:
+            attrib['user'] = self.strings[user_sid]
+
+    def decode_info(self, buf, attrib):
+        """Set the metadata of an element from its Info message,
+        or None if it has none"""
+
+        values = {}
+        if buf is not None:
+            for field, value in iter_fields(buf):
+                values[field] = value
+        # Each field may be left out on its own
+        for field in (1, 2, 3, 4):
+            if field in values:
+                values[field] = signed(values[field])
+        self.info(attrib, values.get(1), values.get(2), values.get(3), values.get(4),
+                  values.get(5))
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def decode_dense(self, buf, wanted):
+        ids = lats = lons = keys_vals = ()
+        info = {}
+        for field, value in iter_fields(buf):
+            if field == 1:
+                ids = undelta([zigzag(v) for v in read_packed(value)])
+            elif field == 5:
+                for info_field, info_value in iter_fields(value):
+                    info[info_field] = read_packed(info_value)
+            elif field == 8:
+                lats = undelta([zigzag(v) for v in read_packed(value)])
+            elif field == 9:
+                lons = undelta([zigzag(v) for v in read_packed(value)])
+            elif field == 10:
+                keys_vals = read_packed(value)
+        if 'node' not in wanted:
+            return []
+
+        # The DenseInfo, or any of its arrays, may be left out
+        # (e.g. the uids and users of an anonymized extract)
+        if 1 in info:
+            versions = [signed(version) for version in info[1]]
+        else:
+            versions = [None] * len(ids)
+        timestamps = dense_info(info, 2, len(ids))
+        changesets = dense_info(info, 3, len(ids))
+        uids = dense_info(info, 4, len(ids))
+        user_sids = dense_info(info, 5, len(ids))
+
+        elements = []
+        strings = self.strings
+        kv = 0
+        for i, node_id in enumerate(ids):
+            attrib = {'id': str(node_id),
+                      'lat': self.coordinate(self.lat_offset, lats[i]),
+                      'lon': self.coordinate(self.lon_offset, lons[i])}
+            self.info(attrib, versions[i], timestamps[i], changesets[i], uids[i],
+                      user_sids[i])
+            # keys_vals holds key, value pairs for each node in turn,
+            # each node's ended by a 0
+            tags = []
+            if keys_vals:
+                while keys_vals[kv] != 0:
+                    tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                    kv += 2
+                kv += 1
+            elements.append(('node', attrib, tags, None, None))
+        return elements
+
+    def decode_node(self, buf):
+        attrib = {}
+        keys = vals = ()
+        info = None
+        lat = lon = 0
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib['id'] = str(zigzag(value))
+            elif field == 2:
+                keys = read_packed(value)
+            elif field == 3:
+                vals = read_packed(value)
+            elif field == 4:
+                info = value
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        self.decode_info(info, attrib)
+        attrib['lat'] = self.coordinate(self.lat_offset, lat)
+        attrib['lon'] = self.coordinate(self.lon_offset, lon)
+        return ('node', attrib, self.tags(keys, vals), None, None)
+
+    def decode_way(self, buf):
+        attrib = {}
+        keys = vals = refs = ()
+        info = None
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib['id'] = str(signed(value))
+            elif field == 2:
+                keys = read_packed(value)
+            elif field == 3:
+                vals = read_packed(value)
+            elif field == 4:
+                info = value
+            elif field == 8:
+                refs = undelta([zigzag(v) for v in read_packed(value)])
+        self.decode_info(info, attrib)
+        return ('way', attrib, self.tags(keys, vals), refs, None)
+
+    def decode_relation(self, buf):
+        attrib = {}
+        keys = vals = roles = member_ids = types = ()
+        info = None
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib['id'] = str(signed(value))
+            elif field == 2:
+                keys = read_packed(value)
+            elif field == 3:
+                vals = read_packed(value)
+            elif field == 4:
+                info = value
+            elif field == 8:
+                roles = read_packed(value)
+            elif field == 9:
+                member_ids = undelta([zigzag(v) for v in read_packed(value)])
+            elif field == 10:
+                types = read_packed(value)
+        self.decode_info(info, attrib)
+        members = [(MEMBER_TYPES[t], ref, self.strings[role])
+                   for t, ref, role in zip(types, member_ids, roles)]
+        return ('relation', attrib, self.tags(keys, vals), None, members)
+
+    def decode_group(self, buf, wanted):
+        elements = []
+        for field, value in iter_fields(buf):
+            if field == 1 and 'node' in wanted:
+                elements.append(self.decode_node(value))
+            elif field == 2:
+                elements.extend(self.decode_dense(value, wanted))
+            elif field == 3 and 'way' in wanted:
+                elements.append(self.decode_way(value))
+            elif field == 4 and 'relation' in wanted:
+                elements.append(self.decode_relation(value))
+        return elements
+
+
+def decode_primitive_block(buf, wanted):
+    """Return the elements of a PrimitiveBlock as
+    (tag, attrib, tags, node refs, members) tuples"""
+
+    groups = []
+    strings = []
+    settings = {17: 100, 18: 1000, 19: 0, 20: 0}
+    for field, value in iter_fields(buf):
+        if field == 1:
+            strings = [decode_string(s) for f, s in iter_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field in settings:
+            settings[field] = signed(value)
+    block = Block(strings, settings[17], settings[19], settings[20], settings[18])
+    elements = []
+    for group in groups:
+        elements.extend(block.decode_group(group, wanted))
+    return elements
+
+
+def blob_data(buf):
+    """Return the uncompressed data of a Blob"""
+
+    for field, value in iter_fields(buf):
+        if field == 1:
+            return bytes(value)
+        elif field == 3:
+            return zlib.decompress(bytes(value))
+        elif field in (4, 5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression (field %d)" % field)
+    return b''
+
+
+def decode_blob(args):
+    """Decode one blob of the file (run in the worker processes)"""
+
+    blob_type, raw, wanted = args
+    data = bytearray(blob_data(bytearray(raw)))
+    if blob_type == 'OSMHeader':
+        required = [bytes(value) for field, value in iter_fields(data) if field == 4]
+        unsupported = set(required) - SUPPORTED_FEATURES
+        if unsupported:
+            raise ValueError("Unsupported PBF features: %s" % ', '.join(sorted(unsupported)))
+        return []
+    elif blob_type == 'OSMData':
+        return decode_primitive_block(data, wanted)
+    return []
+
+
+def read_blobs(pbf_path):
+    """Yield (type, raw blob) for each blob of the file"""
+
+    with open(pbf_path, 'rb') as f:
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                return
+            size, = struct.unpack('>I', head)
+            blob_type = None
+            datasize = 0
+            for field, value in iter_fields(bytearray(f.read(size))):
+                if field == 1:
+                    blob_type = bytes(value)
+                elif field == 3:
+                    datasize = value
+            yield blob_type, f.read(datasize)
+
+
+# ================================================== #
+#               Elements                             #
+# ================================================== #
+class PbfChild(object):
+    """A <tag>, <nd> or <member> of a PbfElement"""
+
+    __slots__ = ('tag', 'attrib')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+
+class PbfElement(object):
+    """Node, way or relation read from a PBF file, with the parts of
+    the ElementTree element interface that shape_element and the
+    audits use (tag, attrib, iteration over the children, iter,
+    findall, clear)"""
+
+    __slots__ = ('tag', 'attrib', 'tags', 'refs', 'members')
+
+    def __init__(self, tag, attrib, tags, refs, members):
+        self.tag = tag
+        self.attrib = attrib
+        self.tags = tags
+        self.refs = refs
+        self.members = members
+
+    def iter(self, tag=None):
+        if tag == 'tag':
+            for k, v in self.tags:
+                yield PbfChild('tag', {'k': k, 'v': v})
+        elif tag == 'nd':
+            for ref in self.refs or ():
+                yield PbfChild('nd', {'ref': str(ref)})
+        elif tag == 'member':
+            for member_type, ref, role in self.members or ():
+                yield PbfChild('member', {'type': member_type, 'ref': str(ref), 'role': role})
+        elif tag is None:
+            raise ValueError("PbfElement.iter needs a child tag")
+
+    def __iter__(self):
+        # The children in the order of the XML
+        for tag in ('tag', 'nd', 'member'):
+            for child in self.iter(tag):
+                yield child
+
+    def findall(self, tag):
+        return list(self.iter(tag))
+
+    def clear(self):
+        pass
+
+
+def iter_decoded(pbf_path, wanted, processes=None):
+    """Yield the decoded element tuples of each blob in file order,
+    with the blobs decoded in a pool of worker processes"""
+
+    jobs = ((blob_type, raw, wanted) for blob_type, raw in read_blobs(pbf_path))
+    if processes == 0 or processes == 1:
+        for job in jobs:
+            yield decode_blob(job)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Only a few blobs per worker are read ahead, so memory use
+        # does not grow with the size of the file
+        ahead = BLOBS_AHEAD * (processes or multiprocessing.cpu_count())
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.apply_async(decode_blob, (job,)))
+            if len(pending) >= ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def iter_elements(pbf_path, tags=('node', 'way', 'relation'), processes=None):
+    """Yield each node, way and relation of the PBF file with one of the
+    given tags, in the same form as get_element"""
+
+    wanted = frozenset(tags)
+    for elements in iter_decoded(pbf_path, wanted, processes):
+        for element in elements:
+            if element[0] in wanted:
+                yield PbfElement(*element)
+
+
+def benchmark(xml_path, pbf_path, processes=None):
+    """Time shaping every element of the same extract read from the
+    XML file and from the PBF file"""
+
+    import database_prep
+
+    results = {}
+    for label, elements in [('xml', lambda: database_prep.get_element(xml_path)),
+                            ('pbf', lambda: iter_elements(pbf_path, processes=processes))]:
+        start = time.time()
+        count = 0
+        for element in elements():
+            database_prep.shape_element(element, as_tuples=True)
+            count += 1
+        results[label] = (count, time.time() - start)
+    return results
+
+
+def test_missing_info():
+    """Decode and shape elements written without some or all of their
+    metadata: dense nodes with no uids or users, or no DenseInfo at
+    all, and a way whose Info has no version"""
+
+    import database_prep
+
+    def varint(value):
+        out = bytearray()
+        while value > 0x7f:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+        return out
+
+    def field(number, value):
+        return varint(number << 3) + varint(value)
+
+    def message(number, payload):
+        return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+    def packed(number, values, delta=True):
+        if delta:
+            # Delta and zigzag coded, as most of the dense arrays are
+            values = [value - previous for value, previous in zip(values, [0] + values)]
+            values = [v << 1 if v >= 0 else (-v << 1) - 1 for v in values]
+        return message(number, bytearray().join(varint(value) for value in values))
+
+    coordinates = (packed(8, [455000000, 455000001])
+                   + packed(9, [-1226000000, -1226000001]))
+    # Versions, timestamps and changesets, and no uids or user names
+    dense_info = (packed(1, [3, 4], delta=False) + packed(2, [1451606400, 1451606460])
+                  + packed(3, [7, 9]))
+    block = Block(['', 'highway', 'residential', 'mapper'], 100, 0, 0, 1000)
+    nodes = block.decode_dense(packed(1, [10, 11]) + message(5, dense_info) + coordinates,
+                               ('node',))
+    assert [attrib for _, attrib, _, _, _ in nodes] == [
+        {'id': '10', 'lat': '45.5000000', 'lon': '-122.6000000', 'version': '3',
+         'timestamp': '2016-01-01T00:00:00Z', 'changeset': '7', 'uid': '0', 'user': ''},
+        {'id': '11', 'lat': '45.5000001', 'lon': '-122.6000001', 'version': '4',
+         'timestamp': '2016-01-01T00:01:00Z', 'changeset': '9', 'uid': '0', 'user': ''}], nodes
+    bare_nodes = block.decode_dense(packed(1, [12, 13]) + coordinates, ('node',))
+    assert bare_nodes[1][1] == dict(MISSING_INFO, id='13', lat='45.5000001',
+                                    lon='-122.6000001'), bare_nodes
+    # A timestamp, uid and user, and no version or changeset
+    way = block.decode_way(field(1, 20) + packed(2, [1], delta=False)
+                           + packed(3, [2], delta=False)
+                           + message(4, field(2, 1451606400) + field(4, 42) + field(5, 3))
+                           + packed(8, [10, 11]))
+    assert way[1] == {'id': '20', 'version': '0', 'timestamp': '2016-01-01T00:00:00Z',
+                      'changeset': '0', 'uid': '42', 'user': 'mapper'}, way
+
+    for element in nodes + bare_nodes + [way]:
+        element = PbfElement(*element)
+        el = database_prep.shape_element(element)
+        assert database_prep.element_as_dicts(
+            database_prep.shape_element_tuples(element)) == el, el
+
+
+def test(xml_path, pbf_path, processes=None):
+    """Check that the PBF file shapes to the same rows as the XML file,
+    and compare how long each takes"""
+
+    import itertools
+    import database_prep
+
+    test_missing_info()
+
+    def shaped(element):
+        el = database_prep.shape_element(element, as_tuples=True)
+        # The XML may write coordinates with fewer decimal places,
+        # so they are compared as numbers
+        if 'node' in el:
+            node = list(el['node'])
+            node[1:3] = float(node[1]), float(node[2])
+            el['node'] = tuple(node)
+        return el
+
+    xml_elements = database_prep.get_element(xml_path)
+    pbf_elements = iter_elements(pbf_path, processes=processes)
+    for xml_element, pbf_element in itertools.izip_longest(xml_elements, pbf_elements):
+        assert xml_element is not None and pbf_element is not None
+        xml_shaped = shaped(xml_element)
+        pbf_shaped = shaped(pbf_element)
+        assert xml_shaped == pbf_shaped, (xml_shaped, pbf_shaped)
+
+    for label, (count, seconds) in sorted(benchmark(xml_path, pbf_path, processes).items()):
+        print "%s: %d elements in %.2f s (%.0f elements/sec)" % (
+            label, count, seconds, count / seconds if seconds else 0)
+
+
+if __name__ == '__main__':
+    import sys
+    test(sys.argv[1], sys.argv[2])
@@ -0,0 +1,337 @@
+# Pipelined version of the loop in write_elements (database_prep.py),
+# used by process_map(..., pipeline=True).
+# Parsing, shaping and writing run in their own threads, connected by
+# bounded queues: a reader thread pulls elements from get_element in
+# batches, a shaper thread shapes (and validates) them and splits the
+# rows by table, and a writer thread per table (one for all of them
+# when the output can't be written from several threads, as with
+# SQLite) writes them out. When a queue is full the stage feeding it
+# waits, so memory use is bounded by the queue sizes.
+# There is a single shaper: the GIL keeps Python code from running in
+# several threads at once, and the cleaning caches are not thread
+# safe (parallel_prep.py spreads shaping over processes instead).
+# Each table's rows go through one queue and one writer in order, so
+# the output is the same as that of the sequential loop.
+# The time each stage spends working, waiting for input and waiting
+# for room downstream, and the depth of each queue, are recorded to
+# show which stage is the bottleneck.
+
+import Queue
+import sys
+import threading
+import time
+
+import database_prep
+import fast_validation
+
+# Batches each queue holds
+QUEUE_SIZE = 16
+
+# Elements passed from the reader to the shaper at a time
+BATCH_SIZE = 500
+
+# How often a blocked stage checks whether another one failed
+POLL_SECONDS = 0.1
+
+# The keys of a shaped element that hold a single row
+SINGLE_ROW_KEYS = ('node', 'way', 'relation')
+
+
+class PipelineAborted(Exception):
+    """Raised in a stage when another stage has failed"""
+
+
+class Stage(object):
+    """Time spent by one stage working, waiting for input and
+    waiting for room in the next queue"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.start = None
+        self.end = None
+
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    def busy(self):
+        return self.elapsed() - self.wait_in - self.wait_out
+
+    def report(self):
+        return {'items': self.items, 'seconds': self.elapsed(), 'busy_seconds': self.busy(),
+                'wait_input_seconds': self.wait_in, 'wait_output_seconds': self.wait_out}
+
+
+class BoundedQueue(object):
+    """Queue.Queue with its depth sampled on every put"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.queue = Queue.Queue(size)
+        self.puts = 0
+        self.depth_total = 0
+        self.max_depth = 0
+
+    def sample(self):
+        depth = self.queue.qsize()
+        self.puts += 1
+        self.depth_total += depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def report(self):
+        return {'size': self.size, 'max_depth': self.max_depth,
+                'mean_depth': self.depth_total / float(self.puts) if self.puts else 0.0}
+
+
+class Pipeline(object):
+    """Runs the shaping and writing of process_map in threaded
+    stages, and keeps the statistics of the run"""
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stages = []
+        self.queues = []
+        self.failed = threading.Event()
+        self.error = None
+
+    def new_queue(self, name):
+        queue = BoundedQueue(name, self.queue_size)
+        self.queues.append(queue)
+        return queue
+
+    def put(self, stage, queue, item):
+        start = time.time()
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                queue.queue.put(item, timeout=POLL_SECONDS)
+                break
+            except Queue.Full:
+                pass
+        stage.wait_out += time.time() - start
+        queue.sample()
+
+    def get(self, stage, queue):
+        start = time.time()
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                item = queue.queue.get(timeout=POLL_SECONDS)
+                break
+            except Queue.Empty:
+                pass
+        stage.wait_in += time.time() - start
+        return item
+
+    def start_stage(self, name, target, *args):
+        stage = Stage(name)
+        self.stages.append(stage)
+
+        def run():
+            stage.start = time.time()
+            try:
+                target(stage, *args)
+            except PipelineAborted:
+                pass
+            except BaseException:
+                if not self.failed.is_set():
+                    self.error = sys.exc_info()
+                    self.failed.set()
+            finally:
+                stage.end = time.time()
+
+        thread = threading.Thread(target=run, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def read(self, stage, elements, out):
+        batch = []
+        for element in elements:
+            batch.append(element)
+            if len(batch) >= self.batch_size:
+                stage.items += len(batch)
+                self.put(stage, out, batch)
+                batch = []
+                # Stop parsing if a later stage failed
+                if self.failed.is_set():
+                    raise PipelineAborted()
+        stage.items += len(batch)
+        if batch:
+            self.put(stage, out, batch)
+        self.put(stage, out, None)
+
+    def shape(self, stage, elements, table_queues, as_tuples, validate, validate_every,
+              validator, geometry, shaper):
+        shape_for_output = database_prep.shape_for_output
+        compact = shaper is not None
+        element_schema = database_prep.output_schema(compact)
+        i = 0
+        while True:
+            batch = self.get(stage, elements)
+            if batch is None:
+                break
+            tables = {}
+            for element in batch:
+                el = shape_for_output(element, as_tuples, geometry, shaper)
+                if el:
+                    if validate is True and i % validate_every == 0:
+                        database_prep.validate_element(
+                            database_prep.element_as_dicts(el, compact) if as_tuples else el,
+                            validator, element_schema)
+                    for name, rows in el.iteritems():
+                        if name in SINGLE_ROW_KEYS:
+                            tables.setdefault(name, []).append(rows)
+                        elif rows:
+                            tables.setdefault(name, []).extend(rows)
+                i += 1
+            stage.items += len(batch)
+            for name, rows in tables.iteritems():
+                queue = table_queues[name]
+                self.put(stage, queue, (name, rows))
+        for queue in set(table_queues.values()):
+            self.put(stage, queue, None)
+
+    def write(self, stage, queue, output):
+        while True:
+            item = self.get(stage, queue)
+            if item is None:
+                break
+            name, rows = item
+            output.add_rows(name, rows)
+            stage.items += len(rows)
+
+    def run(self, elements, output, validate, validate_every=1, validator=None,
+            geometry=None, shaper=None):
+        """Shape, validate and write the elements, as write_elements does"""
+
+        if validator is None:
+            validator = fast_validation.CompiledValidator(
+                database_prep.output_schema(shaper is not None))
+        as_tuples = getattr(output, 'row_format', 'dict') == 'tuple'
+        names = [name for name, _ in
+                 getattr(output, 'output_fields', database_prep.OUTPUT_FIELDS)]
+
+        element_queue = self.new_queue('elements')
+        if getattr(output, 'tables_independent', False):
+            table_queues = dict((name, self.new_queue(name)) for name in names)
+        else:
+            rows_queue = self.new_queue('rows')
+            table_queues = dict((name, rows_queue) for name in names)
+
+        threads = [self.start_stage('read', self.read, elements, element_queue),
+                   self.start_stage('shape', self.shape, element_queue, table_queues, as_tuples,
+                                    validate, validate_every, validator, geometry, shaper)]
+        for queue in self.queues[1:]:
+            threads.append(self.start_stage('write ' + queue.name, self.write, queue, output))
+        for thread in threads:
+            # join with a timeout so that KeyboardInterrupt gets through
+            while thread.is_alive():
+                thread.join(1)
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def bottleneck(self):
+        """Name of the stage that spent the most time working"""
+
+        return max(self.stages, key=lambda stage: stage.busy()).name
+
+    def report(self):
+        return {'stages': dict((stage.name, stage.report()) for stage in self.stages),
+                'queues': dict((queue.name, queue.report()) for queue in self.queues),
+                'bottleneck': self.bottleneck()}
+
+    def report_lines(self):
+        lines = []
+        for stage in self.stages:
+            lines.append("%-24s %9d items  busy %6.2f s  waiting for input %6.2f s, "
+                         "for output %6.2f s" % (stage.name, stage.items, stage.busy(),
+                                                 stage.wait_in, stage.wait_out))
+        for queue in self.queues:
+            report = queue.report()
+            lines.append("queue %-18s depth max %2d, mean %5.1f of %d" % (
+                queue.name, report['max_depth'], report['mean_depth'], report['size']))
+        lines.append("bottleneck: %s" % self.bottleneck())
+        return lines
+
+
+def test():
+    """Check that the pipelined csv and SQLite outputs are the same
+    as the sequential ones, and that an error in a stage stops the run"""
+
+    import os
+    import shutil
+    import sqlite3
+    import tempfile
+
+    import benchmark
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        benchmark.generate_osm(osm_path, 50000)
+
+        def paths(name):
+            out_dir = os.path.join(tmp_dir, name)
+            os.mkdir(out_dir)
+            return dict((key, os.path.join(out_dir, os.path.basename(path)))
+                        for key, path in database_prep.OUTPUT_PATHS.items())
+
+        sequential = paths('sequential')
+        pipelined = paths('pipelined')
+        start = time.time()
+        database_prep.process_map(osm_path, True, paths=sequential, geometry=True)
+        sequential_seconds = time.time() - start
+        pipeline = Pipeline()
+        start = time.time()
+        database_prep.process_map(osm_path, True, paths=pipelined, geometry=True,
+                                  pipeline=pipeline)
+        pipelined_seconds = time.time() - start
+        for name, _ in database_prep.output_fields(geometry=True):
+            with open(sequential[name], 'rb') as f:
+                expected = f.read()
+            with open(pipelined[name], 'rb') as f:
+                assert f.read() == expected, name
+        print "\n".join(pipeline.report_lines())
+        print "sequential %.2f s, pipelined %.2f s" % (sequential_seconds, pipelined_seconds)
+
+        dumps = []
+        for name, use_pipeline in (('sequential.db', False), ('pipelined.db', True)):
+            db_path = os.path.join(tmp_dir, name)
+            database_prep.process_map(osm_path, False, output='sqlite', db_path=db_path,
+                                      pipeline=use_pipeline)
+            conn = sqlite3.connect(db_path)
+            dumps.append(list(conn.iterdump()))
+            conn.close()
+        assert dumps[0] == dumps[1]
+
+        class FailingOutput(database_prep.CsvOutput):
+            def add_rows(self, name, rows):
+                if name == 'way':
+                    raise IOError("disk full")
+                database_prep.CsvOutput.add_rows(self, name, rows)
+
+        output = FailingOutput(paths('failing'))
+        try:
+            with output:
+                Pipeline().run(database_prep.get_element(osm_path), output, False)
+        except IOError as e:
+            assert str(e) == "disk full"
+        else:
+            raise AssertionError("the error in the writer was not raised")
+        print "outputs are identical"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,226 @@
+# Instrumentation for process_map in database_prep.py, to find out
+# where a slow run spends its time.
+# A PipelineStats given to process_map(..., stats=...) records the
+# elements per second, the time spent parsing (iterparse), shaping
+# (shape_element and the cleaning functions), validating and writing,
+# the number of tags with each key and the peak memory, logs progress
+# every log_every elements and can write a JSON report at the end.
+# Every profile_every-th element can also be run under cProfile, or
+# the whole run sampled with a signal-based profiler.
+# Without a PipelineStats, write_elements does none of this work.
+
+import collections
+import cProfile
+import json
+import pstats
+import signal
+import sys
+import time
+
+import osm_stream
+
+STAGES = ('parse', 'shape', 'validate', 'write')
+
+# Interval of the sampling profiler, in seconds
+SAMPLE_INTERVAL = 0.005
+
+
+class SamplingProfiler(object):
+    """Counts the function running every interval seconds of CPU
+    time, using SIGPROF. Much cheaper than cProfile, at the cost of
+    only seeing where time goes rather than exact call counts"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def handle(self, signum, frame):
+        if frame is not None:
+            code = frame.f_code
+            self.samples['%s:%d(%s)' % (code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.handle)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def top(self, n=20):
+        total = sum(self.samples.values()) or 1
+        return [{'location': location, 'samples': count, 'share': count / float(total)}
+                for location, count in self.samples.most_common(n)]
+
+
+class PipelineStats(object):
+    """Counts and timings of one process_map run"""
+
+    def __init__(self, log_every=100000, log=None, report_path=None,
+                 profile=None, profile_every=100, profile_path=None, top_keys=50):
+        # profile is None, 'cprofile' (every profile_every-th element)
+        # or 'sample' (the whole run)
+        if profile not in (None, 'cprofile', 'sample'):
+            raise ValueError("Unknown profiler: %r" % (profile,))
+        self.log_every = log_every
+        self.log = log or (lambda line: sys.stderr.write(line + '\n'))
+        self.report_path = report_path
+        self.profile = profile
+        self.profile_every = profile_every
+        self.profile_path = profile_path
+        self.top_keys = top_keys
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.elements = collections.Counter()
+        self.tag_keys = collections.Counter()
+        self.count = 0
+        self.start_time = None
+        self.end_time = None
+        self.profiler = None
+        self.sampler = None
+
+    def start(self):
+        self.start_time = time.time()
+        if self.profile == 'cprofile':
+            self.profiler = cProfile.Profile()
+        elif self.profile == 'sample':
+            self.sampler = SamplingProfiler()
+            self.sampler.start()
+
+    def finish(self):
+        self.end_time = time.time()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.profiler is not None and self.profile_path:
+            self.profiler.dump_stats(self.profile_path)
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def timed(self, elements):
+        """Yield the elements, adding the time taken to
+        produce each one to the parse stage"""
+
+        seconds = self.seconds
+        timer = time.time
+        iterator = iter(elements)
+        while True:
+            start = timer()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                seconds['parse'] += timer() - start
+                return
+            seconds['parse'] += timer() - start
+            yield element
+
+    def profiling(self):
+        """Whether the next element should be run under cProfile"""
+
+        return self.profiler is not None and self.count % self.profile_every == 0
+
+    def element_done(self, element, shape_seconds, validate_seconds, write_seconds):
+        seconds = self.seconds
+        seconds['shape'] += shape_seconds
+        seconds['validate'] += validate_seconds
+        seconds['write'] += write_seconds
+        self.elements[element.tag] += 1
+        tag_keys = self.tag_keys
+        for tag in element.iter('tag'):
+            tag_keys[tag.attrib['k']] += 1
+        self.count += 1
+        if self.log_every and self.count % self.log_every == 0:
+            self.log(self.progress_line())
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.count / elapsed if elapsed else 0.0
+
+    def progress_line(self):
+        return "%d elements, %.0f elements/sec, %s, peak memory %d MB" % (
+            self.count, self.rate(),
+            ", ".join("%s %.1f s" % (stage, self.seconds[stage]) for stage in STAGES),
+            osm_stream.peak_memory_kb() / 1024)
+
+    def report(self):
+        """Everything recorded, as a dict that can be written as JSON"""
+
+        elapsed = self.elapsed()
+        report = {'elements': self.count,
+                  'elements_by_type': dict(self.elements),
+                  'seconds': elapsed,
+                  'elements_per_second': self.rate(),
+                  'stage_seconds': dict(self.seconds),
+                  'other_seconds': elapsed - sum(self.seconds.values()),
+                  'peak_memory_kb': osm_stream.peak_memory_kb(),
+                  'tag_keys': dict(self.tag_keys.most_common(self.top_keys)),
+                  'distinct_tag_keys': len(self.tag_keys)}
+        if self.profiler is not None:
+            report['profile'] = profile_summary(self.profiler)
+        if self.sampler is not None:
+            report['samples'] = self.sampler.top()
+        return report
+
+
+def profile_summary(profiler, n=20):
+    """The functions with the most cumulative time in a cProfile run"""
+
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({'function': '%s:%d(%s)' % (filename, line, name), 'calls': calls,
+                     'total_seconds': total, 'cumulative_seconds': cumulative})
+    rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+    return rows[:n]
+
+
+def test(n_nodes=100000):
+    """Run process_map with and without stats on a sample file,
+    check the report, and compare the run times"""
+
+    import os
+    import shutil
+    import tempfile
+
+    import database_prep
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        osm_stream.write_sample_file(osm_path, n_nodes)
+        paths = dict((key, os.path.join(tmp_dir, os.path.basename(path)))
+                     for key, path in database_prep.OUTPUT_PATHS.items())
+
+        start = time.time()
+        database_prep.process_map(osm_path, True, paths=paths)
+        plain = time.time() - start
+
+        lines = []
+        report_path = os.path.join(tmp_dir, 'report.json')
+        stats = PipelineStats(log_every=25000, log=lines.append, report_path=report_path)
+        start = time.time()
+        database_prep.process_map(osm_path, True, paths=paths, stats=stats)
+        timed = time.time() - start
+        with open(report_path) as f:
+            report = json.load(f)
+        assert report['elements'] == n_nodes + n_nodes / 10
+        assert report['tag_keys'] == {'addr:street': n_nodes, 'addr:postcode': n_nodes,
+                                      'addr:state': n_nodes / 10}
+        assert len(lines) == report['elements'] // 25000
+        print "\n".join(lines)
+        print "without stats %.2f s, with stats %.2f s" % (plain, timed)
+
+        for profile in ('cprofile', 'sample'):
+            stats = PipelineStats(log_every=0, profile=profile)
+            database_prep.process_map(osm_path, False, paths=paths, stats=stats)
+            top = stats.report()['profile' if profile == 'cprofile' else 'samples']
+            assert top
+            print "%s: %s" % (profile, top[0].get('function') or top[0].get('location'))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
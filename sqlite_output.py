@@ -0,0 +1,206 @@
+# Loads shaped elements straight into the SQLite database instead of
+# writing the csv files and importing them by hand.
+# Rows are buffered per table and inserted with executemany, all
+# inside one transaction, with the PRAGMAs set for a bulk load.
+# Indexes are only built once all of the rows are in, along with an
+# R-tree over the nodes with spatial_index=True, and the covering
+# indexes and summary tables of summary_tables.py with summaries=True.
+# Used by process_map in database_prep.py with output='sqlite'
+
+import sqlite3
+import time
+
+import database_prep
+import schema
+import summary_tables
+
+DB_PATH = "Portland.db"
+
+# Number of rows buffered per table before they are inserted
+BATCH_SIZE = 10000
+
+# Table each key of a shaped element is loaded into
+TABLE_NAMES = {'node': 'nodes',
+               'node_tags': 'nodes_tags',
+               'way': 'ways',
+               'way_nodes': 'ways_nodes',
+               'way_tags': 'ways_tags',
+               'relation': 'relations',
+               'relation_tags': 'relations_tags',
+               'relation_members': 'relations_members',
+               'way_geometry': 'ways_geometry',
+               'user': 'users'}
+
+# SQLite column types for the types used in schema.py
+COLUMN_TYPES = {'integer': 'INTEGER', 'float': 'REAL', 'string': 'TEXT'}
+
+# Settings used while loading; the journal and syncing are turned
+# back on once the load is done
+LOAD_PRAGMAS = ["PRAGMA journal_mode = OFF",
+                "PRAGMA synchronous = OFF",
+                "PRAGMA cache_size = -200000",
+                "PRAGMA temp_store = MEMORY"]
+FINISH_PRAGMAS = ["PRAGMA journal_mode = DELETE",
+                  "PRAGMA synchronous = FULL"]
+
+INDEXES = ["CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id)",
+           "CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id)",
+           "CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id, position)",
+           "CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id)",
+           "CREATE INDEX IF NOT EXISTS relations_tags_id ON relations_tags (id)",
+           "CREATE INDEX IF NOT EXISTS relations_members_id ON relations_members (id, position)",
+           "CREATE INDEX IF NOT EXISTS relations_members_member "
+           "ON relations_members (member_type, member_id)"]
+
+# Optional R-tree over the node coordinates, for fast bounding
+# box queries (see nodes_in_bbox)
+CREATE_NODES_RTREE = ("CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree "
+                      "USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+FILL_NODES_RTREE = ("INSERT OR REPLACE INTO nodes_rtree "
+                    "SELECT id, lat, lat, lon, lon FROM nodes")
+
+
+def create_table_sql(name, fields, element_schema=schema.schema):
+    """CREATE TABLE statement for the rows of one key of
+    a shaped element"""
+
+    rules = database_prep.field_schema(name, element_schema)
+    columns = []
+    for field in fields:
+        column = '"%s" %s' % (field, COLUMN_TYPES[rules[field]['type']])
+        if field == 'id' and name in ('node', 'way', 'relation', 'way_geometry'):
+            column += ' PRIMARY KEY'
+        elif field == 'uid' and name == 'user':
+            column += ' PRIMARY KEY'
+        elif rules[field].get('required'):
+            column += ' NOT NULL'
+        columns.append(column)
+    return 'CREATE TABLE IF NOT EXISTS %s (%s)' % (TABLE_NAMES[name], ', '.join(columns))
+
+
+class SqliteOutput(object):
+    """Write shaped elements into the tables of a SQLite database"""
+
+    # Rows are inserted from tuples in field order (see shape_element_tuples)
+    row_format = 'tuple'
+
+    def __init__(self, db_path=DB_PATH, batch_size=BATCH_SIZE, spatial_index=False,
+                 geometry=False, compact=False, summaries=False):
+        self.db_path = db_path
+        self.output_fields = database_prep.output_fields(geometry, compact)
+        self.schema = database_prep.output_schema(compact)
+        self.batch_size = batch_size
+        self.spatial_index = spatial_index
+        # The summary tables are counted as the rows are inserted
+        self.summary = None
+        if summaries:
+            self.summary = summary_tables.SummaryCollector(self.output_fields)
+        self.conn = None
+        self.inserts = {}
+        self.batches = {}
+        # Rows inserted and seconds spent inserting them, per table
+        self.rows = {}
+        self.seconds = {}
+        self.index_seconds = 0.0
+
+    def __enter__(self):
+        # The rows may be inserted from the writer thread of pipeline.py,
+        # which is then the only one using the connection
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for pragma in LOAD_PRAGMAS:
+            self.conn.execute(pragma)
+        for name, fields in self.output_fields:
+            self.conn.execute(create_table_sql(name, fields, self.schema))
+            # A user is written again when their name changes
+            # within the file (see compact.py)
+            self.inserts[name] = '%s INTO %s (%s) VALUES (%s)' % (
+                'INSERT OR REPLACE' if name == 'user' else 'INSERT',
+                TABLE_NAMES[name],
+                ', '.join('"%s"' % field for field in fields),
+                ', '.join('?' * len(fields)))
+            self.batches[name] = []
+            self.rows[name] = 0
+            self.seconds[name] = 0.0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for name in self.batches:
+                    self.flush(name)
+                self.conn.commit()
+                start = time.time()
+                for index in INDEXES:
+                    self.conn.execute(index)
+                if self.spatial_index:
+                    self.conn.execute(CREATE_NODES_RTREE)
+                    self.conn.execute(FILL_NODES_RTREE)
+                if self.summary is not None:
+                    summary_tables.build_indexes(self.conn)
+                    self.summary.write(self.conn)
+                self.conn.commit()
+                self.index_seconds = time.time() - start
+            else:
+                self.conn.rollback()
+            for pragma in FINISH_PRAGMAS:
+                self.conn.execute(pragma)
+        finally:
+            self.conn.close()
+
+    def flush(self, name):
+        """Insert the buffered rows of one table"""
+
+        batch = self.batches[name]
+        if batch:
+            start = time.time()
+            self.conn.executemany(self.inserts[name], batch)
+            self.seconds[name] += time.time() - start
+            self.rows[name] += len(batch)
+            self.batches[name] = []
+
+    def add_rows(self, name, rows):
+        if self.summary is not None:
+            self.summary.add_rows(name, rows)
+        batch = self.batches[name]
+        batch.extend(rows)
+        if len(batch) >= self.batch_size:
+            self.flush(name)
+
+    def write(self, el):
+        """Buffer the rows of one shaped element"""
+
+        database_prep.write_element(self, el)
+
+    def report(self):
+        """Rows loaded and insert rate of each table"""
+
+        lines = []
+        for name, _ in self.output_fields:
+            seconds = self.seconds[name]
+            rate = self.rows[name] / seconds if seconds else 0.0
+            lines.append("%s: %d rows, %.0f rows/sec" % (TABLE_NAMES[name], self.rows[name], rate))
+        lines.append("indexes: %.1f s" % self.index_seconds)
+        return "\n".join(lines)
+
+
+def has_spatial_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+
+
+def nodes_in_bbox(conn, min_lon, min_lat, max_lon, max_lat):
+    """Ids of the nodes inside a bounding box, using the R-tree
+    when the database has one"""
+
+    if has_spatial_index(conn):
+        # The R-tree keeps float32 boxes, rounded outwards, so it finds
+        # the boxes overlapping the query and the exact coordinates in
+        # nodes decide, as they do without the R-tree
+        sql = ("SELECT nodes.id FROM nodes_rtree JOIN nodes ON nodes.id = nodes_rtree.id "
+               "WHERE nodes_rtree.max_lat >= ? AND nodes_rtree.min_lat <= ? "
+               "AND nodes_rtree.max_lon >= ? AND nodes_rtree.min_lon <= ? "
+               "AND nodes.lat BETWEEN ? AND ? AND nodes.lon BETWEEN ? AND ?")
+        params = (min_lat, max_lat, min_lon, max_lon) * 2
+    else:
+        sql = "SELECT id FROM nodes WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?"
+        params = (min_lat, max_lat, min_lon, max_lon)
+    return [row[0] for row in conn.execute(sql, params)]
@@ -7,11 +7,13 @@
 # The data is actually cleaned when preparing the database,
 # which can be seen in database_prep.py
 
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+from osm_stream import iter_elements
+import audit_cache
+
 OSMFILE = "small_sample.osm"
 
 # I decided to standardize state names to be the full name of the state,
@@ -35,28 +37,36 @@ state_name_mapping = {"OR": "Oregon",
                       "1401 N.E. 68th Avenue  Portland, OR 97213": "Oregon"
                       }
 
+# Tag keys looked at by this audit, used by combined_audit.py
+AUDIT_KEYS = ("addr:state",)
+
 def is_state(elem):
     return (elem.attrib['k'] == "addr:state")
 
+def audit_state(states, state):
+    if state not in expected:
+        states.add(state)
+
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
     states = set()
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_state(tag):
-                    if (tag.attrib['v'] not in expected):
-                        states.add(tag.attrib['v'])
-    osm_file.close()
+    for elem in iter_elements(osmfile):
+        for tag in elem.iter("tag"):
+            if is_state(tag):
+                audit_state(states, tag.attrib['v'])
     return states
 
+def audit_rules():
+    """The expected state names, which the cached results depend on"""
+
+    return {'expected': sorted(expected)}
+
 def update_state_name(state_name):
     if state_name in state_name_mapping:
         state_name = state_name.replace(state_name, state_name_mapping[state_name])
     return state_name
 
 def test():
-    states = audit(OSMFILE)
+    states = audit_cache.cached_audit(OSMFILE, "states", audit, audit_rules())
     pprint.pprint(states)
 
     for state in states:
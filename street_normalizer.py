@@ -0,0 +1,172 @@
+# Street name normalization shared by street_audit.py and
+# database_prep.py.
+# The rules are kept in a data file (street_rules.json by default),
+# so the tables for a new city can be added without code changes:
+#   expected          - correct street types, used by the audit
+#   mapping           - abbreviated street types and their full names
+#                       ("St." => "Street")
+#   specific_mappings - whole street names that are corrected by hand
+#   special_cases     - characters that follow a "#" at the end of
+#                       a street name, which is then removed
+# mapping and special_cases are compiled into a single table keyed
+# by the street type, so a name is cleaned with one lookup of its
+# whole value and one lookup of its last token. Only the last token
+# is rewritten ("St. Johns St" => "St. Johns Street").
+
+import json
+import os
+import re
+import string
+import time
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "street_rules.json")
+
+# Characters matched by \w in the street type regular expression
+# this replaces (r'\b\S+\.?$')
+WORD_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+
+# Marks street types that are removed along with the "#" before them
+REMOVE = None
+
+
+def load_rules(path=RULES_PATH):
+    """Read the street name rules from a json file"""
+
+    with open(path) as f:
+        return json.load(f)
+
+
+class StreetNameNormalizer(object):
+    """Clean street names with the compiled tables of a set of rules"""
+
+    def __init__(self, rules):
+        self.expected = list(rules.get('expected', []))
+        self.mapping = dict(rules.get('mapping', {}))
+        self.specific_mappings = dict(rules.get('specific_mappings', {}))
+        self.special_cases = set(rules.get('special_cases', []))
+
+        # Street type => replacement, or REMOVE for special cases.
+        # mapping is checked before special_cases, so it wins
+        self.street_types = dict.fromkeys(self.special_cases, REMOVE)
+        self.street_types.update(self.mapping)
+
+    def street_type_start(self, name):
+        """Return where the street type (the last token of the name,
+        from its first word boundary) starts, or None if there is none"""
+
+        if not name or name[-1].isspace():
+            return None
+        token = name.rsplit(None, 1)[-1]
+        start = len(name) - len(token)
+        if token[0] not in WORD_CHARS:
+            for i, c in enumerate(token):
+                if c in WORD_CHARS:
+                    return start + i
+            return None
+        return start
+
+    def street_type(self, name):
+        """Return the street type of a name, or None"""
+
+        start = self.street_type_start(name)
+        if start is None:
+            return None
+        return name[start:]
+
+    def normalize(self, name):
+        """Return a street name in its proper form"""
+
+        corrected = self.specific_mappings.get(name)
+        if corrected is not None:
+            return corrected
+        start = self.street_type_start(name)
+        if start is None:
+            return name
+        street_type = name[start:]
+        if street_type not in self.street_types:
+            return name
+        replacement = self.street_types[street_type]
+        if replacement is REMOVE:
+            if name.endswith(" #", 0, start):
+                return name[:start - 2]
+            return name
+        return (name[:start] + replacement).strip(".").strip(" ")
+
+
+_default = None
+
+def default_normalizer():
+    """The normalizer for the rules in street_rules.json"""
+
+    global _default
+    if _default is None:
+        _default = StreetNameNormalizer(load_rules())
+    return _default
+
+
+# ================================================== #
+#               Benchmark                            #
+# ================================================== #
+street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+
+def regex_update_name(name, rules):
+    """The regular expression and dictionary version of
+    update_name that the normalizer replaces"""
+
+    m = street_type_re.search(name)
+    street_type = m.group()
+    if name in rules['specific_mappings']:
+        name = name.replace(name, rules['specific_mappings'][name])
+    elif street_type in rules['mapping']:
+        name = name.replace(street_type, rules['mapping'][street_type]).strip(".").strip(" ")
+    elif street_type in rules['special_cases']:
+        name_to_replace = " #" + street_type
+        name = name.replace(name_to_replace, "")
+    return name
+
+def benchmark(names, repeat=3):
+    """Time the regex update_name and the normalizer over a list of
+    street names, returning the best time of each in seconds"""
+
+    rules = load_rules()
+    rules['special_cases'] = set(rules['special_cases'])
+    normalizer = StreetNameNormalizer(rules)
+    results = {}
+    for label, func in [('regex', lambda name: regex_update_name(name, rules)),
+                        ('normalizer', normalizer.normalize)]:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for name in names:
+                func(name)
+            seconds = time.time() - start
+            best = seconds if best is None else min(best, seconds)
+        results[label] = best
+    return results
+
+def test():
+    """Compare the normalizer with the regex version and time both"""
+
+    rules = load_rules()
+    normalizer = StreetNameNormalizer(rules)
+    names = ["N. Charleston Ave.", "Northeast 82nd Avenue #D", "Southeast Division St",
+             "SE Hawthorne Blvd", "US 26 (OR)", "gresham", "Northwest 23rd Place",
+             "Southwest Barbur Blvd.", "SW Main st.", "North Lombard Street #101",
+             "Northeast Sandy Boulevard", "Southwest Macadam Ave", "Southeast 122nd Ave"]
+    for name in names:
+        assert normalizer.normalize(name) == regex_update_name(name, rules), name
+
+    # Only the last token is rewritten
+    assert normalizer.normalize("St. Johns St") == "St. Johns Street"
+    assert regex_update_name("St. Johns St", rules) == "Street. Johns Street"
+    assert normalizer.normalize("Southeast Stark St") == "Southeast Stark Street"
+    assert normalizer.street_type("Avenue #D") == "D"
+    assert normalizer.street_type("Main Street ") is None
+
+    results = benchmark(names * 20000)
+    print "regex: %.3f s, normalizer: %.3f s (%.1fx)" % (
+        results['regex'], results['normalizer'], results['regex'] / results['normalizer'])
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,495 @@
+# Speeds up the analysis queries of the report on the SQLite database
+# built by process_map(..., output='sqlite', summaries=True).
+# The report's queries (top contributing users, counts of amenities,
+# postcodes and cities) group every row of the tag tables, or of
+# nodes and ways, on each run. Two things are added after the load:
+#  * covering indexes on the tag tables (key, type, value, id) and on
+#    the uid of nodes and ways, so queries on a single key read only
+#    the index instead of the whole table
+#  * summary tables, counted in one pass over the rows as they are
+#    inserted (see SummaryCollector) rather than by GROUP BY queries
+#    over the loaded tables afterwards:
+#      summary_users      elements added by each uid
+#      summary_keys       elements with each tag key and type, and the
+#                         number of distinct values of those in VALUE_KEYS
+#      summary_tags       elements with each value of the keys in
+#                         VALUE_KEYS
+#      summary_postcodes  elements with each postcode and city, and
+#                         how many of them are amenities
+# Values are only counted for the keys in VALUE_KEYS, whose values
+# repeat (amenity, postcode, city, ...), so memory use during the load
+# grows with the number of users and distinct keys, not with names,
+# house numbers and other values that are mostly unique.
+# build() adds both to a database loaded some other way, and
+# incremental_update.py updates the summary tables with the counts of
+# the rows each change file removes and adds (see SummaryDeltas).
+# benchmark_queries() times the report queries against the tables
+# with and without the covering indexes, and against the summaries.
+
+import sqlite3
+import time
+
+COVERING_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags (key, type, value, id)",
+    "CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags (key, type, value, id)",
+    "CREATE INDEX IF NOT EXISTS relations_tags_key_value "
+    "ON relations_tags (key, type, value, id)",
+    "CREATE INDEX IF NOT EXISTS nodes_uid ON nodes (uid)",
+    "CREATE INDEX IF NOT EXISTS ways_uid ON ways (uid)"]
+
+CREATE_SUMMARIES = [
+    "CREATE TABLE IF NOT EXISTS summary_users (uid INTEGER PRIMARY KEY, user TEXT, "
+    "nodes INTEGER NOT NULL, ways INTEGER NOT NULL, relations INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS summary_tags (key TEXT NOT NULL, type TEXT NOT NULL, "
+    "value TEXT NOT NULL, nodes INTEGER NOT NULL, ways INTEGER NOT NULL, "
+    "relations INTEGER NOT NULL, PRIMARY KEY (key, type, value))",
+    "CREATE TABLE IF NOT EXISTS summary_keys (key TEXT NOT NULL, type TEXT NOT NULL, "
+    "nodes INTEGER NOT NULL, ways INTEGER NOT NULL, relations INTEGER NOT NULL, "
+    "distinct_values INTEGER, PRIMARY KEY (key, type))",
+    "CREATE TABLE IF NOT EXISTS summary_postcodes (postcode TEXT NOT NULL, city TEXT, "
+    "nodes INTEGER NOT NULL, ways INTEGER NOT NULL, relations INTEGER NOT NULL, "
+    "amenities INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS summary_postcodes_postcode "
+    "ON summary_postcodes (postcode, city)"]
+
+SUMMARY_TABLES = ('summary_users', 'summary_tags', 'summary_keys', 'summary_postcodes')
+
+# Element types, in the order of the counts in the summary tables
+KINDS = ('node', 'way', 'relation')
+
+# (key, type) of the tags summary_postcodes is grouped by
+POSTCODE = ('postcode', 'addr')
+CITY = ('city', 'addr')
+AMENITY = ('amenity', 'regular')
+
+# (key, type) of the tags whose values are counted in summary_tags
+VALUE_KEYS = frozenset([AMENITY, POSTCODE, CITY, ('state', 'addr'),
+                        ('shop', 'regular'), ('cuisine', 'regular'),
+                        ('leisure', 'regular'), ('tourism', 'regular'),
+                        ('religion', 'regular'), ('highway', 'regular'),
+                        ('building', 'regular'), ('landuse', 'regular')])
+
+# Key columns of each summary table, and the number of counts after them
+TABLE_KEYS = {'summary_users': (('uid',), 3),
+              'summary_keys': (('key', 'type'), 3),
+              'summary_tags': (('key', 'type', 'value'), 3),
+              'summary_postcodes': (('postcode', 'city'), 4)}
+
+COUNT_COLUMNS = ('nodes', 'ways', 'relations', 'amenities')
+
+# Sets distinct_values of summary_keys for one (key, type) in VALUE_KEYS
+UPDATE_DISTINCT_VALUES = ("UPDATE summary_keys SET distinct_values = (SELECT COUNT(*) "
+                          "FROM summary_tags WHERE key = ? AND type = ?) "
+                          "WHERE key = ? AND type = ?")
+
+
+class SummaryCollector(object):
+    """Counts the rows loaded into the database, as they are added,
+    for the summary tables"""
+
+    def __init__(self, output_fields, value_keys=VALUE_KEYS):
+        fields = dict(output_fields)
+        # Where the uid and user name are in the rows of each element
+        # type; in compact mode the names come from the users rows instead
+        self.uid_indexes = [fields[kind].index('uid') for kind in KINDS]
+        self.user_indexes = [fields[kind].index('user') if 'user' in fields[kind] else None
+                             for kind in KINDS]
+        tag_fields = fields['node_tags']
+        self.tag_indexes = [tag_fields.index(field) for field in ('id', 'key', 'type', 'value')]
+        self.value_keys = value_keys
+        self.names = {}
+        # uid => [nodes, ways, relations]
+        self.users = {}
+        # (key, type) => [nodes, ways, relations]
+        self.keys = {}
+        # (key, type, value) => [nodes, ways, relations], for value_keys
+        self.tags = {}
+        # (postcode, city) => [nodes, ways, relations, amenities]
+        self.postcodes = {}
+
+    def add_rows(self, name, rows, sign=1):
+        """Count rows inserted into the table for one key of a
+        shaped element (or removed from it, with sign=-1)"""
+
+        if name in KINDS:
+            self.add_elements(KINDS.index(name), rows, sign)
+        elif name.endswith('_tags'):
+            self.add_tags(KINDS.index(name[:-len('_tags')]), rows, sign)
+        elif name == 'user':
+            for uid, user in rows:
+                self.names[int(uid)] = user
+
+    def add_elements(self, kind, rows, sign):
+        users = self.users
+        names = self.names
+        uid_index = self.uid_indexes[kind]
+        user_index = self.user_indexes[kind]
+        for row in rows:
+            uid = int(row[uid_index])
+            counts = users.get(uid)
+            if counts is None:
+                counts = users[uid] = [0, 0, 0]
+            counts[kind] += sign
+            if user_index is not None and sign > 0:
+                names[uid] = row[user_index]
+
+    def add_tags(self, kind, rows, sign):
+        # The tags of an element are always added together,
+        # one after another, so the postcode, city and amenity
+        # of each element are collected as its rows go by
+        keys = self.keys
+        tags = self.tags
+        value_keys = self.value_keys
+        id_index, key_index, type_index, value_index = self.tag_indexes
+        element_id = None
+        postcode = city = None
+        amenity = False
+        for row in rows:
+            key_type = (row[key_index], row[type_index])
+            counts = keys.get(key_type)
+            if counts is None:
+                counts = keys[key_type] = [0, 0, 0]
+            counts[kind] += sign
+            if row[id_index] != element_id:
+                if postcode is not None:
+                    self.add_postcode(kind, postcode, city, amenity, sign)
+                element_id = row[id_index]
+                postcode = city = None
+                amenity = False
+            if key_type in value_keys:
+                value = row[value_index]
+                tag = key_type + (value,)
+                counts = tags.get(tag)
+                if counts is None:
+                    counts = tags[tag] = [0, 0, 0]
+                counts[kind] += sign
+                if key_type == POSTCODE:
+                    postcode = value
+                elif key_type == CITY:
+                    city = value
+                elif key_type == AMENITY:
+                    amenity = True
+        if postcode is not None:
+            self.add_postcode(kind, postcode, city, amenity, sign)
+
+    def add_postcode(self, kind, postcode, city, amenity, sign):
+        counts = self.postcodes.get((postcode, city))
+        if counts is None:
+            counts = self.postcodes[(postcode, city)] = [0, 0, 0, 0]
+        counts[kind] += sign
+        if amenity:
+            counts[3] += sign
+
+    def table_counts(self):
+        """(table, {key columns: counts}) of each summary table"""
+
+        return [('summary_users', dict(((uid,), counts) for uid, counts in self.users.iteritems())),
+                ('summary_keys', self.keys),
+                ('summary_tags', self.tags),
+                ('summary_postcodes', self.postcodes)]
+
+    def write(self, conn):
+        """Replace the summary tables with the counts"""
+
+        create_tables(conn)
+        conn.executemany("INSERT INTO summary_users VALUES (?, ?, ?, ?, ?)",
+                         ((uid, self.names.get(uid)) + tuple(counts)
+                          for uid, counts in self.users.iteritems()))
+        conn.executemany("INSERT INTO summary_keys VALUES (?, ?, ?, ?, ?, NULL)",
+                         (key + tuple(counts) for key, counts in self.keys.iteritems()))
+        conn.executemany("INSERT INTO summary_tags VALUES (?, ?, ?, ?, ?, ?)",
+                         (tag + tuple(counts) for tag, counts in self.tags.iteritems()))
+        conn.executemany("INSERT INTO summary_postcodes VALUES (?, ?, ?, ?, ?, ?)",
+                         (key + tuple(counts) for key, counts in self.postcodes.iteritems()))
+        update_distinct_values(conn, self.value_keys)
+
+
+class SummaryDeltas(SummaryCollector):
+    """Changes to the summary tables of a loaded database, from
+    the rows of the elements a change file removes and adds
+    (see incremental_update.py)"""
+
+    def __init__(self, conn, output_fields, value_keys=VALUE_KEYS):
+        SummaryCollector.__init__(self, output_fields, value_keys)
+        self.conn = conn
+        fields = dict(output_fields)
+        self.selects = {}
+        for kind in KINDS:
+            for name, table in ((kind, kind + 's'), (kind + '_tags', kind + 's_tags')):
+                self.selects[name] = "SELECT %s FROM %s WHERE id = ?" % (
+                    ', '.join('"%s"' % field for field in fields[name]), table)
+
+    def remove(self, kind, element_id):
+        """Count the rows of an element that is about to be deleted
+        or replaced as removed"""
+
+        for name in (kind, kind + '_tags'):
+            self.add_rows(name, self.conn.execute(self.selects[name], (element_id,)), -1)
+
+    def apply(self):
+        """Add the changes to the summary tables"""
+
+        conn = self.conn
+        for table, counts in self.table_counts():
+            columns, n_counts = TABLE_KEYS[table]
+            count_columns = COUNT_COLUMNS[:n_counts]
+            match = ' AND '.join('%s IS ?' % column for column in columns)
+            update = "UPDATE %s SET %s WHERE %s" % (
+                table, ', '.join('%s = %s + ?' % (column, column) for column in count_columns),
+                match)
+            insert = "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join(columns + count_columns),
+                ', '.join('?' * (len(columns) + n_counts)))
+            for key, delta in counts.iteritems():
+                if not any(delta):
+                    continue
+                if conn.execute(update, tuple(delta) + key).rowcount == 0:
+                    conn.execute(insert, key + tuple(delta))
+            conn.execute("DELETE FROM %s WHERE %s" % (
+                table, ' AND '.join('%s = 0' % column for column in count_columns)))
+        conn.executemany("UPDATE summary_users SET user = ? WHERE uid = ?",
+                         [(user, uid) for uid, user in self.names.iteritems()])
+        update_distinct_values(conn, [key for key in self.value_keys
+                                      if any(tag[:2] == key for tag in self.tags)])
+        self.reset()
+
+    def reset(self):
+        self.names = {}
+        self.users = {}
+        self.keys = {}
+        self.tags = {}
+        self.postcodes = {}
+
+
+def has_table(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table,)).fetchone() is not None
+
+
+def create_tables(conn):
+    """Create the summary tables, emptying them if they exist"""
+
+    for sql in CREATE_SUMMARIES:
+        conn.execute(sql)
+    for table in SUMMARY_TABLES:
+        conn.execute("DELETE FROM %s" % table)
+
+
+def update_distinct_values(conn, value_keys):
+    conn.executemany(UPDATE_DISTINCT_VALUES, [key + key for key in value_keys])
+
+
+def build_indexes(conn):
+    for index in COVERING_INDEXES:
+        conn.execute(index)
+
+
+def drop_indexes(conn):
+    """Drop the covering indexes (to compare queries without them)"""
+
+    for index in COVERING_INDEXES:
+        name = index.split(' EXISTS ', 1)[1].split(None, 1)[0]
+        conn.execute("DROP INDEX IF EXISTS %s" % name)
+
+
+def tags_of(key_type):
+    """Rows of every tag with a (key, type), with the element type"""
+
+    key, tag_type = key_type
+    return " UNION ALL ".join(
+        "SELECT '%s' AS kind, id, value FROM %ss_tags WHERE key = '%s' AND type = '%s'"
+        % (kind, kind, key, tag_type) for kind in KINDS)
+
+
+def rebuild(conn, value_keys=VALUE_KEYS):
+    """Count the summary tables again from the loaded tables, with
+    GROUP BY queries. Where a uid was renamed, any of its names may
+    be kept"""
+
+    create_tables(conn)
+    counts = "SUM(kind = 'node'), SUM(kind = 'way'), SUM(kind = 'relation')"
+    if has_table(conn, 'users'):
+        # Compact mode (see compact.py)
+        elements = " UNION ALL ".join("SELECT '%s' AS kind, uid FROM %ss" % (kind, kind)
+                                      for kind in KINDS)
+        conn.execute("INSERT INTO summary_users SELECT e.uid, users.user, %s FROM (%s) e "
+                     "LEFT JOIN users ON users.uid = e.uid GROUP BY e.uid" % (counts, elements))
+    else:
+        elements = " UNION ALL ".join("SELECT '%s' AS kind, uid, user FROM %ss" % (kind, kind)
+                                      for kind in KINDS)
+        conn.execute("INSERT INTO summary_users SELECT uid, MAX(user), %s FROM (%s) "
+                     "GROUP BY uid" % (counts, elements))
+    tags = " UNION ALL ".join("SELECT '%s' AS kind, key, type, value FROM %ss_tags"
+                              % (kind, kind) for kind in KINDS)
+    conn.execute("INSERT INTO summary_keys SELECT key, type, %s, NULL FROM (%s) "
+                 "GROUP BY key, type" % (counts, tags))
+    for key, tag_type in value_keys:
+        conn.execute("INSERT INTO summary_tags SELECT key, type, value, %s FROM (%s) "
+                     "WHERE key = ? AND type = ? GROUP BY value" % (counts, tags),
+                     (key, tag_type))
+    update_distinct_values(conn, value_keys)
+    conn.execute("INSERT INTO summary_postcodes "
+                 "SELECT p.value, c.value, SUM(p.kind = 'node'), SUM(p.kind = 'way'), "
+                 "SUM(p.kind = 'relation'), SUM(a.id IS NOT NULL) FROM (%s) p "
+                 "LEFT JOIN (%s) c ON c.kind = p.kind AND c.id = p.id "
+                 "LEFT JOIN (%s) a ON a.kind = p.kind AND a.id = p.id "
+                 "GROUP BY p.value, c.value" % (tags_of(POSTCODE), tags_of(CITY), tags_of(AMENITY)))
+
+
+def build(conn):
+    """Add the covering indexes and summary tables to a database
+    that was loaded without them"""
+
+    build_indexes(conn)
+    rebuild(conn)
+    conn.commit()
+
+
+# The report's queries, each run against the loaded tables and
+# against the summary tables
+QUERIES = [
+    ('top_users',
+     "SELECT uid, COUNT(*) AS n FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) "
+     "GROUP BY uid ORDER BY n DESC, uid LIMIT 10",
+     "SELECT uid, nodes + ways AS n FROM summary_users ORDER BY n DESC, uid LIMIT 10"),
+    ('amenities',
+     "SELECT value, COUNT(*) AS n FROM (%s) "
+     "GROUP BY value ORDER BY n DESC, value" % tags_of(AMENITY),
+     "SELECT value, nodes + ways + relations AS n FROM summary_tags "
+     "WHERE key = 'amenity' AND type = 'regular' ORDER BY n DESC, value"),
+    ('postcodes',
+     "SELECT value, COUNT(*) AS n FROM (%s) "
+     "GROUP BY value ORDER BY n DESC, value" % tags_of(POSTCODE),
+     "SELECT postcode, SUM(nodes + ways + relations) AS n FROM summary_postcodes "
+     "GROUP BY postcode ORDER BY n DESC, postcode"),
+    ('cities',
+     "SELECT value, COUNT(*) AS n FROM (%s) "
+     "GROUP BY value ORDER BY n DESC, value" % tags_of(CITY),
+     "SELECT value, nodes + ways + relations AS n FROM summary_tags "
+     "WHERE key = 'city' AND type = 'addr' ORDER BY n DESC, value"),
+    ('amenities_by_postcode',
+     "SELECT p.value, COUNT(*) AS n FROM (%s) p JOIN (%s) a "
+     "ON a.kind = p.kind AND a.id = p.id "
+     "GROUP BY p.value ORDER BY n DESC, p.value" % (tags_of(POSTCODE), tags_of(AMENITY)),
+     "SELECT postcode, SUM(amenities) AS n FROM summary_postcodes GROUP BY postcode "
+     "HAVING n > 0 ORDER BY n DESC, postcode"),
+]
+
+
+def best_time(conn, sql, repeat):
+    """Rows of a query, and the fastest of repeat runs"""
+
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        rows = conn.execute(sql).fetchall()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return rows, best
+
+
+def benchmark_queries(db_path, repeat=3):
+    """Time each query of QUERIES against the loaded tables without
+    and with the covering indexes, and against the summary tables,
+    checking that they give the same rows. The covering indexes are
+    dropped for the first run and built again afterwards"""
+
+    conn = sqlite3.connect(db_path)
+    try:
+        drop_indexes(conn)
+        scans = [best_time(conn, scan, repeat) for _, scan, _ in QUERIES]
+        build_indexes(conn)
+        conn.commit()
+        results = []
+        for (name, scan, summary), (rows, scan_seconds) in zip(QUERIES, scans):
+            indexed_rows, indexed_seconds = best_time(conn, scan, repeat)
+            summary_rows, summary_seconds = best_time(conn, summary, repeat)
+            if not rows == indexed_rows == summary_rows:
+                raise AssertionError("%s: the summary tables give different rows" % name)
+            results.append({'query': name, 'rows': len(rows), 'scan_seconds': scan_seconds,
+                            'indexed_seconds': indexed_seconds,
+                            'summary_seconds': summary_seconds})
+    finally:
+        conn.close()
+    return results
+
+
+def report_lines(results):
+    lines = ["%-22s %6s %10s %10s %10s %8s" % ('query', 'rows', 'scan', 'indexed',
+                                               'summary', 'speedup')]
+    for result in results:
+        fastest = min(result['indexed_seconds'], result['summary_seconds'])
+        lines.append("%-22s %6d %9.4fs %9.4fs %9.4fs %7.0fx" % (
+            result['query'], result['rows'], result['scan_seconds'],
+            result['indexed_seconds'], result['summary_seconds'],
+            result['scan_seconds'] / fastest if fastest else 0.0))
+    return lines
+
+
+def test():
+    """Check that the summaries counted during the load, and updated
+    by a change file, are the same as the ones counted afterwards with
+    GROUP BY, for the regular and compact layouts, and time the report
+    queries"""
+
+    import os
+    import shutil
+    import tempfile
+
+    import benchmark
+    import database_prep
+    import incremental_update
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        benchmark.generate_osm(osm_path, 50000)
+
+        for compact in (False, True):
+            db_path = os.path.join(tmp_dir, 'compact.db' if compact else 'map.db')
+            database_prep.process_map(osm_path, False, output='sqlite', db_path=db_path,
+                                      summaries=True, compact=compact)
+            conn = sqlite3.connect(db_path)
+            streamed = [sorted(conn.execute("SELECT * FROM %s" % table))
+                        for table in SUMMARY_TABLES]
+            rebuild(conn)
+            for table, rows in zip(SUMMARY_TABLES, streamed):
+                assert sorted(conn.execute("SELECT * FROM %s" % table)) == rows, table
+            assert streamed[0] and streamed[3]
+            conn.close()
+
+        # A change file moves a tagged node to another postcode,
+        # amenity and user, deletes a way and creates a node
+        conn = incremental_update.open_db(os.path.join(tmp_dir, 'map.db'))
+        node_id = conn.execute("SELECT id FROM nodes_tags WHERE key = 'postcode' "
+                               "AND type = 'addr' LIMIT 1").fetchone()[0]
+        way_id = conn.execute("SELECT id FROM ways_tags LIMIT 1").fetchone()[0]
+        osc_path = os.path.join(tmp_dir, '1.osc')
+        with open(osc_path, 'wb') as f:
+            f.write("""<osmChange version="0.6">
+<modify><node id="%d" lat="45.5" lon="-122.6" version="9" changeset="9" uid="999999"
+ user="new_user" timestamp="2020-01-01T00:00:00Z">
+ <tag k="addr:postcode" v="97000"/><tag k="amenity" v="library"/></node></modify>
+<delete><way id="%d" version="9" changeset="9" uid="1" user="x"
+ timestamp="2020-01-01T00:00:00Z"/></delete>
+<create><node id="-1" lat="45.4" lon="-122.5" version="1" changeset="9" uid="999999"
+ user="new_user" timestamp="2020-01-01T00:00:00Z">
+ <tag k="addr:city" v="Newtown"/><tag k="addr:postcode" v="97000"/>
+ <tag k="fixme" v="check"/></node></create>
+</osmChange>""" % (node_id, way_id))
+        incremental_update.apply_change_file(conn, osc_path)
+        updated = [sorted(conn.execute("SELECT * FROM %s" % table)) for table in SUMMARY_TABLES]
+        rebuild(conn)
+        for table, rows in zip(SUMMARY_TABLES, updated):
+            assert sorted(conn.execute("SELECT * FROM %s" % table)) == rows, table
+        assert (999999, u'new_user', 2, 0, 0) in updated[0]
+        conn.close()
+
+        print "\n".join(report_lines(benchmark_queries(os.path.join(tmp_dir, 'map.db'))))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
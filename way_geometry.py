@@ -0,0 +1,257 @@
+# Builds the geometry of each way while process_map in database_prep.py
+# runs, so the ways don't have to be joined back against the nodes to
+# get their coordinates.
+# The coordinates of every node are kept as it is streamed, as int32
+# fixed-point values (degrees * 10^7, the precision OSM stores), and
+# each way is written as a WKB linestring (in hex) in the
+# ways_geometry table. Ways with fewer than two nodes in the file
+# have no geometry.
+# Two stores are available: 'sorted' keeps the ids and coordinates in
+# arrays (16 bytes per node) and finds them by binary search, which
+# needs the nodes in id order, as in extracts and sorted files; and
+# 'dense' keeps the coordinates of every possible id in a sparse
+# memory-mapped file (8 bytes per id, though the pages of unused ids
+# are never written), which takes nodes in any order and suits
+# extracts with a large share of all the node ids. Negative ids (new
+# nodes in files edited with JOSM) are skipped by the dense store.
+
+import array
+import bisect
+import binascii
+import mmap
+import os
+import struct
+import tempfile
+
+# Coordinates are stored as int32 in units of 10^-7 degrees
+COORDINATE_PRECISION = 10 ** 7
+
+# The dense store adds this to each coordinate, so that the zero
+# bytes of a new page of the file mean a missing node
+DENSE_OFFSET = 2 ** 31
+
+# WKB header of a little-endian linestring
+WKB_LINESTRING = struct.pack('<BI', 1, 2)
+
+
+def to_fixed(value):
+    """Fixed-point int of a coordinate given as a string or float"""
+
+    return int(round(float(value) * COORDINATE_PRECISION))
+
+
+class SortedLocationStore(object):
+    """Node coordinates in parallel arrays sorted by node id.
+    The nodes must arrive in id order, as they do in sorted OSM
+    files: sorting the arrays afterwards would take several Python
+    objects per node, which is what the arrays are there to avoid"""
+
+    def __init__(self):
+        # 'l' is 64 bits on the 64-bit platforms this runs on
+        # (Python 2 arrays have no 'q')
+        self.ids = array.array('l')
+        self.lats = array.array('i')
+        self.lons = array.array('i')
+
+    def add(self, node_id, lat, lon):
+        if self.ids and node_id <= self.ids[-1]:
+            raise ValueError("Node %d comes after node %d: the sorted location store "
+                             "needs the nodes in id order (sort the file, or use "
+                             "location_store='dense')" % (node_id, self.ids[-1]))
+        self.ids.append(node_id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+
+    def get(self, node_id):
+        """(lat, lon) of a node in fixed point, or None"""
+
+        ids = self.ids
+        i = bisect.bisect_left(ids, node_id)
+        if i < len(ids) and ids[i] == node_id:
+            return self.lats[i], self.lons[i]
+        return None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_bytes(self):
+        return sum(len(a) * a.itemsize for a in (self.ids, self.lats, self.lons))
+
+    def close(self):
+        pass
+
+
+class DenseLocationStore(object):
+    """Node coordinates in a memory-mapped file, at offset 8 * id.
+    The file grows as larger ids are added; it is sparse on disk,
+    and deleted when the store is closed unless a path was given"""
+
+    def __init__(self, path=None, initial_ids=2 ** 20):
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.nodes')
+            self.temporary = True
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            self.temporary = False
+        self.path = path
+        self.fd = fd
+        self.map = None
+        self.capacity = 0
+        self.count = 0
+        self.skipped = 0
+        self.grow(initial_ids)
+
+    def grow(self, ids):
+        if self.map is not None:
+            self.map.close()
+        os.ftruncate(self.fd, ids * 8)
+        self.map = mmap.mmap(self.fd, ids * 8)
+        self.capacity = ids
+
+    def add(self, node_id, lat, lon):
+        if node_id < 0:
+            # pack_into would count a negative offset from the end
+            # of the map and overwrite another node
+            self.skipped += 1
+            return
+        if node_id >= self.capacity:
+            self.grow(max(node_id + 1, self.capacity * 2))
+        struct.pack_into('<II', self.map, node_id * 8, lat + DENSE_OFFSET, lon + DENSE_OFFSET)
+        self.count += 1
+
+    def get(self, node_id):
+        if node_id < 0 or node_id >= self.capacity:
+            return None
+        lat, lon = struct.unpack_from('<II', self.map, node_id * 8)
+        if lat == 0:
+            return None
+        return lat - DENSE_OFFSET, lon - DENSE_OFFSET
+
+    def __len__(self):
+        return self.count
+
+    def memory_bytes(self):
+        # Size of the mapping; only the pages in use take memory
+        return self.capacity * 8
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+        if self.temporary:
+            os.remove(self.path)
+
+
+STORES = {'sorted': SortedLocationStore, 'dense': DenseLocationStore}
+
+
+def linestring_wkb(points):
+    """WKB linestring of a list of fixed-point (lat, lon) points"""
+
+    coordinates = []
+    for lat, lon in points:
+        coordinates.append(lon / float(COORDINATE_PRECISION))
+        coordinates.append(lat / float(COORDINATE_PRECISION))
+    return (WKB_LINESTRING + struct.pack('<I', len(points))
+            + struct.pack('<%dd' % len(coordinates), *coordinates))
+
+
+def parse_wkb(wkb_hex):
+    """List of (lon, lat) points of a WKB linestring in hex"""
+
+    wkb = binascii.unhexlify(wkb_hex)
+    count, = struct.unpack_from('<I', wkb, 5)
+    values = struct.unpack_from('<%dd' % (count * 2), wkb, 9)
+    return zip(values[::2], values[1::2])
+
+
+class WayGeometry(object):
+    """Keeps the coordinates of the nodes as they are streamed
+    and builds the geometry rows of the ways"""
+
+    def __init__(self, store='sorted', **store_options):
+        if store not in STORES:
+            raise ValueError("Unknown location store: %r" % (store,))
+        self.store = STORES[store](**store_options)
+        self.missing_nodes = 0
+
+    def add_node(self, element):
+        attrib = element.attrib
+        self.store.add(int(attrib['id']), to_fixed(attrib['lat']), to_fixed(attrib['lon']))
+
+    def way_rows(self, element):
+        """Geometry rows (id, linestring) of a way, as tuples"""
+
+        get = self.store.get
+        points = []
+        for nd in element.iter('nd'):
+            point = get(int(nd.attrib['ref']))
+            if point is None:
+                self.missing_nodes += 1
+            else:
+                points.append(point)
+        if len(points) < 2:
+            return []
+        return [(element.attrib['id'], binascii.hexlify(linestring_wkb(points)))]
+
+    def close(self):
+        self.store.close()
+
+
+def test(n_nodes=200000):
+    """Check both stores against a dict, and the geometries written
+    by process_map against the nodes of the sample file"""
+
+    import csv
+    import random
+    import shutil
+
+    import database_prep
+    import osm_stream
+
+    ids = sorted(random.sample(xrange(1, 10 ** 8), n_nodes))
+    expected = dict((node_id, (random.randint(-900000000, 900000000),
+                               random.randint(-1800000000, 1800000000)))
+                    for node_id in ids)
+    for name in STORES:
+        store = STORES[name]()
+        try:
+            for node_id in ids:
+                store.add(node_id, *expected[node_id])
+            assert all(store.get(node_id) == expected[node_id] for node_id in ids), name
+            assert store.get(ids[-1] + 1) is None and store.get(0) is None
+            if name == 'dense':
+                store.add(-1, 0, 0)
+                assert store.get(-1) is None and store.skipped == 1
+                assert all(store.get(node_id) == expected[node_id] for node_id in ids)
+            else:
+                try:
+                    store.add(ids[0], 0, 0)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("the sorted store took an unsorted id")
+            print "%s store: %d nodes, %d kB" % (name, len(store), store.memory_bytes() / 1024)
+        finally:
+            store.close()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_path = os.path.join(tmp_dir, 'map.osm')
+        osm_stream.write_sample_file(osm_path, 1000)
+        paths = dict((key, os.path.join(tmp_dir, os.path.basename(path)))
+                     for key, path in database_prep.OUTPUT_PATHS.items())
+        database_prep.process_map(osm_path, True, paths=paths, geometry=True)
+        with open(paths['way_geometry']) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 100
+        for row in rows:
+            points = parse_wkb(row['linestring'])
+            assert len(points) == 10
+            assert all(point == (-122.6, 45.5) for point in points)
+        print "%d way geometries" % len(rows)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
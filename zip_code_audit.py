@@ -8,16 +8,21 @@
 # The data is actually cleaned when preparing the database, 
 # which can be seen in database_prep.py
 
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+from osm_stream import iter_elements
+import audit_cache
+
 OSMFILE = "small_sample.osm"
 
 #Regular expression checks whether the zip code is a 5-digit number
 zip_code_re = re.compile(r'^\d{5}$')
 
+# Tag keys looked at by this audit, used by combined_audit.py
+AUDIT_KEYS = ("addr:postcode",)
+
 def is_zip_code(elem):
     return (elem.attrib['k'] == "addr:postcode")
 
@@ -27,16 +32,18 @@ def audit_zip(zip_codes, code):
         zip_codes.add(code)
 
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
     zip_codes = set()
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_zip_code(tag):
-                    audit_zip(zip_codes, tag.attrib['v'])
-    osm_file.close()
+    for elem in iter_elements(osmfile):
+        for tag in elem.iter("tag"):
+            if is_zip_code(tag):
+                audit_zip(zip_codes, tag.attrib['v'])
     return zip_codes
 
+def audit_rules():
+    """The zip code pattern, which the cached results depend on"""
+
+    return {'pattern': zip_code_re.pattern}
+
 # No mapping dictionary was used for zip codes
 # The only issues that needed to be corrected were hyphenated zip codes
 # and "Portland, OR " being included before the code
@@ -49,7 +56,7 @@ def update_zip(zip_code):
     return zip_code
 
 def test():
-    zips = audit(OSMFILE)
+    zips = audit_cache.cached_audit(OSMFILE, "zip_codes", audit, audit_rules())
     pprint.pprint(zips)
 
     for zip in zips: